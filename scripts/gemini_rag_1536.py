@@ -1,86 +1,2548 @@
 #!/usr/bin/env python3
 """
-RAG Population with LangChain RecursiveCharacterTextSplitter and gemini-embedding-001
+RAG Population with RecursiveCharacterTextSplitter chunking and gemini-embedding-001
 
-Uses LangChain's RecursiveCharacterTextSplitter for robust, batchable text splitting
-and VertexAI embeddings with gemini-embedding-001 model.
+Splits text into the chunks LangChain's RecursiveCharacterTextSplitter produces (with a
+span-based reimplementation of it) and embeds them with VertexAI's gemini-embedding-001 model.
 """
 
 import argparse
+import asyncio
+import bisect
+import codecs
+import functools
+import gzip
+import hashlib
+import importlib.util
+import itertools
 import logging
+import math
+import multiprocessing
 import os
+import queue
+import random
+import re
+import signal
+import sqlite3
 import sys
+import tempfile
+import threading
 import time
+import zlib
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Tuple
 import json
 
 # Core libraries
 import numpy as np
-from google.cloud import storage
-from google.cloud import firestore
-import firebase_admin
-from firebase_admin import credentials
-from google.cloud.firestore_v1.vector import Vector
- 
-
-
-# LangChain imports for chunking and embeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_google_vertexai.embeddings import VertexAIEmbeddings
-from langchain.text_splitter import RecursiveJsonSplitter
-
-# File processing
-import PyPDF2
-import io
-
-# Configure logging with more detail
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(f'rag_gemini_1536_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log'),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+
+# The Google Cloud SDKs, LangChain and PyPDF2 take most of the startup time, so they are
+# imported where first used: a run only pays for the clients and splitters it actually needs
+
 logger = logging.getLogger(__name__)
 
+
+def configure_logging(level: str = 'INFO'):
+    """Configure logging with more detail (called from main so pool workers don't open log files)"""
+    logging.basicConfig(
+        level=getattr(logging, level),
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler(f'rag_gemini_1536_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log'),
+            logging.StreamHandler(sys.stdout)
+        ]
+    )
+
+EMBEDDING_MODEL = "gemini-embedding-001"
+
+# Text formats that can be read in ranges and split without holding the whole file
+STREAMABLE_EXTENSIONS = ('.txt', '.md', '.csv', '.json')
+
+# Largest vector a Firestore vector index accepts
+FIRESTORE_MAX_VECTOR_DIMENSIONS = 2048
+
+# Compact vector encodings and the embedding document fields they are stored in
+VECTOR_ENCODING_FIELDS = {
+    'float16': 'embeddingFloat16',
+    'int8': 'embeddingInt8',
+    'binary': 'embeddingBinary'
+}
+
+# Sentinel passed through the pipeline queues to stop stage workers
+_PIPELINE_DONE = object()
+
+# Per-chunk debug lines are logged for one chunk in this many
+CHUNK_LOG_SAMPLE = 100
+
+
+def _server_timestamp(db=None):
+    """Firestore's server-timestamp sentinel, or the one db supplies (the in-memory backend has its own)"""
+    sentinel = getattr(db, 'SERVER_TIMESTAMP', None)
+    if sentinel is not None:
+        return sentinel
+    from google.cloud import firestore
+    return firestore.SERVER_TIMESTAMP
+
+
+def _vector_type(db):
+    """Firestore's Vector class, or the one db supplies, so offline runs don't need the Google SDK"""
+    vector = getattr(db, 'Vector', None)
+    if vector is not None:
+        return vector
+    from google.cloud.firestore_v1.vector import Vector
+    return Vector
+
+
+class StageStats:
+    """Latency histogram, reservoir sample and item counts for one stage"""
+
+    # Histogram bucket upper bounds in seconds (Prometheus `le` labels)
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+    RESERVOIR_SIZE = 1024
+
+    def __init__(self, rng: random.Random):
+        self.rng = rng
+        self.count = 0
+        self.items = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.bucket_counts = [0] * (len(self.BUCKETS) + 1)
+        self.reservoir: List[float] = []
+
+    def observe(self, seconds: float, items: int):
+        self.count += 1
+        self.items += items
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.bucket_counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        # Algorithm R: every observation has an equal chance of being in the sample
+        if len(self.reservoir) < self.RESERVOIR_SIZE:
+            self.reservoir.append(seconds)
+        else:
+            slot = self.rng.randrange(self.count)
+            if slot < self.RESERVOIR_SIZE:
+                self.reservoir[slot] = seconds
+
+    def snapshot(self, wall_seconds: float) -> Dict[str, Any]:
+        ordered = sorted(self.reservoir)
+
+        def percentile(p: float) -> float:
+            return ordered[min(len(ordered) - 1, int(p * len(ordered)))] if ordered else 0.0
+
+        return {
+            'calls': self.count,
+            'items': self.items,
+            'seconds': self.seconds,
+            'share_of_wall': self.seconds / wall_seconds if wall_seconds > 0 else 0.0,
+            'items_per_sec': self.items / wall_seconds if wall_seconds > 0 else 0.0,
+            'items_per_busy_sec': self.items / self.seconds if self.seconds > 0 else 0.0,
+            'p50': percentile(0.50),
+            'p90': percentile(0.90),
+            'p99': percentile(0.99),
+            'max': self.max_seconds,
+            'buckets': dict(zip([*map(str, self.BUCKETS), '+Inf'], itertools.accumulate(self.bucket_counts)))
+        }
+
+
+class RunMetrics:
+    """
+    Per-stage timers (list, download, extract, split, embed, write, plus embed_request and
+    write_batch for single API calls) and sampled queue-depth gauges. Snapshots are written as
+    JSON or as a Prometheus textfile, periodically by a reporter thread and once at the end.
+    Stage seconds are summed over threads, so in pipeline mode they can exceed the wall time.
+    """
+
+    def __init__(self, path: Optional[str] = None, fmt: str = 'json', interval: float = 30.0,
+                 sample_interval: float = 1.0):
+        self.path = path
+        self.fmt = fmt
+        self.interval = interval
+        self.sample_interval = sample_interval
+        self.started_at = time.time()
+        self.lock = threading.Lock()
+        self.rng = random.Random(0)
+        self.stages: Dict[str, StageStats] = {}
+        self.gauges: Dict[str, Any] = {}
+        self.gauge_stats: Dict[str, Dict[str, float]] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def observe(self, stage: str, seconds: float, items: int = 1):
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = StageStats(self.rng)
+            self.stages[stage].observe(seconds, items)
+
+    @contextmanager
+    def timer(self, stage: str, items: int = 1):
+        """Time a block; the yielded dict's 'items' can be set inside the block once known"""
+        record = {'items': items}
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            self.observe(stage, time.perf_counter() - start, record['items'])
+
+    def register_gauge(self, name: str, read_fn):
+        with self.lock:
+            self.gauges[name] = read_fn
+
+    def sample_gauges(self):
+        with self.lock:
+            gauges = list(self.gauges.items())
+        for name, read_fn in gauges:
+            try:
+                value = float(read_fn())
+            except Exception:
+                continue
+            with self.lock:
+                stats = self.gauge_stats.setdefault(name, {'current': 0.0, 'max': 0.0, 'sum': 0.0, 'samples': 0})
+                stats['current'] = value
+                stats['max'] = max(stats['max'], value)
+                stats['sum'] += value
+                stats['samples'] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        wall_seconds = time.time() - self.started_at
+        with self.lock:
+            return {
+                'timestamp': time.time(),
+                'elapsed_seconds': wall_seconds,
+                'stages': {name: stats.snapshot(wall_seconds) for name, stats in self.stages.items()},
+                'queues': {name: {'current': stats['current'], 'max': stats['max'],
+                                  'mean': stats['sum'] / stats['samples'] if stats['samples'] else 0.0}
+                           for name, stats in self.gauge_stats.items()}
+            }
+
+    @staticmethod
+    def to_prometheus(snapshot: Dict[str, Any]) -> str:
+        lines = ['# HELP rag_run_elapsed_seconds Wall time since the run started',
+                 '# TYPE rag_run_elapsed_seconds gauge',
+                 f"rag_run_elapsed_seconds {snapshot['elapsed_seconds']:.6f}",
+                 '# HELP rag_stage_seconds Duration of one stage call',
+                 '# TYPE rag_stage_seconds histogram']
+        for stage, stats in snapshot['stages'].items():
+            for le, count in stats['buckets'].items():
+                lines.append(f'rag_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {count}')
+            lines.append(f'rag_stage_seconds_sum{{stage="{stage}"}} {stats["seconds"]:.6f}')
+            lines.append(f'rag_stage_seconds_count{{stage="{stage}"}} {stats["calls"]}')
+        lines += ['# HELP rag_stage_items_total Items (files, chunks, documents) handled per stage',
+                  '# TYPE rag_stage_items_total counter']
+        lines += [f'rag_stage_items_total{{stage="{stage}"}} {stats["items"]}' for stage, stats in snapshot['stages'].items()]
+        lines += ['# HELP rag_queue_depth Sampled queue depth', '# TYPE rag_queue_depth gauge']
+        lines += [f'rag_queue_depth{{queue="{name}"}} {stats["current"]:g}' for name, stats in snapshot['queues'].items()]
+        lines += ['# HELP rag_queue_depth_max Largest sampled queue depth', '# TYPE rag_queue_depth_max gauge']
+        lines += [f'rag_queue_depth_max{{queue="{name}"}} {stats["max"]:g}' for name, stats in snapshot['queues'].items()]
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def merge(snapshots: List[Dict[str, Any]], wall_seconds: float) -> Dict[str, Any]:
+        """
+        Combine the snapshots of several workers. Counts and histograms are summed; the
+        percentiles are read from the merged histogram, so they are bucket upper bounds.
+        """
+        stages: Dict[str, Dict[str, Any]] = {}
+        for snapshot in snapshots:
+            for name, stage in snapshot['stages'].items():
+                merged = stages.setdefault(name, {'calls': 0, 'items': 0, 'seconds': 0.0, 'max': 0.0, 'buckets': {}})
+                merged['calls'] += stage['calls']
+                merged['items'] += stage['items']
+                merged['seconds'] += stage['seconds']
+                merged['max'] = max(merged['max'], stage['max'])
+                for le, count in stage['buckets'].items():
+                    merged['buckets'][le] = merged['buckets'].get(le, 0) + count
+
+        def percentile(stage: Dict[str, Any], p: float) -> float:
+            for le, count in stage['buckets'].items():
+                if count >= p * stage['calls']:
+                    return stage['max'] if le == '+Inf' else min(float(le), stage['max'])
+            return stage['max']
+
+        for stage in stages.values():
+            stage['share_of_wall'] = stage['seconds'] / wall_seconds if wall_seconds > 0 else 0.0
+            stage['items_per_sec'] = stage['items'] / wall_seconds if wall_seconds > 0 else 0.0
+            stage['items_per_busy_sec'] = stage['items'] / stage['seconds'] if stage['seconds'] > 0 else 0.0
+            stage.update({f'p{int(p * 100)}': percentile(stage, p) for p in (0.50, 0.90, 0.99)})
+        queues: Dict[str, Dict[str, float]] = {}
+        for snapshot in snapshots:
+            for name, depth in snapshot['queues'].items():
+                merged = queues.setdefault(name, {'current': 0.0, 'max': 0.0, 'mean': 0.0})
+                merged['current'] += depth['current']
+                merged['max'] = max(merged['max'], depth['max'])
+                merged['mean'] += depth['mean'] / len(snapshots)
+        return {'timestamp': time.time(), 'elapsed_seconds': wall_seconds, 'stages': stages, 'queues': queues}
+
+    def write(self) -> Dict[str, Any]:
+        """Write a snapshot to the metrics file (atomically, so scrapers never read half a file)"""
+        self.sample_gauges()
+        snapshot = self.snapshot()
+        if self.path:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                if self.fmt == 'prometheus':
+                    f.write(self.to_prometheus(snapshot))
+                else:
+                    json.dump(snapshot, f, indent=2)
+            os.replace(tmp_path, self.path)
+        return snapshot
+
+    def _report(self):
+        next_write = time.time() + self.interval
+        while not self._stop.wait(self.sample_interval):
+            self.sample_gauges()
+            if self.path and self.interval > 0 and time.time() >= next_write:
+                try:
+                    self.write()
+                except OSError as e:
+                    logger.warning(f"⚠️  Failed to write metrics to {self.path}: {e}")
+                next_write = time.time() + self.interval
+
+    def start(self):
+        self._thread = threading.Thread(target=self._report, name='rag-metrics', daemon=True)
+        self._thread.start()
+
+    def close(self) -> Dict[str, Any]:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        return self.write()
+
+
+class PdfPageTimeout(Exception):
+    """Raised inside a PDF worker when a single page takes longer than the page timeout"""
+
+
+def _raise_page_timeout(signum, frame):
+    raise PdfPageTimeout()
+
+
+def _extract_pdf_page_range(pdf_path: str, start: int, end: int, page_timeout: float) -> Tuple[List[str], List[int]]:
+    """
+    Process pool worker: extract pages [start, end) of a PDF on disk.
+    Returns the page texts and the page numbers that were abandoned after page_timeout seconds.
+    """
+    import PyPDF2
+
+    reader = PyPDF2.PdfReader(pdf_path)
+    # Pool workers run tasks on their main thread, so SIGALRM can interrupt a pathological page
+    use_alarm = (page_timeout > 0 and hasattr(signal, 'setitimer')
+                 and threading.current_thread() is threading.main_thread())
+    previous_handler = signal.signal(signal.SIGALRM, _raise_page_timeout) if use_alarm else None
+    texts = []
+    timed_out = []
+    try:
+        for page_number in range(start, end):
+            try:
+                if use_alarm:
+                    signal.setitimer(signal.ITIMER_REAL, page_timeout)
+                page_text = reader.pages[page_number].extract_text()
+            except PdfPageTimeout:
+                page_text = ""
+                timed_out.append(page_number)
+            finally:
+                if use_alarm:
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+            texts.append(page_text)
+    finally:
+        if use_alarm:
+            signal.signal(signal.SIGALRM, previous_handler)
+    return texts, timed_out
+
+
+def iter_pdf_pages(pdf_path: str, executor: ProcessPoolExecutor, page_timeout: float = 30.0,
+                   pages_per_task: int = 8, max_pending_tasks: int = 16) -> Iterator[str]:
+    """
+    Stream the text of each page of a PDF on disk, in page order.
+    Page ranges are extracted in parallel on the process pool; only a bounded window of
+    ranges is in flight so very long PDFs don't buffer all of their text at once.
+    """
+    import PyPDF2
+
+    page_count = len(PyPDF2.PdfReader(pdf_path).pages)
+    starts = iter(range(0, page_count, pages_per_task))
+    pending = deque()
+
+    def submit_next() -> bool:
+        start = next(starts, None)
+        if start is None:
+            return False
+        end = min(start + pages_per_task, page_count)
+        pending.append(executor.submit(_extract_pdf_page_range, pdf_path, start, end, page_timeout))
+        return True
+
+    try:
+        while len(pending) < max_pending_tasks and submit_next():
+            pass
+        while pending:
+            texts, timed_out = pending.popleft().result()
+            submit_next()
+            for page_number in timed_out:
+                logger.warning(f"⚠️  Page {page_number + 1} of {os.path.basename(pdf_path)} exceeded {page_timeout:.0f}s, skipped")
+            yield from texts
+    finally:
+        for future in pending:
+            future.cancel()
+
+def quantize_embeddings(embeddings: np.ndarray, encoding: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Compact encodings of a (n, d) float32 batch, vectorised over the whole batch.
+    Returns the per-row codes and, for int8, the per-vector scale needed to dequantize.
+    """
+    if encoding == 'float16':
+        return embeddings.astype(np.float16), None
+    if encoding == 'int8':
+        # Symmetric scalar quantization: each vector's largest magnitude maps to 127
+        scales = np.abs(embeddings).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.clip(np.rint(embeddings / scales[:, None]), -127, 127).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    if encoding == 'binary':
+        return np.packbits(embeddings > 0, axis=1), None
+    raise ValueError(f"Unknown vector encoding: {encoding}")
+
+
+def dequantize_embeddings(codes: np.ndarray, scales: Optional[np.ndarray], encoding: str, dimensions: int) -> np.ndarray:
+    """Approximate float32 vectors from compact codes (binary decodes to ±1 per dimension)"""
+    if encoding == 'float16':
+        return codes.astype(np.float32)
+    if encoding == 'int8':
+        return codes.astype(np.float32) * scales[:, None]
+    if encoding == 'binary':
+        return np.unpackbits(codes, axis=1, count=dimensions).astype(np.float32) * 2.0 - 1.0
+    raise ValueError(f"Unknown vector encoding: {encoding}")
+
+
+def matryoshka_field(dimensions: int) -> str:
+    """Embedding document field of a truncated vector: embedding256, embedding768, ..."""
+    return f"embedding{dimensions}"
+
+
+def matryoshka_truncations(embeddings: np.ndarray, dimensions: List[int]) -> Dict[int, np.ndarray]:
+    """
+    Unit-length prefixes of a (n, d) float32 batch, one (n, k) array per requested size k < d.
+    gemini-embedding-001 is trained Matryoshka-style, so the leading k dimensions are an embedding
+    in their own right once re-normalized; one cumulative sum of squares gives every prefix norm.
+    """
+    squares = np.cumsum(np.square(embeddings, dtype=np.float32), axis=1)
+    truncations = {}
+    for size in dimensions:
+        norms = np.sqrt(squares[:, size - 1])
+        norms[norms == 0] = 1.0
+        truncations[size] = embeddings[:, :size] / norms[:, None]
+    return truncations
+
+
+def iter_blob_text(blob, window_bytes: int) -> Iterator[str]:
+    """
+    Stream a UTF-8 blob as text windows of roughly window_bytes, using ranged downloads.
+    Multi-byte characters split across ranges are carried over by the incremental decoder.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    size = blob.size or 0
+    for start in range(0, size, window_bytes):
+        end = min(start + window_bytes, size)
+        # Pin the generation so an overwrite mid-stream fails instead of mixing two versions
+        data = blob.download_as_bytes(start=start, end=end - 1, if_generation_match=blob.generation)
+        text = decoder.decode(data, final=end >= size)
+        if text:
+            yield text
+
+
+class SpanTextSplitter:
+    """
+    Produces the same chunks as LangChain's RecursiveCharacterTextSplitter with its defaults
+    (keep_separator=True, strip_whitespace=True, character length), but works on (start, end)
+    offsets into the text instead of substrings. Separators are found with numpy over the code
+    points of the text, and where every chunk would end and the next one start is worked out for
+    all pieces at once, so only one step per chunk runs in Python. Only the final chunks are copied.
+    """
+
+    def __init__(self, chunk_size: int = 1024, chunk_overlap: int = 128, separators: Optional[List[str]] = None):
+        if chunk_size <= 0 or chunk_overlap < 0 or chunk_overlap > chunk_size:
+            raise ValueError(f"Invalid chunk size/overlap: {chunk_size}/{chunk_overlap}")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.separators = separators or ["\n\n", "\n", " ", ""]
+
+    def split_text(self, text: str) -> List[str]:
+        return [text[start:end] for start, end in self.split_spans(text)]
+
+    def split_spans(self, text: str) -> List[Tuple[int, int]]:
+        """Chunks of `text` as (start, end) character offsets, in order"""
+        spans: List[Tuple[int, int]] = []
+        if len(text) < self.chunk_size:
+            # Every piece fits, so the whole text is one chunk
+            stripped = text.strip()
+            if stripped:
+                start = len(text) - len(text.lstrip())
+                spans.append((start, start + len(stripped)))
+            return spans
+        # ASCII text (the common case) is one byte per character, a quarter of the UTF-32 copy
+        codes = (np.frombuffer(text.encode('ascii'), dtype=np.uint8) if text.isascii()
+                 else np.frombuffer(text.encode('utf-32-le', errors='surrogatepass'), dtype=np.uint32))
+        self._split(text, codes, 0, len(text), self.separators, spans)
+        return spans
+
+    @staticmethod
+    def _matches(codes: np.ndarray, separator: str, start: int, end: int) -> np.ndarray:
+        """Non-overlapping occurrences of separator within [start, end), taken left to right as re.split does"""
+        length = len(separator)
+        if end - start < length or max(map(ord, separator)) > np.iinfo(codes.dtype).max:
+            return np.empty(0, dtype=np.int64)
+        found = np.flatnonzero(codes[start:end - length + 1] == ord(separator[0])) + start
+        for offset, char in enumerate(separator[1:], 1):
+            found = found[codes[found + offset] == ord(char)]
+        if length > 1 and len(found) > 1 and (np.diff(found) < length).any():
+            kept = []
+            next_free = start
+            for position in found.tolist():
+                if position >= next_free:
+                    kept.append(position)
+                    next_free = position + length
+            found = np.array(kept, dtype=np.int64)
+        return found
+
+    def _split(self, text: str, codes: np.ndarray, start: int, end: int, separators: List[str],
+               spans: List[Tuple[int, int]]):
+        separator, remaining, found = separators[-1], [], None
+        for index, candidate in enumerate(separators):
+            if not candidate:
+                separator = candidate
+                break
+            found = self._matches(codes, candidate, start, end)
+            if len(found):
+                separator, remaining = candidate, separators[index + 1:]
+                break
+        if not separator:
+            bounds = np.arange(start, end + 1)
+        elif found is None or not len(found):
+            bounds = np.array([start, end])
+        else:
+            # Each separator starts a piece (keep_separator=True); an empty first piece is dropped
+            bounds = np.concatenate((found if found[0] == start else np.concatenate(([start], found)), [end]))
+        lengths = np.diff(bounds)
+        # For every piece at once: the bound at which a chunk starting there stops fitting, and where
+        # the next chunk starts when this piece is the one that did not fit
+        ends = np.searchsorted(bounds, bounds + self.chunk_size, 'right')
+        heads = np.searchsorted(bounds, np.maximum(bounds[:-1] - self.chunk_overlap, bounds[1:] - self.chunk_size), 'left')
+        first = 0
+        for index in np.flatnonzero(lengths >= self.chunk_size).tolist():
+            if index > first:
+                self._merge(text, bounds, ends, heads, first, index, spans)
+            if remaining:
+                self._split(text, codes, bounds.item(index), bounds.item(index + 1), remaining, spans)
+            else:
+                spans.append((bounds.item(index), bounds.item(index + 1)))
+            first = index + 1
+        if first < len(lengths):
+            self._merge(text, bounds, ends, heads, first, len(lengths), spans)
+
+    @staticmethod
+    def _merge(text: str, bounds: np.ndarray, ends: np.ndarray, heads: np.ndarray, first: int, last: int,
+               spans: List[Tuple[int, int]]):
+        """
+        Merge the contiguous pieces [first, last) into chunks like TextSplitter._merge_splits. A chunk
+        from piece `head` ends before the first piece that would take it past chunk_size, and the next
+        chunk starts at the first piece that leaves at most chunk_overlap behind and room for that piece.
+        """
+        head = first
+        while True:
+            over = ends.item(head)
+            start, end = bounds.item(head), bounds.item(over - 1 if over <= last else last)
+            # Strip whitespace like TextSplitter._join_docs, without copying the chunk
+            while start < end and text[start].isspace():
+                start += 1
+            while end > start and text[end - 1].isspace():
+                end -= 1
+            if start < end:
+                spans.append((start, end))
+            if over > last:
+                return
+            head = heads.item(over - 1)
+
+
+def iter_windowed_chunks(windows: Iterator[str], splitter, metrics: Optional[RunMetrics] = None) -> Iterator[str]:
+    """
+    Split a stream of text windows with a SpanTextSplitter or a LangChain text splitter.
+    The last chunk of each window is held back and re-split together with the next window,
+    so chunks and their overlap continue across window boundaries; at most one chunk of text
+    is carried between windows.
+    """
+    span_split = getattr(splitter, 'split_spans', None)
+
+    def split(text: str) -> Tuple[List[str], int]:
+        """Chunks of the text and the offset at which the last one starts"""
+        with (metrics.timer('split') if metrics is not None else nullcontext({})) as timed:
+            if span_split is not None:
+                spans = span_split(text)
+                chunks = [text[start:end] for start, end in spans]
+                tail_start = spans[-1][0] if spans else -1
+            else:
+                chunks = splitter.split_text(text)
+                # LangChain chunks are substrings of the text, so the last one can be located exactly
+                tail_start = text.rfind(chunks[-1]) if chunks else -1
+            timed['items'] = len(chunks)
+        return chunks, tail_start
+
+    carry = ""
+    for window in windows:
+        buffer = carry + window
+        chunks, tail_start = split(buffer)
+        if not chunks:
+            carry = ""
+            continue
+        yield from chunks[:-1]
+        carry = buffer[tail_start:] if tail_start >= 0 else chunks[-1]
+    if carry.strip():
+        yield from split(carry)[0]
+
+
+class WriteEngineError(Exception):
+    """Raised when Firestore writes still fail after all retry attempts"""
+
+
+def _is_retryable_write_error(error: Exception) -> bool:
+    """Contention, quota and availability errors are worth retrying; validation errors are not"""
+    code = getattr(error, 'code', None)
+    name = type(error).__name__
+    return code in (409, 429, 500, 503, 504) or name in (
+        'Aborted', 'DeadlineExceeded', 'InternalServerError', 'ResourceExhausted', 'ServiceUnavailable', 'TooManyRequests'
+    )
+
+
+class FirestoreWriteEngine:
+    """
+    Parallel Firestore committer for upserts and deletes (an equivalent of BulkWriter).
+    Operations from any thread are grouped into batches that commit concurrently on a thread pool,
+    throttled to an ops/sec rate that ramps up following Firestore's 500/50/5 rule, with transient
+    failures retried using jittered exponential backoff. Every operation gets a future so callers
+    can wait for exactly the writes they issued.
+    """
+
+    def __init__(self, db, batch_size: int = 50, max_in_flight: int = 8, initial_ops_per_second: Optional[float] = None,
+                 max_ops_per_second: float = 10_000, max_attempts: int = 5, metrics: Optional[RunMetrics] = None):
+        self.db = db
+        self.metrics = metrics
+        self.batch_size = batch_size
+        if initial_ops_per_second is None:
+            # Backends without Firestore's hot-spotting (RAMP_UP = False) start at the full rate
+            initial_ops_per_second = 500 if getattr(db, 'RAMP_UP', True) else max_ops_per_second
+        self.initial_ops_per_second = initial_ops_per_second
+        self.max_ops_per_second = max_ops_per_second
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._ops: List[Tuple[Tuple, Future]] = []
+        self._pending_batches = set()
+        # Bounds queued + running batches so producers slow down instead of buffering unboundedly
+        self._slots = threading.BoundedSemaphore(max_in_flight * 2)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='rag-write')
+        self._throttle_lock = threading.Lock()
+        self._started_at: Optional[float] = None
+        self._next_slot_at = 0.0
+        self.writes = 0
+        self.deletes = 0
+        self.batches = 0
+        self.retries = 0
+        self.failures = 0
+        self.busy_seconds_start: Optional[float] = None
+        self.last_commit_at: Optional[float] = None
+
+    def set(self, reference, data: Dict[str, Any], merge: bool = False) -> Future:
+        return self._enqueue(('set', reference, data, merge))
+
+    def update(self, reference, data: Dict[str, Any]) -> Future:
+        return self._enqueue(('update', reference, data))
+
+    def delete(self, reference) -> Future:
+        return self._enqueue(('delete', reference))
+
+    def _enqueue(self, op: Tuple) -> Future:
+        future = Future()
+        with self._lock:
+            self._ops.append((op, future))
+            ready = None
+            if len(self._ops) >= self.batch_size:
+                ready, self._ops = self._ops, []
+        if ready:
+            self._submit(ready)
+        return future
+
+    def _submit(self, ops: List[Tuple[Tuple, Future]]):
+        self._slots.acquire()
+        batch_future = self._executor.submit(self._commit, ops)
+        with self._lock:
+            self._pending_batches.add(batch_future)
+        batch_future.add_done_callback(self._batch_done)
+
+    def _batch_done(self, batch_future: Future):
+        with self._lock:
+            self._pending_batches.discard(batch_future)
+        self._slots.release()
+
+    def _current_rate(self, now: float) -> float:
+        """Start at initial_ops_per_second and grow 50% every 5 minutes, up to max_ops_per_second"""
+        if self._started_at is None:
+            self._started_at = now
+        steps = int((now - self._started_at) // 300)
+        return min(self.max_ops_per_second, self.initial_ops_per_second * (1.5 ** steps))
+
+    def _throttle(self, op_count: int):
+        with self._throttle_lock:
+            now = time.monotonic()
+            start_at = max(now, self._next_slot_at)
+            self._next_slot_at = start_at + op_count / self._current_rate(now)
+        if start_at > now:
+            time.sleep(start_at - now)
+
+    def _commit(self, ops: List[Tuple[Tuple, Future]]):
+        for attempt in range(1, self.max_attempts + 1):
+            self._throttle(len(ops))
+            try:
+                batch = self.db.batch()
+                for op, _ in ops:
+                    if op[0] == 'set':
+                        batch.set(op[1], op[2], merge=op[3])
+                    elif op[0] == 'update':
+                        batch.update(op[1], op[2])
+                    else:
+                        batch.delete(op[1])
+                commit_start = time.perf_counter()
+                batch.commit()
+                if self.metrics is not None:
+                    self.metrics.observe('write_batch', time.perf_counter() - commit_start, len(ops))
+                break
+            except Exception as e:
+                if attempt < self.max_attempts and _is_retryable_write_error(e):
+                    delay = random.uniform(0, min(30.0, 0.5 * 2 ** attempt))
+                    logger.warning(f"⚠️  Firestore batch of {len(ops)} writes failed ({e}), retrying in {delay:.1f}s")
+                    with self._lock:
+                        self.retries += 1
+                    time.sleep(delay)
+                    continue
+                logger.error(f"❌ Firestore batch of {len(ops)} writes failed after {attempt} attempts: {e}")
+                with self._lock:
+                    self.failures += len(ops)
+                error = WriteEngineError(f"Firestore batch failed after {attempt} attempts: {e}")
+                for _, future in ops:
+                    future.set_exception(error)
+                return
+        with self._lock:
+            now = time.time()
+            if self.busy_seconds_start is None:
+                self.busy_seconds_start = now
+            self.last_commit_at = now
+            self.batches += 1
+            self.deletes += sum(1 for op, _ in ops if op[0] == 'delete')
+            self.writes += sum(1 for op, _ in ops if op[0] != 'delete')
+        for _, future in ops:
+            future.set_result(None)
+
+    def _submit_partial(self):
+        with self._lock:
+            ready, self._ops = self._ops, []
+        if ready:
+            self._submit(ready)
+
+    def wait(self, futures: List[Future]):
+        """Commit any partial batch and block until the given operations are done, raising on failure"""
+        self._submit_partial()
+        for future in futures:
+            future.result()
+
+    def flush(self):
+        """Commit everything queued so far and wait for all in-flight batches"""
+        self._submit_partial()
+        while True:
+            with self._lock:
+                pending = list(self._pending_batches)
+            if not pending:
+                return
+            for batch_future in pending:
+                batch_future.result()
+
+    def delete_collection(self, collection_ref, page_size: int = 500) -> int:
+        """Delete every document in a collection, paging through references so the collection is never held in memory"""
+        deleted = 0
+        futures = []
+        for doc_ref in collection_ref.list_documents(page_size=page_size):
+            futures.append(self.delete(doc_ref))
+            deleted += 1
+            if len(futures) >= page_size:
+                self.wait(futures)
+                futures = []
+            if deleted % 10_000 == 0:
+                logger.info(f"   🗑️  {deleted:,} documents deleted so far...")
+        self.wait(futures)
+        return deleted
+
+    def pending_batches(self) -> int:
+        """Batches submitted and not yet committed"""
+        with self._lock:
+            return len(self._pending_batches)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            elapsed = (self.last_commit_at - self.busy_seconds_start) if self.busy_seconds_start and self.last_commit_at else 0.0
+            return {
+                'writes': self.writes,
+                'deletes': self.deletes,
+                'batches': self.batches,
+                'retries': self.retries,
+                'failures': self.failures,
+                'ops_per_sec': (self.writes + self.deletes) / elapsed if elapsed > 0 else 0.0
+            }
+
+    def close(self):
+        self.flush()
+        self._executor.shutdown(wait=True)
+
+
+class SQLiteManifest:
+    """Incremental ingest manifest kept in a local SQLite file, one row per blob"""
+
+    def __init__(self, path: str):
+        self.path = path
+        # Read by the pipeline feeder and written by the collector; --shard workers each get their own file
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS manifest ('
+            ' name TEXT PRIMARY KEY, generation TEXT, md5_hash TEXT, crc32c TEXT,'
+            ' dimensions INTEGER, source_id TEXT, chunk_ids TEXT, updated_at REAL, text_layout TEXT)'
+        )
+        # Manifests written before text layouts were recorded get the column, NULL (unknown) for existing rows
+        if 'text_layout' not in {row[1] for row in self.conn.execute('PRAGMA table_info(manifest)')}:
+            self.conn.execute('ALTER TABLE manifest ADD COLUMN text_layout TEXT')
+        self.conn.commit()
+
+    def get(self, name: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT name, generation, md5_hash, crc32c, dimensions, source_id, chunk_ids, text_layout FROM manifest WHERE name = ?',
+                (name,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            'name': row[0], 'generation': row[1], 'md5_hash': row[2], 'crc32c': row[3],
+            'dimensions': row[4], 'source_id': row[5], 'chunk_ids': json.loads(row[6] or '[]'),
+            'text_layout': json.loads(row[7]) if row[7] is not None else None
+        }
+
+    def put(self, entry: Dict[str, Any]):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO manifest (name, generation, md5_hash, crc32c, dimensions, source_id, chunk_ids,'
+                ' updated_at, text_layout) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (entry['name'], entry['generation'], entry['md5_hash'], entry['crc32c'], entry['dimensions'],
+                 entry['source_id'], json.dumps(entry['chunk_ids']), time.time(), json.dumps(entry['text_layout']))
+            )
+            self.conn.commit()
+
+    def delete(self, name: str):
+        with self.lock:
+            self.conn.execute('DELETE FROM manifest WHERE name = ?', (name,))
+            self.conn.commit()
+
+    def names(self, prefix: str = '') -> List[str]:
+        # substr instead of LIKE so '%' and '_' in object names aren't treated as wildcards, and instead of
+        # an upper bound character, which any name with a higher character after the prefix would sort past
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT name FROM manifest WHERE name >= ? AND substr(name, 1, ?) = ?', (prefix, len(prefix), prefix)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute('DELETE FROM manifest')
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class FirestoreManifest:
+    """Incremental ingest manifest kept in Firestore, one document per blob in the manifest collection"""
+
+    def __init__(self, db, collection_name: str = 'ingest_manifest'):
+        self.db = db
+        self.collection_name = collection_name
+
+    def _doc_ref(self, name: str):
+        # Object names contain '/', which Firestore document IDs cannot
+        return self.db.collection(self.collection_name).document(hashlib.sha1(name.encode('utf-8')).hexdigest())
+
+    def get(self, name: str) -> Optional[Dict[str, Any]]:
+        snapshot = self._doc_ref(name).get()
+        if not snapshot.exists:
+            return None
+        data = snapshot.to_dict()
+        return {
+            'name': data['name'], 'generation': data.get('generation'), 'md5_hash': data.get('md5Hash'),
+            'crc32c': data.get('crc32c'), 'dimensions': data.get('dimensions'),
+            'source_id': data.get('sourceId'), 'chunk_ids': data.get('chunkIds', []),
+            'text_layout': data.get('textLayout')
+        }
+
+    def put(self, entry: Dict[str, Any]):
+        self._doc_ref(entry['name']).set({
+            'name': entry['name'],
+            'generation': entry['generation'],
+            'md5Hash': entry['md5_hash'],
+            'crc32c': entry['crc32c'],
+            'dimensions': entry['dimensions'],
+            'sourceId': entry['source_id'],
+            'chunkIds': entry['chunk_ids'],
+            'textLayout': entry['text_layout'],
+            'updatedAt': _server_timestamp(self.db)
+        })
+
+    def delete(self, name: str):
+        self._doc_ref(name).delete()
+
+    def names(self, prefix: str = '') -> List[str]:
+        query = self.db.collection(self.collection_name)
+        if prefix:
+            # Strings sort by UTF-8 bytes, and U+10FFFF is the highest code point, so every name under the prefix sorts below this
+            query = query.where('name', '>=', prefix).where('name', '<', prefix + '\U0010ffff')
+        return [snapshot.to_dict()['name'] for snapshot in query.stream()]
+
+    def clear(self):
+        collection_ref = self.db.collection(self.collection_name)
+        batch = self.db.batch()
+        pending = 0
+        for doc_ref in collection_ref.list_documents(page_size=500):
+            batch.delete(doc_ref)
+            pending += 1
+            if pending == 500:
+                batch.commit()
+                batch = self.db.batch()
+                pending = 0
+        if pending:
+            batch.commit()
+
+    def close(self):
+        pass
+
+
+def utf8_boundary(data: bytes, position: int) -> int:
+    """
+    The nearest UTF-8 codepoint boundary at or before `position`. A codepoint is at most 4 bytes,
+    so this steps back over at most 3 continuation bytes (0b10xxxxxx) and never decodes anything.
+    """
+    position = max(0, min(position, len(data)))
+    while 0 < position < len(data) and data[position] & 0xC0 == 0x80:
+        position -= 1
+    return position
+
+
+def utf8_part_offsets(data: bytes, max_bytes: int) -> List[int]:
+    """Start offsets of consecutive parts of at most max_bytes each, every one beginning on a codepoint boundary"""
+    offsets = [0]
+    while len(data) - offsets[-1] > max_bytes:
+        offsets.append(utf8_boundary(data, offsets[-1] + max_bytes))
+    return offsets
+
+
+class SourceTextStore:
+    """
+    Full text of source documents. Text up to INLINE_BYTES stays in the source document's `text`
+    field. Longer text is cut at codepoint boundaries into parts of at most part_bytes, stored
+    either in the sources/{id}/parts subcollection ('parts', written in parallel) or as gzip shards
+    under a GCS URI ('gcs'). The source document records textStorage, textBytes, partCount and
+    partOffsets (the byte offset each part starts at), so read() fetches only the parts a byte
+    range overlaps.
+    """
+
+    # Firestore caps a document at 1 MiB; the margin leaves room for the other source fields
+    INLINE_BYTES = 1_000_000
+    # ... and a commit request at 10 MiB, so only a few near-1 MiB parts fit in one batch
+    MAX_BATCH_BYTES = 9 * 1024 * 1024
+
+    def __init__(self, db, backend: str = 'parts', part_bytes: int = 900 * 1024, uri: Optional[str] = None,
+                 storage_client=None, max_in_flight: int = 8, metrics: Optional[RunMetrics] = None):
+        if backend == 'gcs' and not (uri and uri.startswith('gs://')):
+            raise ValueError("The gcs source text backend needs a gs://bucket/prefix URI")
+        self.db = db
+        self.backend = backend
+        self.part_bytes = part_bytes
+        self.uri = uri.rstrip('/') if uri else None
+        self.storage_client = storage_client
+        self.max_in_flight = max_in_flight
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self._engine: Optional[FirestoreWriteEngine] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.parted_documents = 0
+        self.parts_written = 0
+        self.bytes_stored = 0
+
+    def _parts_engine(self) -> FirestoreWriteEngine:
+        with self._lock:
+            if self._engine is None:
+                self._engine = FirestoreWriteEngine(self.db, batch_size=max(1, self.MAX_BATCH_BYTES // self.part_bytes),
+                                                    max_in_flight=self.max_in_flight, metrics=self.metrics)
+            return self._engine
+
+    def _pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix='rag-source-text')
+            return self._executor
+
+    @staticmethod
+    def _part_id(index: int) -> str:
+        return f"{index:05d}"
+
+    def _shard_blob(self, text_uri: str, index: int):
+        bucket_name, _, prefix = text_uri[len('gs://'):].partition('/')
+        return self.storage_client.bucket(bucket_name).blob(f"{prefix}/part-{index:05d}.txt.gz")
+
+    def write(self, source_ref, text: str, previous_fields: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Store the text of a source document and return the fields to set on it. Parts are
+        committed before this returns, so the source document never points at missing parts.
+        previous_fields (the document's fields before this write, if it existed) locate the parts
+        of the previous version that the new one does not overwrite.
+        """
+        writer = SourceTextWriter(self, source_ref, previous_fields)
+        writer.write(text.encode('utf-8'))
+        return writer.close()
+
+    def _put_part(self, source_ref, text_uri: Optional[str], index: int, start: int, data: bytes) -> Future:
+        """Start storing one part; the future's result is the number of bytes stored"""
+        if self.backend == 'gcs':
+            return self._pool().submit(self._upload_shard, text_uri, index, data)
+        stored = Future()
+        write = self._parts_engine().set(source_ref.collection('parts').document(self._part_id(index)),
+                                         {'index': index, 'byteOffset': start, 'text': data.decode('utf-8')})
+        write.add_done_callback(lambda done: stored.set_exception(done.exception()) if done.exception() else stored.set_result(len(data)))
+        return stored
+
+    def _count_parted(self, parts: int, stored: int):
+        with self._lock:
+            self.parted_documents += 1
+            self.parts_written += parts
+            self.bytes_stored += stored
+
+    @staticmethod
+    def layout(fields: Dict[str, Any]) -> Dict[str, Any]:
+        """The fields that locate a source document's parts or shards ({} for inline text), as kept in the manifest"""
+        if fields.get('textStorage') not in ('parts', 'gcs'):
+            return {}
+        return {key: fields[key] for key in ('textStorage', 'textUri', 'partCount') if key in fields}
+
+    def _replace_previous(self, source_ref, previous_fields: Optional[Dict[str, Any]], fields: Dict[str, Any]):
+        """Remove the parts of the previous version that the new one did not overwrite"""
+        if previous_fields:
+            same_place = (previous_fields.get('textStorage') == fields['textStorage']
+                          and previous_fields.get('textUri') == fields.get('textUri'))
+            self._remove_parts(source_ref, previous_fields, keep=fields.get('partCount', 0) if same_place else 0)
+
+    def _upload_shard(self, text_uri: str, index: int, data: bytes) -> int:
+        compressed = gzip.compress(data, compresslevel=6)
+        self._shard_blob(text_uri, index).upload_from_string(compressed, content_type='application/gzip')
+        return len(compressed)
+
+    def read(self, source_ref, start: int = 0, end: Optional[int] = None) -> str:
+        """
+        Text of a source document, or the UTF-8 byte range [start, end) of it with both ends moved
+        back to codepoint boundaries. Only the parts overlapping the range are fetched.
+        """
+        snapshot = source_ref.get()
+        if not snapshot.exists:
+            raise KeyError(f"No source document {source_ref.id}")
+        fields = snapshot.to_dict()
+        if fields.get('textStorage') in ('parts', 'gcs'):
+            offsets = fields['partOffsets']
+            end = fields['textBytes'] if end is None else min(end, fields['textBytes'])
+            if start >= end:
+                return ''
+            first = bisect.bisect_right(offsets, start) - 1
+            last = bisect.bisect_left(offsets, end) - 1
+            parts_ref = source_ref.collection('parts')
+
+            def read_part(index: int) -> bytes:
+                if fields['textStorage'] == 'gcs':
+                    return gzip.decompress(self._shard_blob(fields['textUri'], index).download_as_bytes())
+                return parts_ref.document(self._part_id(index)).get().to_dict()['text'].encode('utf-8')
+
+            data = b''.join(self._pool().map(read_part, range(first, last + 1)))
+            base = offsets[first]
+        else:
+            # Inline text, or the text1..textN fields written before parts existed
+            text = fields.get('text')
+            if text is None:
+                text = ''.join(itertools.takewhile(lambda part: part is not None,
+                                                   (fields.get(f'text{index}') for index in itertools.count(1))))
+            if start == 0 and end is None:
+                return text
+            data = text.encode('utf-8')
+            base = 0
+            end = len(data) if end is None else min(end, len(data))
+        return data[utf8_boundary(data, start - base):utf8_boundary(data, end - base)].decode('utf-8')
+
+    def delete(self, source_ref, fields: Optional[Dict[str, Any]] = None):
+        """Remove the parts or shards of a source document (deleting the document itself is up to the caller)"""
+        if fields is None:
+            snapshot = source_ref.get()
+            fields = snapshot.to_dict() if snapshot.exists else None
+        if fields:
+            self._remove_parts(source_ref, fields, keep=0)
+
+    def _remove_parts(self, source_ref, fields: Dict[str, Any], keep: int):
+        indices = range(keep, fields.get('partCount') or 0)
+        if not indices:
+            return
+        if fields.get('textStorage') == 'parts':
+            parts_ref = source_ref.collection('parts')
+            engine = self._parts_engine()
+            engine.wait([engine.delete(parts_ref.document(self._part_id(index))) for index in indices])
+        elif fields.get('textStorage') == 'gcs':
+            def delete_shard(index: int):
+                try:
+                    self._shard_blob(fields['textUri'], index).delete()
+                except Exception as e:
+                    if getattr(e, 'code', None) != 404 and type(e).__name__ != 'NotFound':
+                        raise
+            list(self._pool().map(delete_shard, indices))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'backend': self.backend,
+                'parted_documents': self.parted_documents,
+                'parts_written': self.parts_written,
+                'bytes_stored': self.bytes_stored
+            }
+
+    def close(self):
+        if self._engine is not None:
+            self._engine.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+
+class SourceTextWriter:
+    """
+    Stores source text that arrives in pieces (the windows of a streamed file) the way
+    SourceTextStore.write stores a whole text: parts are cut at the same codepoint boundaries and
+    written as soon as they fill, with at most max_in_flight of them buffered. close() waits for
+    them and returns the fields to set on the source document.
+    """
+
+    def __init__(self, store: SourceTextStore, source_ref, previous_fields: Optional[Dict[str, Any]] = None):
+        self.store = store
+        self.source_ref = source_ref
+        self.previous_fields = previous_fields
+        self.text_uri = f"{store.uri}/{source_ref.id}" if store.backend == 'gcs' else None
+        self.buffer = bytearray()
+        self.offsets: List[int] = []
+        self.total_bytes = 0
+        self.pending: deque = deque()
+        self.stored = 0
+
+    def append(self, text: str):
+        self.write(text.encode('utf-8'))
+
+    def write(self, data: bytes):
+        self.buffer += data
+        # Same cut as utf8_part_offsets: a part is only closed once more than part_bytes are waiting
+        while len(self.buffer) > self.store.part_bytes:
+            cut = utf8_boundary(self.buffer, self.store.part_bytes)
+            self._put(bytes(self.buffer[:cut]))
+            del self.buffer[:cut]
+
+    def _put(self, data: bytes):
+        start = self.total_bytes
+        self.pending.append(self.store._put_part(self.source_ref, self.text_uri, len(self.offsets), start, data))
+        self.offsets.append(start)
+        self.total_bytes += len(data)
+        if len(self.pending) > self.store.max_in_flight:
+            self._settle(keep=self.store.max_in_flight)
+
+    def _settle(self, keep: int = 0):
+        if self.store.backend == 'parts':
+            # The oldest parts may still sit in a partial batch
+            self.store._parts_engine().wait([])
+        while len(self.pending) > keep:
+            self.stored += self.pending.popleft().result()
+
+    def close(self) -> Dict[str, Any]:
+        if not self.offsets and len(self.buffer) <= self.store.INLINE_BYTES:
+            fields = {'text': self.buffer.decode('utf-8'), 'textStorage': 'inline', 'textBytes': len(self.buffer)}
+        else:
+            if self.buffer:
+                self._put(bytes(self.buffer))
+                self.buffer.clear()
+            self._settle()
+            fields = {'textStorage': self.store.backend, 'textBytes': self.total_bytes,
+                      'partCount': len(self.offsets), 'partOffsets': self.offsets}
+            if self.text_uri:
+                fields['textUri'] = self.text_uri
+            self.store._count_parted(len(self.offsets), self.stored)
+        self.store._replace_previous(self.source_ref, self.previous_fields, fields)
+        return fields
+
+
+class RunCheckpoint:
+    """
+    Append-only JSON-lines record of the files (and, for streamed files, the chunk batches)
+    that a run has finished, so --resume can continue an interrupted run. Entries are keyed
+    on object name and generation, so a file that changed since the checkpoint is redone.
+    A batch entry lists the chunk indices it wrote and its duplicate pointers, since chunks
+    left out as duplicates were never written.
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self.completed: Dict[str, str] = {}
+        # name -> {'generation', 'chunks_done', 'written': chunk indices, 'duplicates': {chunk index: canonical ID}}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+        if resume and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A crash can leave a partially written last line
+                        continue
+                    if record['event'] == 'file':
+                        self.completed[record['name']] = record['generation']
+                    elif record['event'] == 'batch':
+                        self._add_batch(record)
+        self.file = open(path, 'a' if resume else 'w', encoding='utf-8')
+
+    @staticmethod
+    def _generation(blob) -> str:
+        return str(blob.generation) if blob.generation is not None else ''
+
+    def is_complete(self, blob) -> bool:
+        return self.completed.get(blob.name) == self._generation(blob)
+
+    def _add_batch(self, record: Dict[str, Any]):
+        state = self.batches.get(record['name'])
+        if state is None or state['generation'] != record['generation']:
+            state = self.batches[record['name']] = {'generation': record['generation'], 'chunks_done': 0, 'written': [], 'duplicates': {}}
+        state['chunks_done'] = record['chunks_done']
+        state['written'].extend(record['written'])
+        state['duplicates'].update(record['duplicates'])
+
+    def resume_state(self, blob) -> Tuple[int, List[int], Dict[str, str]]:
+        """Chunks of a streamed file done by the interrupted run, the indices it wrote, and its duplicate pointers"""
+        state = self.batches.get(blob.name)
+        if state is None or state['generation'] != self._generation(blob):
+            return 0, [], {}
+        return state['chunks_done'], list(state['written']), dict(state['duplicates'])
+
+    def record_file(self, blob, status: str, chunks: int):
+        self._append({'event': 'file', 'name': blob.name, 'generation': self._generation(blob), 'status': status, 'chunks': chunks})
+
+    def record_batch(self, blob, chunks_done: int, written: List[int], duplicates: Dict[str, str]):
+        self._append({'event': 'batch', 'name': blob.name, 'generation': self._generation(blob), 'chunks_done': chunks_done,
+                      'written': written, 'duplicates': duplicates})
+
+    def _append(self, record: Dict[str, Any]):
+        with self.lock:
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def train_ivf_centroids(sample: np.ndarray, lists: int, iterations: int = 20, seed: int = 0) -> np.ndarray:
+    """Spherical k-means over unit vectors; empty lists are re-seeded from random sample points"""
+    rng = np.random.default_rng(seed)
+    lists = min(lists, len(sample))
+    centroids = sample[rng.choice(len(sample), lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=lists)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        sums = np.zeros_like(centroids)
+        filled = counts > 0
+        sums[filled] = np.add.reduceat(sample[order], starts[filled], axis=0)
+        empty = np.flatnonzero(~filled)
+        sums[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+        centroids = _normalize_rows(sums).astype(np.float32)
+    return centroids
+
+
+def _truncate_spool_lines(path: str, max_lines: Optional[int] = None) -> int:
+    """Cut a line-per-entry spool back to its complete lines (at most max_lines); returns the line count"""
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'rb') as f:
+        line_ends = np.flatnonzero(np.frombuffer(f.read(), dtype=np.uint8) == ord('\n')) + 1
+    if max_lines is not None:
+        line_ends = line_ends[:max_lines]
+    with open(path, 'r+b') as f:
+        f.truncate(int(line_ends[-1]) if len(line_ends) else 0)
+    return len(line_ends)
+
+
+def _reconcile_vector_spool(vectors_path: str, lines_path: str, dimensions: int) -> int:
+    """
+    Cut a float32 vector spool and its line-per-row spool back to the rows both hold in full. A crash
+    between (or during) the two writes leaves extra vectors or a partial line, and rows appended after
+    them would no longer line up with their vectors. Returns the row count.
+    """
+    row_bytes = 4 * dimensions
+    vector_rows = os.path.getsize(vectors_path) // row_bytes if os.path.exists(vectors_path) else 0
+    count = _truncate_spool_lines(lines_path, vector_rows)
+    if os.path.exists(vectors_path):
+        with open(vectors_path, 'r+b') as f:
+            f.truncate(count * row_bytes)
+    return count
+
+
+class AnnIndexWriter:
+    """
+    Builds a local IVF-flat index (cosine similarity) from the vectors a run writes.
+
+    Vectors and chunk IDs are appended to pending spool files as batches are committed, and
+    removed chunk IDs to a removal log, so an interrupted run keeps them for --resume. build()
+    clusters everything into `lists` inverted lists and writes, atomically:
+    vectors.npy (grouped by list, memory-mappable), chunk_ids.json (side table, same order),
+    centroids.npy, offsets.npy (list boundaries into vectors.npy) and index.json.
+    """
+
+    def __init__(self, path: str, dimensions: int, lists: Optional[int] = None, merge_existing: bool = False):
+        self.path = path
+        self.dimensions = dimensions
+        self.lists = lists
+        self.merge_existing = merge_existing
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        # When updating, vectors spooled by an interrupted run are still live documents
+        mode = 'ab' if merge_existing else 'wb'
+        if merge_existing:
+            _reconcile_vector_spool(os.path.join(path, 'pending_vectors.f32'), os.path.join(path, 'pending_ids.txt'), dimensions)
+            _truncate_spool_lines(os.path.join(path, 'pending_removed.txt'))
+        self.vectors_file = open(os.path.join(path, 'pending_vectors.f32'), mode)
+        self.ids_file = open(os.path.join(path, 'pending_ids.txt'), mode)
+        self.removed_file = open(os.path.join(path, 'pending_removed.txt'), mode)
+
+    def add(self, chunk_ids: List[str], vectors: np.ndarray):
+        """Spool committed vectors; the vector bytes go first so a crash never leaves IDs without vectors"""
+        data = _normalize_rows(np.asarray(vectors, dtype=np.float32)).tobytes()
+        with self.lock:
+            self.vectors_file.write(data)
+            self.vectors_file.flush()
+            self.ids_file.write(''.join(f"{chunk_id}\n" for chunk_id in chunk_ids).encode('utf-8'))
+            self.ids_file.flush()
+
+    def remove(self, chunk_ids: List[str]):
+        with self.lock:
+            self.removed_file.write(''.join(f"{chunk_id}\n" for chunk_id in chunk_ids).encode('utf-8'))
+            self.removed_file.flush()
+
+    def reset(self):
+        """Forget the existing index and anything spooled so far (their documents were cleared)"""
+        with self.lock:
+            self.merge_existing = False
+            for spool in (self.vectors_file, self.ids_file, self.removed_file):
+                spool.seek(0)
+                spool.truncate()
+
+    def _read_lines(self, name: str) -> List[str]:
+        with open(os.path.join(self.path, name), encoding='utf-8') as f:
+            lines = f.read().split('\n')
+        # The last line is either empty or cut short by a crash
+        return lines[:-1]
+
+    def _collect(self) -> Tuple[List[Tuple[np.ndarray, int]], List[str]]:
+        """(source array, row) for every live vector, and its chunk ID; later writes of an ID win"""
+        removed = set(self._read_lines('pending_removed.txt'))
+        pending_ids = self._read_lines('pending_ids.txt')
+        pending_bytes = os.path.getsize(os.path.join(self.path, 'pending_vectors.f32'))
+        pending_count = min(len(pending_ids), pending_bytes // (4 * self.dimensions))
+        pending = np.memmap(os.path.join(self.path, 'pending_vectors.f32'), dtype=np.float32, mode='r',
+                            shape=(pending_count, self.dimensions)) if pending_count else np.empty((0, self.dimensions), np.float32)
+        live: Dict[str, Tuple[np.ndarray, int]] = {}
+        if self.merge_existing and os.path.exists(os.path.join(self.path, 'index.json')):
+            existing = IvfFlatIndex(self.path)
+            if existing.dimensions == self.dimensions:
+                for row, chunk_id in enumerate(existing.chunk_ids):
+                    if chunk_id not in removed:
+                        live[chunk_id] = (existing.vectors, row)
+            else:
+                logger.warning(f"⚠️  Existing ANN index has {existing.dimensions} dimensions; rebuilding from this run only")
+        for row, chunk_id in enumerate(pending_ids[:pending_count]):
+            live.pop(chunk_id, None)
+            live[chunk_id] = (pending, row)
+        # Removals logged after a chunk was (re)written still apply, e.g. stale chunks of a changed file
+        for chunk_id in removed:
+            live.pop(chunk_id, None)
+        return list(live.values()), list(live.keys())
+
+    @staticmethod
+    def _gather(rows: List[Tuple[np.ndarray, int]]) -> np.ndarray:
+        return np.stack([source[row] for source, row in rows]) if rows else np.empty((0, 0), np.float32)
+
+    def build(self, iterations: int = 20, seed: int = 0, block_size: int = 65_536) -> Dict[str, Any]:
+        """Cluster all live vectors and atomically replace the index files"""
+        with self.lock:
+            self.vectors_file.flush()
+            self.ids_file.flush()
+            self.removed_file.flush()
+            rows, chunk_ids = self._collect()
+            count = len(rows)
+            lists = max(1, min(self.lists or int(np.sqrt(count)), count))
+            stats = {'vectors': count, 'lists': lists if count else 0, 'path': self.path}
+            if not count:
+                return stats
+
+            rng = np.random.default_rng(seed)
+            # 256 points per list is plenty to place the centroids
+            sample_rows = rng.choice(count, min(count, lists * 256), replace=False)
+            centroids = train_ivf_centroids(self._gather([rows[i] for i in sample_rows]), lists, iterations, seed)
+            assignments = np.empty(count, dtype=np.int64)
+            for start in range(0, count, block_size):
+                block = self._gather(rows[start:start + block_size])
+                assignments[start:start + block_size] = np.argmax(block @ centroids.T, axis=1)
+            order = np.argsort(assignments, kind='stable')
+            offsets = np.concatenate(([0], np.cumsum(np.bincount(assignments, minlength=len(centroids))))).astype(np.int64)
+
+            def tmp(name: str) -> str:
+                return os.path.join(self.path, f".tmp.{name}")
+
+            vectors_out = np.lib.format.open_memmap(tmp('vectors.npy'), mode='w+', dtype=np.float32,
+                                                    shape=(count, self.dimensions))
+            for start in range(0, count, block_size):
+                vectors_out[start:start + block_size] = self._gather([rows[i] for i in order[start:start + block_size]])
+            vectors_out.flush()
+            del vectors_out
+            np.save(tmp('centroids.npy'), centroids)
+            np.save(tmp('offsets.npy'), offsets)
+            with open(tmp('chunk_ids.json'), 'w', encoding='utf-8') as f:
+                json.dump([chunk_ids[i] for i in order], f)
+            with open(tmp('index.json'), 'w', encoding='utf-8') as f:
+                json.dump({'type': 'ivf-flat', 'metric': 'cosine', 'model': EMBEDDING_MODEL,
+                           'dimensions': self.dimensions, 'vectors': count, 'lists': len(centroids)}, f)
+            del rows
+            # index.json last: a reader never sees metadata for files that are not in place yet
+            for name in ('vectors.npy', 'centroids.npy', 'offsets.npy', 'chunk_ids.json', 'index.json'):
+                os.replace(tmp(name), os.path.join(self.path, name))
+
+            # The spool is now part of the index; later builds in this process start from it
+            self.merge_existing = True
+            for spool in (self.vectors_file, self.ids_file, self.removed_file):
+                spool.seek(0)
+                spool.truncate()
+            stats['lists'] = len(centroids)
+            return stats
+
+    def close(self):
+        with self.lock:
+            for spool in (self.vectors_file, self.ids_file, self.removed_file):
+                spool.close()
+
+
+class IvfFlatIndex:
+    """Read side of an index built by AnnIndexWriter; vectors are memory-mapped, not loaded"""
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, 'index.json'), encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.dimensions = self.meta['dimensions']
+        self.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+        self.centroids = np.load(os.path.join(path, 'centroids.npy'))
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        with open(os.path.join(path, 'chunk_ids.json'), encoding='utf-8') as f:
+            self.chunk_ids: List[str] = json.load(f)
+
+    def __len__(self) -> int:
+        return len(self.chunk_ids)
+
+    def search(self, query: np.ndarray, k: int = 10, n_probe: int = 8) -> List[Tuple[str, float]]:
+        """Top-k (chunk ID, cosine similarity) pairs, scanning the n_probe lists nearest the query"""
+        query = np.asarray(query, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        n_probe = min(n_probe, len(self.centroids))
+        probes = np.argpartition(-(self.centroids @ query), n_probe - 1)[:n_probe]
+        rows = np.concatenate([np.arange(self.offsets[p], self.offsets[p + 1]) for p in probes])
+        if not len(rows):
+            return []
+        scores = self.vectors[rows] @ query
+        k = min(k, len(rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.chunk_ids[rows[i]], float(scores[i])) for i in top]
+
+
+# Metadata columns of an exported embedding row, in column order
+EXPORT_METADATA_FIELDS = ('chunkId', 'sourceId', 'fileName', 'chunkIndex', 'totalChunks', 'text')
+
+
+def _export_arrow_schema(dimensions: int):
+    import pyarrow as pa
+
+    return pa.schema([('chunkId', pa.string()), ('sourceId', pa.string()), ('fileName', pa.string()),
+                      ('chunkIndex', pa.int64()), ('totalChunks', pa.int64()), ('text', pa.string()),
+                      ('embedding', pa.list_(pa.float32(), dimensions))])
+
+
+class EmbeddingExportWriter:
+    """
+    Exports committed embeddings and their chunk metadata to local columnar shards, so they can be
+    bulk-imported into Firestore later (also at fewer dimensions or another encoding) without
+    calling the embedding API again.
+
+    Rows are appended to pending spool files as batches are committed, like AnnIndexWriter, so an
+    interrupted run keeps them for --resume; once `shard_rows` rows are spooled (and at the end of
+    a run) the spool is sealed into one shard in the chosen format:
+    npy - part-NNNNN.npy (float32, as embedded, memory-mappable) and part-NNNNN.jsonl (metadata, same order)
+    parquet - part-NNNNN.parquet with the metadata columns and a fixed-size list `embedding` column
+    Chunk IDs removed up to a shard go to part-NNNNN.removed.json. manifest.json lists the shards
+    in write order and is replaced after their files are in place; later rows of a chunk ID win.
+    """
+
+    def __init__(self, path: str, dimensions: int, fmt: str = 'npy', shard_rows: int = 10_000,
+                 merge_existing: bool = False):
+        self.path = path
+        self.dimensions = dimensions
+        self.fmt = fmt
+        self.shard_rows = shard_rows
+        self.lock = threading.Lock()
+        self.rows_written = 0
+        self.shards_written = 0
+        self.bytes_written = 0
+        os.makedirs(path, exist_ok=True)
+        self.manifest = {'type': 'embedding-export', 'model': EMBEDDING_MODEL, 'dimensions': dimensions, 'shards': []}
+        # Shards of a previous export that this run replaces; their files go once the new manifest is written
+        self._superseded: List[Dict[str, Any]] = []
+        existing = self._read_manifest()
+        if existing is not None:
+            if merge_existing and existing['dimensions'] == dimensions:
+                self.manifest = existing
+            else:
+                if merge_existing:
+                    logger.warning(f"⚠️  Existing export has {existing['dimensions']} dimensions; replacing it with this run's vectors")
+                self._superseded = existing['shards']
+        # When updating, rows spooled by an interrupted run are still live documents
+        mode = 'ab' if merge_existing else 'wb'
+        self.pending_rows = 0
+        if merge_existing:
+            self.pending_rows = _reconcile_vector_spool(os.path.join(path, 'pending_vectors.f32'),
+                                                        os.path.join(path, 'pending_rows.jsonl'), dimensions)
+            _truncate_spool_lines(os.path.join(path, 'pending_removed.txt'))
+        self.vectors_file = open(os.path.join(path, 'pending_vectors.f32'), mode)
+        self.rows_file = open(os.path.join(path, 'pending_rows.jsonl'), mode)
+        self.removed_file = open(os.path.join(path, 'pending_removed.txt'), mode)
+
+    def _read_manifest(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(os.path.join(self.path, 'manifest.json'), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _read_lines(self, name: str) -> List[str]:
+        with open(os.path.join(self.path, name), encoding='utf-8') as f:
+            lines = f.read().split('\n')
+        # The last line is either empty or cut short by a crash
+        return lines[:-1]
+
+    def add(self, rows: List[Dict[str, Any]], vectors: np.ndarray):
+        """Spool committed rows (EXPORT_METADATA_FIELDS) and their vectors; vector bytes go first, as in AnnIndexWriter"""
+        data = np.asarray(vectors, dtype=np.float32).tobytes()
+        lines = ''.join(json.dumps(row, ensure_ascii=False) + '\n' for row in rows).encode('utf-8')
+        with self.lock:
+            self.vectors_file.write(data)
+            self.vectors_file.flush()
+            self.rows_file.write(lines)
+            self.rows_file.flush()
+            self.pending_rows += len(rows)
+            if self.pending_rows >= self.shard_rows:
+                self._seal()
+
+    def remove(self, chunk_ids: List[str]):
+        with self.lock:
+            self.removed_file.write(''.join(f"{chunk_id}\n" for chunk_id in chunk_ids).encode('utf-8'))
+            self.removed_file.flush()
+
+    def reset(self):
+        """Drop the existing export and anything spooled so far (their documents were cleared)"""
+        with self.lock:
+            self._superseded.extend(self.manifest['shards'])
+            self.manifest['shards'] = []
+            for spool in (self.vectors_file, self.rows_file, self.removed_file):
+                spool.seek(0)
+                spool.truncate()
+            self.pending_rows = 0
+            self._write_manifest()
+
+    def _shard_files(self, shard: Dict[str, Any]) -> List[str]:
+        names = [f"{shard['name']}.npy", f"{shard['name']}.jsonl"] if shard['format'] == 'npy' else [f"{shard['name']}.parquet"]
+        if shard.get('removed'):
+            names.append(f"{shard['name']}.removed.json")
+        return names
+
+    def _write_manifest(self):
+        tmp_path = os.path.join(self.path, '.tmp.manifest.json')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, os.path.join(self.path, 'manifest.json'))
+        live = {name for shard in self.manifest['shards'] for name in self._shard_files(shard)}
+        for shard in self._superseded:
+            for name in self._shard_files(shard):
+                if name not in live:
+                    try:
+                        os.remove(os.path.join(self.path, name))
+                    except FileNotFoundError:
+                        pass
+        self._superseded = []
+
+    def _seal(self):
+        """Turn the spool into the next shard (caller holds the lock)"""
+        self.vectors_file.flush()
+        self.rows_file.flush()
+        self.removed_file.flush()
+        lines = self._read_lines('pending_rows.jsonl')
+        removed = self._read_lines('pending_removed.txt')
+        vector_bytes = os.path.getsize(os.path.join(self.path, 'pending_vectors.f32'))
+        count = min(len(lines), vector_bytes // (4 * self.dimensions))
+        if not count and not removed:
+            if self._superseded:
+                self._write_manifest()
+            return
+        rows = [json.loads(line) for line in lines[:count]]
+        vectors = np.fromfile(os.path.join(self.path, 'pending_vectors.f32'), dtype=np.float32,
+                              count=count * self.dimensions).reshape(count, self.dimensions)
+        # Sequence numbers continue past every shard ever listed, so a replaced export's files are never overwritten
+        sequence = 1 + max((int(shard['name'].split('-')[1]) for shard in self.manifest['shards'] + self._superseded), default=-1)
+        shard = {'name': f"part-{sequence:05d}", 'format': self.fmt, 'rows': count, 'removed': len(removed)}
+
+        def tmp(name: str) -> str:
+            return os.path.join(self.path, f".tmp.{name}")
+
+        names = self._shard_files(shard)
+        if self.fmt == 'npy':
+            np.save(tmp(names[0]), vectors)
+            with open(tmp(names[1]), 'w', encoding='utf-8') as f:
+                f.write(''.join(line + '\n' for line in lines[:count]))
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            schema = _export_arrow_schema(self.dimensions)
+            columns = [pa.array([row.get(field) for row in rows], type=schema.field(field).type) for field in EXPORT_METADATA_FIELDS]
+            columns.append(pa.FixedSizeListArray.from_arrays(pa.array(vectors.reshape(-1)), self.dimensions))
+            pq.write_table(pa.Table.from_arrays(columns, schema=schema), tmp(names[0]))
+        if removed:
+            with open(tmp(names[-1]), 'w', encoding='utf-8') as f:
+                json.dump(removed, f)
+        for name in names:
+            self.bytes_written += os.path.getsize(tmp(name))
+            os.replace(tmp(name), os.path.join(self.path, name))
+        # The manifest last: a reader never sees a shard whose files are not in place yet
+        self.manifest['shards'].append(shard)
+        self._write_manifest()
+        for spool in (self.vectors_file, self.rows_file, self.removed_file):
+            spool.seek(0)
+            spool.truncate()
+        self.pending_rows = 0
+        self.rows_written += count
+        self.shards_written += 1
+
+    def flush(self):
+        """Seal whatever is spooled into a (possibly short) shard"""
+        with self.lock:
+            self._seal()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {'rows': self.rows_written, 'shards': self.shards_written, 'bytes': self.bytes_written,
+                    'format': self.fmt, 'path': self.path}
+
+    def close(self):
+        with self.lock:
+            for spool in (self.vectors_file, self.rows_file, self.removed_file):
+                spool.close()
+
+
+class EmbeddingShardReader:
+    """Read side of an EmbeddingExportWriter export: the live rows of each shard, in write order"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'manifest.json'), encoding='utf-8') as f:
+            self.manifest = json.load(f)
+        self.dimensions: int = self.manifest['dimensions']
+        self.shards: List[Dict[str, Any]] = self.manifest['shards']
+
+    def _chunk_ids(self, shard: Dict[str, Any]) -> List[str]:
+        if shard['format'] == 'npy':
+            with open(os.path.join(self.path, f"{shard['name']}.jsonl"), encoding='utf-8') as f:
+                return [json.loads(line)['chunkId'] for line in f]
+        import pyarrow.parquet as pq
+
+        return pq.read_table(os.path.join(self.path, f"{shard['name']}.parquet"), columns=['chunkId']).column('chunkId').to_pylist()
+
+    def _removed(self, shard: Dict[str, Any]) -> List[str]:
+        if not shard.get('removed'):
+            return []
+        with open(os.path.join(self.path, f"{shard['name']}.removed.json"), encoding='utf-8') as f:
+            return json.load(f)
+
+    def _read(self, shard: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], np.ndarray]:
+        if shard['format'] == 'npy':
+            vectors = np.load(os.path.join(self.path, f"{shard['name']}.npy"), mmap_mode='r')
+            with open(os.path.join(self.path, f"{shard['name']}.jsonl"), encoding='utf-8') as f:
+                return [json.loads(line) for line in f], vectors
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(os.path.join(self.path, f"{shard['name']}.parquet"))
+        embedding = table.column('embedding').combine_chunks()
+        vectors = embedding.flatten().to_numpy().reshape(len(embedding), self.dimensions)
+        return table.drop_columns(['embedding']).to_pylist(), vectors
+
+    def live_rows(self) -> Dict[str, Tuple[int, int]]:
+        """{chunk ID: (shard position, row)} of each chunk's latest row, leaving out removed chunks"""
+        live: Dict[str, Tuple[int, int]] = {}
+        for position, shard in enumerate(self.shards):
+            for row, chunk_id in enumerate(self._chunk_ids(shard)):
+                live.pop(chunk_id, None)
+                live[chunk_id] = (position, row)
+            # Removals spooled with a shard apply to its rows and everything before them
+            for chunk_id in self._removed(shard):
+                live.pop(chunk_id, None)
+        return live
+
+    def iter_live(self) -> Iterator[Tuple[Dict[str, Any], List[Dict[str, Any]], np.ndarray]]:
+        """(shard, rows, vectors) for every shard, restricted to its live rows"""
+        live = self.live_rows()
+        for position, shard in enumerate(self.shards):
+            rows, vectors = self._read(shard)
+            keep = [row for row, meta in enumerate(rows) if live.get(meta['chunkId']) == (position, row)]
+            yield shard, [rows[row] for row in keep], np.asarray(vectors[keep], dtype=np.float32)
+
+
+class EmbeddingCache:
+    """
+    Persistent content-addressed embedding cache in SQLite.
+    Keys hash the chunk text together with the model name and dimensions; vectors are stored
+    as float32 blobs and the least recently used entries are evicted once max_bytes is exceeded.
+    """
+
+    def __init__(self, path: str, model_name: str, dimensions: int, max_bytes: int):
+        self.path = path
+        self.model_name = model_name
+        self.dimensions = dimensions
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        # Shared by the pipeline's embed workers; every access goes through self.lock
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS embedding_cache ('
+            ' key TEXT PRIMARY KEY, vector BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS embedding_cache_last_used ON embedding_cache (last_used)')
+        self.conn.commit()
+        self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM embedding_cache').fetchone()[0]
+
+    def key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\0{self.dimensions}\0{text}".encode('utf-8')).hexdigest()
+
+    def get_many(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """Look up texts, returning None for each miss; hits are marked as recently used"""
+        keys = [self.key(text) for text in texts]
+        found = {}
+        with self.lock:
+            # Stay below SQLite's default limit of 999 bound parameters
+            for i in range(0, len(keys), 500):
+                key_batch = keys[i:i + 500]
+                rows = self.conn.execute(
+                    f"SELECT key, vector FROM embedding_cache WHERE key IN ({','.join('?' * len(key_batch))})",
+                    key_batch
+                ).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self.conn.executemany('UPDATE embedding_cache SET last_used = ? WHERE key = ?',
+                                      [(now, key) for key in found])
+                self.conn.commit()
+        return [np.frombuffer(found[key], dtype=np.float32).tolist() if key in found else None for key in keys]
+
+    def put_many(self, texts: List[str], vectors: List[List[float]]):
+        """Store freshly generated embeddings, evicting old entries if the cache grows past max_bytes"""
+        now = time.time()
+        rows = []
+        for text, vector in zip(texts, vectors):
+            key = self.key(text)
+            blob = np.asarray(vector, dtype=np.float32).tobytes()
+            rows.append((key, blob, len(key) + len(blob), now))
+        with self.lock:
+            for key, _, size, _ in rows:
+                existing = self.conn.execute('SELECT size FROM embedding_cache WHERE key = ?', (key,)).fetchone()
+                self.total_bytes += size - (existing[0] if existing else 0)
+            self.conn.executemany('INSERT OR REPLACE INTO embedding_cache VALUES (?, ?, ?, ?)', rows)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        """Drop least recently used entries until the cache is back under 90% of max_bytes"""
+        target = self.max_bytes * 0.9
+        while self.total_bytes > target:
+            rows = self.conn.execute('SELECT key, size FROM embedding_cache ORDER BY last_used LIMIT 1000').fetchall()
+            if not rows:
+                self.total_bytes = 0
+                break
+            evicted = []
+            for key, size in rows:
+                evicted.append((key,))
+                self.total_bytes -= size
+                if self.total_bytes <= target:
+                    break
+            self.conn.executemany('DELETE FROM embedding_cache WHERE key = ?', evicted)
+            self.evictions += len(evicted)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'size_bytes': self.total_bytes
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class ChunkDeduplicator:
+    """
+    Run-wide duplicate detection between splitting and embedding.
+
+    Exact duplicates are found by a hash of the whitespace-normalised text. Near duplicates
+    ('near' mode) are found with MinHash signatures over word 5-shingles, bucketed by LSH
+    bands: num_perm / bands rows per band put the candidate threshold at about
+    (1 / bands) ** (bands / num_perm), and candidates are confirmed when their estimated
+    Jaccard similarity reaches `threshold`. Whole files with the content hash of an already
+    processed file are detected too.
+
+    The first occurrence of a chunk claims it as canonical as soon as it is seen, so files in
+    flight together in pipeline mode still find each other's chunks. A claim is settled when
+    its file commits the chunk (register) or fails (release_source); duplicates of claims that
+    were released are returned by settle() so the caller can embed and write them itself.
+    """
+
+    MERSENNE_PRIME = (1 << 31) - 1
+
+    def __init__(self, near: bool = True, threshold: float = 0.9, num_perm: int = 128, bands: int = 16,
+                 shingle_words: int = 5, seed: int = 1):
+        self.near = near
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_words = shingle_words
+        rng = np.random.default_rng(seed)
+        # a*x + b mod (2^31 - 1) with a, b, x < 2^31 cannot overflow uint64
+        self.perm_a = rng.integers(1, self.MERSENNE_PRIME, num_perm, dtype=np.uint64)[:, None]
+        self.perm_b = rng.integers(0, self.MERSENNE_PRIME, num_perm, dtype=np.uint64)[:, None]
+        self.lock = threading.Lock()
+        self.exact: Dict[bytes, str] = {}
+        self.band_buckets: List[Dict[bytes, List[str]]] = [{} for _ in range(bands)]
+        self.signatures: Dict[str, np.ndarray] = {}
+        self.claims: Dict[str, Future] = {}
+        self.claims_by_source: Dict[str, set] = {}
+        self.released: set = set()
+        # source ID -> {chunk index: (canonical chunk ID, text)} for duplicates of unsettled claims
+        self.waiting: Dict[str, Dict[int, Tuple[str, str]]] = {}
+        self.documents: Dict[str, str] = {}
+        self.chunks_checked = 0
+        self.exact_duplicates = 0
+        self.near_duplicates = 0
+        self.bytes_saved = 0
+        self.duplicate_documents = 0
+        self.document_bytes_saved = 0
+
+    @staticmethod
+    def _exact_key(text: str) -> bytes:
+        return hashlib.sha1(' '.join(text.split()).encode('utf-8')).digest()
+
+    def signature(self, text: str) -> np.ndarray:
+        words = text.split()
+        size = self.shingle_words
+        shingles = {' '.join(words[i:i + size]) for i in range(max(1, len(words) - size + 1))}
+        hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles),
+                             dtype=np.uint64, count=len(shingles)) % self.MERSENNE_PRIME
+        return ((self.perm_a * hashes + self.perm_b) % self.MERSENNE_PRIME).min(axis=1).astype(np.uint32)
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def _near_match(self, signature: np.ndarray) -> Optional[str]:
+        best_id, best_score = None, self.threshold
+        seen = set()
+        for band, key in enumerate(self._band_keys(signature)):
+            for candidate in self.band_buckets[band].get(key, ()):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                score = float(np.mean(self.signatures[candidate] == signature))
+                if score >= best_score:
+                    best_id, best_score = candidate, score
+        return best_id
+
+    def filter(self, source_id: str, texts: List[str], chunk_ids: List[str],
+               chunk_indices: List[int]) -> Tuple[List[int], Dict[int, str]]:
+        """
+        Positions of the texts that must be embedded (now claimed as canonical), and
+        {position: canonical chunk ID} for the duplicates.
+        """
+        signatures = [self.signature(text) for text in texts] if self.near else []
+        keep: List[int] = []
+        duplicates: Dict[int, str] = {}
+        with self.lock:
+            self.chunks_checked += len(texts)
+            for position, text in enumerate(texts):
+                key = self._exact_key(text)
+                canonical = self.exact.get(key)
+                if canonical is not None:
+                    self.exact_duplicates += 1
+                elif self.near:
+                    canonical = self._near_match(signatures[position])
+                    if canonical is not None:
+                        self.near_duplicates += 1
+                if canonical is None:
+                    keep.append(position)
+                    self._claim(source_id, chunk_ids[position], key, signatures[position] if self.near else None)
+                    continue
+                self.bytes_saved += len(text.encode('utf-8'))
+                duplicates[position] = canonical
+                if canonical in self.claims and canonical not in self.claims_by_source.get(source_id, ()):
+                    # Claimed by another file that has not committed it yet
+                    self.waiting.setdefault(source_id, {})[chunk_indices[position]] = (canonical, text)
+        return keep, duplicates
+
+    def _claim(self, source_id: str, chunk_id: str, key: bytes, signature: Optional[np.ndarray]):
+        self.exact.setdefault(key, chunk_id)
+        if signature is not None:
+            self.signatures[chunk_id] = signature
+            for band, band_key in enumerate(self._band_keys(signature)):
+                self.band_buckets[band].setdefault(band_key, []).append(chunk_id)
+        self.claims[chunk_id] = Future()
+        self.claims_by_source.setdefault(source_id, set()).add(chunk_id)
+
+    def register(self, source_id: str, chunk_ids: List[str]):
+        """Settle the claims on chunks that are now committed"""
+        with self.lock:
+            claimed = self.claims_by_source.get(source_id, set())
+            for chunk_id in chunk_ids:
+                claimed.discard(chunk_id)
+                future = self.claims.pop(chunk_id, None)
+                if future is not None:
+                    future.set_result(True)
+
+    def release_source(self, source_id: str):
+        """Withdraw the uncommitted claims of a file that failed, so later duplicates embed their own copy"""
+        with self.lock:
+            for chunk_id in self.claims_by_source.pop(source_id, set()):
+                future = self.claims.pop(chunk_id, None)
+                if future is None:
+                    continue
+                self.released.add(chunk_id)
+                signature = self.signatures.pop(chunk_id, None)
+                if signature is not None:
+                    for band, band_key in enumerate(self._band_keys(signature)):
+                        self.band_buckets[band][band_key].remove(chunk_id)
+                future.set_result(False)
+            self.exact = {key: chunk_id for key, chunk_id in self.exact.items() if chunk_id not in self.released}
+            self.waiting.pop(source_id, None)
+
+    def settle(self, source_id: str) -> Dict[int, str]:
+        """
+        Wait for the claims this file's duplicates point at; returns {chunk index: text} for
+        duplicates whose canonical chunk was released and must be written by this file.
+        """
+        with self.lock:
+            waiting = self.waiting.pop(source_id, {})
+            futures = [self.claims.get(canonical) for canonical, _ in waiting.values()]
+        for future in futures:
+            if future is not None:
+                future.result()
+        with self.lock:
+            return {index: text for index, (canonical, text) in waiting.items() if canonical in self.released}
+
+    def document(self, blob) -> Optional[str]:
+        """Source ID of an earlier file in this run with identical content"""
+        if not blob.md5_hash:
+            return None
+        with self.lock:
+            canonical = self.documents.get(blob.md5_hash)
+            if canonical is not None:
+                self.duplicate_documents += 1
+                self.document_bytes_saved += blob.size or 0
+            return canonical
+
+    def register_document(self, blob, source_id: str):
+        if blob.md5_hash:
+            with self.lock:
+                self.documents.setdefault(blob.md5_hash, source_id)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'chunks_checked': self.chunks_checked,
+                'exact_duplicates': self.exact_duplicates,
+                'near_duplicates': self.near_duplicates,
+                'bytes_saved': self.bytes_saved,
+                'duplicate_documents': self.duplicate_documents,
+                'document_bytes_saved': self.document_bytes_saved
+            }
+
+
+# gRPC status names of the errors the embedding batcher treats specially, as HTTP statuses
+_GRPC_STATUS_CODES = {'RESOURCE_EXHAUSTED': 429, 'INVALID_ARGUMENT': 400}
+
+
+def _embedding_error_status(error: Exception) -> Optional[int]:
+    """HTTP status of an API error from its type or `code`, or None when it carries neither"""
+    name = type(error).__name__
+    if name in ('ResourceExhausted', 'TooManyRequests'):
+        return 429
+    if name in ('InvalidArgument', 'BadRequest'):
+        return 400
+    code = getattr(error, 'code', None)
+    if callable(code):
+        # grpc.RpcError exposes its status as a method returning a grpc.StatusCode
+        try:
+            code = code()
+        except Exception:
+            return None
+    if getattr(code, 'name', None) in _GRPC_STATUS_CODES:
+        return _GRPC_STATUS_CODES[code.name]
+    return code if isinstance(code, int) and not isinstance(code, bool) else None
+
+
+def _classify_embedding_error(error: Exception) -> str:
+    """
+    Classify an embedding API error as 'rate_limit', 'too_large' or 'other'. The exception type
+    or status code decides; the message is only read for errors that carry neither (a leading
+    status as in "429 Quota exceeded", or quota wording), and to tell a request-size 400 from
+    other invalid arguments.
+    """
+    status = _embedding_error_status(error)
+    message = str(error).lower()
+    if status is None:
+        leading = re.match(r'\s*(\d{3})\b', message)
+        status = int(leading.group(1)) if leading else None
+        if status is None and re.search(r'\bquota\b|\brate limit|\bresource exhausted\b', message):
+            return 'rate_limit'
+    if status == 429:
+        return 'rate_limit'
+    if status == 400 and re.search(r'\btoken|\btoo many\b|\btoo large\b|\bexceed|\blimit\b|\bsize\b', message):
+        return 'too_large'
+    return 'other'
+
+
+# Rough characters per token of embedding input, for budgeting tokens-per-minute quotas
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, -(-len(text) // CHARS_PER_TOKEN))
+
+
+class TokenBucket:
+    """
+    A budget of `per_minute` units, refilled continuously and holding at most `burst_seconds`
+    worth. A request larger than the whole bucket goes through once the bucket is full and leaves
+    it in debt, so it is paced instead of blocked forever. Not thread-safe: it is only used on
+    the embedding batcher's event loop.
+    """
+
+    def __init__(self, per_minute: float, burst_seconds: float = 10.0):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until `amount` can be taken"""
+        self._refill(now)
+        needed = min(amount, self.capacity)
+        return 0.0 if self.level >= needed else (needed - self.level) / self.rate
+
+    def take(self, amount: float, now: float):
+        self._refill(now)
+        self.level -= amount
+
+
+class EmbeddingBatcher:
+    """
+    Packs chunks from every file being processed into shared embedding requests.
+    A request is bounded by both an item count and a character budget (a proxy for tokens);
+    both limits shrink on request-size errors and grow back while requests succeed.
+    Requests run concurrently on an asyncio loop in a background thread, and each chunk
+    gets its own future so results route back to the chunk that asked for them.
+
+    Requests are paced by optional requests-per-minute and tokens-per-minute token buckets.
+    Concurrency is AIMD: halved on a quota error (once per congestion event) and raised by about
+    one per round of successful requests, up to max_in_flight. Chunks of a failed request are
+    requeued rather than failed: quota errors pause dispatch and retry until quota_timeout,
+    other errors retry up to max_retries times with backoff.
+    """
+
+    def __init__(self, embeddings, dimensions: int, max_items: int = 100, max_chars: int = 60_000,
+                 max_in_flight: int = 4, linger_seconds: float = 0.05, max_retries: int = 5,
+                 requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                 quota_timeout: float = 900.0, metrics: Optional[RunMetrics] = None):
+        self.embeddings = embeddings
+        self.metrics = metrics
+        self.dimensions = dimensions
+        self.max_items = max_items
+        self.max_chars = max_chars
+        self.max_in_flight = max_in_flight
+        self.linger_seconds = linger_seconds
+        self.max_retries = max_retries
+        self.quota_timeout = quota_timeout
+        self.request_budget = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_budget = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        # Current (adaptive) limits
+        self.batch_items = max_items
+        self.batch_chars = max_chars
+        self.concurrency = float(max_in_flight)
+        self._success_streak = 0
+        self._quota_streak = 0
+        # Bumped on every concurrency decrease; requests launched before it don't decrease it again
+        self._limit_epoch = 0
+        self._paused_until = 0.0
+        self.stats_lock = threading.Lock()
+        self.requests = 0
+        self.chunks_embedded = 0
+        self.retries = 0
+        self.batch_shrinks = 0
+        self.rate_limited = 0
+        self.requeued = 0
+        self.failed_chunks = 0
+        self.throttled_requests = 0
+        self.throttled_seconds = 0.0
+        self.in_flight_requests = 0
+        self.first_request_at: Optional[float] = None
+        self.last_result_at: Optional[float] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self._loop is not None:
+                return
+            self._loop = asyncio.new_event_loop()
+            # The embedding client is synchronous, so in-flight requests run on a thread pool
+            self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix='rag-embed')
+            self._thread = threading.Thread(target=self._loop.run_forever, name='rag-embed-batcher', daemon=True)
+            self._thread.start()
+            self._queue = asyncio.run_coroutine_threadsafe(self._create_queue(), self._loop).result()
+            asyncio.run_coroutine_threadsafe(self._dispatch(), self._loop)
+
+    async def _create_queue(self) -> asyncio.Queue:
+        self._slots = asyncio.Condition()
+        return asyncio.Queue()
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts, blocking until every one of them has been returned by a (shared) request"""
+        if not texts:
+            return []
+        self._start()
+        futures = [Future() for _ in texts]
+        # Queue items are (text, future, retries so far, when quota errors started for it)
+        self._loop.call_soon_threadsafe(self._enqueue_many, [(text, future, 0, None) for text, future in zip(texts, futures)])
+        return [future.result() for future in futures]
+
+    def _enqueue_many(self, items: List[Tuple[str, Future, int, Optional[float]]]):
+        for item in items:
+            self._queue.put_nowait(item)
+
+    async def _dispatch(self):
+        """Form batches from queued chunks and launch them, at most max_in_flight at a time"""
+        carry = None
+        while True:
+            first = carry if carry is not None else await self._queue.get()
+            carry = None
+            batch = [first]
+            batch_chars = len(first[0])
+            deadline = self._loop.time() + self.linger_seconds
+            while len(batch) < self.batch_items:
+                try:
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    remaining = deadline - self._loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                if batch_chars + len(item[0]) > self.batch_chars:
+                    carry = item
+                    break
+                batch.append(item)
+                batch_chars += len(item[0])
+            await self._acquire_slot()
+            self._loop.create_task(self._run_batch(batch))
+
+    async def _acquire_slot(self):
+        """Wait until fewer requests than the current AIMD concurrency limit are in flight"""
+        async with self._slots:
+            await self._slots.wait_for(lambda: self.in_flight_requests < max(1, int(self.concurrency)))
+            with self.stats_lock:
+                self.in_flight_requests += 1
+
+    async def _run_batch(self, batch: List[Tuple[str, Future, int, Optional[float]]]):
+        try:
+            await self._send(batch)
+        finally:
+            async with self._slots:
+                with self.stats_lock:
+                    self.in_flight_requests -= 1
+                self._slots.notify_all()
+
+    async def _throttle(self, texts: List[str]):
+        """Wait out a quota pause and the request/token budgets, then spend from them"""
+        tokens = sum(estimate_tokens(text) for text in texts)
+        budgets = [(bucket, amount) for bucket, amount in ((self.request_budget, 1), (self.token_budget, tokens))
+                   if bucket is not None]
+        waited = 0.0
+        while True:
+            now = self._loop.time()
+            delay = max([self._paused_until - now] + [bucket.wait_time(amount, now) for bucket, amount in budgets])
+            if delay <= 0:
+                break
+            waited += delay
+            await asyncio.sleep(delay)
+        for bucket, amount in budgets:
+            bucket.take(amount, now)
+        if waited:
+            with self.stats_lock:
+                self.throttled_requests += 1
+                self.throttled_seconds += waited
+
+    async def _send(self, batch: List[Tuple[str, Future, int, Optional[float]]]):
+        texts = [item[0] for item in batch]
+        await self._throttle(texts)
+        epoch = self._limit_epoch
+        with self.stats_lock:
+            self.requests += 1
+            if self.first_request_at is None:
+                self.first_request_at = time.time()
+        try:
+            request_start = time.perf_counter()
+            vectors = await self._loop.run_in_executor(
+                self._executor, functools.partial(self.embeddings.embed, texts, dimensions=self.dimensions)
+            )
+            if self.metrics is not None:
+                self.metrics.observe('embed_request', time.perf_counter() - request_start, len(texts))
+            if len(vectors) != len(texts):
+                raise ValueError(f"Embedding API returned {len(vectors)} vectors for {len(texts)} texts")
+        except Exception as e:
+            kind = _classify_embedding_error(e)
+            if kind == 'too_large' and len(batch) > 1:
+                # Resend as two smaller requests instead of failing the whole batch
+                self._shrink(len(batch), batch_chars=sum(len(text) for text in texts))
+                middle = len(batch) // 2
+                await self._send(batch[:middle])
+                await self._send(batch[middle:])
+                return
+            if kind == 'rate_limit':
+                self._on_rate_limit(epoch)
+            self._requeue(batch, e, kind)
+            return
+        if vectors and len(vectors[0]) != self.dimensions:
+            logger.warning(f"⚠️  Embedding dimension mismatch in batch: requested {self.dimensions}, got {len(vectors[0])}")
+        for (_, future, _, _), vector in zip(batch, vectors):
+            future.set_result(vector)
+        self._grow()
+        with self.stats_lock:
+            self.chunks_embedded += len(batch)
+            self.last_result_at = time.time()
+
+    def _requeue(self, batch: List[Tuple[str, Future, int, Optional[float]]], error: Exception, kind: str):
+        """Put the chunks of a failed request back in the queue; fail only those out of retries"""
+        now = self._loop.time()
+        retry, failed = [], []
+        for text, future, attempts, limited_since in batch:
+            if kind == 'rate_limit':
+                since = limited_since if limited_since is not None else now
+                (failed if now - since > self.quota_timeout else retry).append((text, future, attempts, since))
+            else:
+                (failed if attempts >= self.max_retries else retry).append((text, future, attempts + 1, None))
+        for _, future, _, _ in failed:
+            future.set_exception(error)
+        with self.stats_lock:
+            self.retries += 1
+            self.requeued += len(retry)
+            self.failed_chunks += len(failed)
+        if not retry:
+            return
+        if kind == 'rate_limit':
+            # The quota pause in _throttle spaces these out
+            delay = 0.0
+        else:
+            # Exponential backoff with full jitter so concurrent requests don't retry in lockstep
+            delay = random.uniform(0, min(60.0, 2.0 ** max(attempts for _, _, attempts, _ in retry)))
+        logger.warning(f"⚠️  Embedding request of {len(batch)} chunks failed ({kind}: {error}), "
+                       f"requeued {len(retry)} chunks" + (f" in {delay:.1f}s" if delay else ""))
+        self._loop.call_later(delay, self._enqueue_many, retry)
+
+    def _on_rate_limit(self, epoch: int):
+        """Multiplicative decrease: halve concurrency once per congestion event and pause dispatch"""
+        with self.stats_lock:
+            self.rate_limited += 1
+            self._success_streak = 0
+            if epoch != self._limit_epoch:
+                # Launched before the last decrease: that one already accounted for this congestion
+                return
+            self._limit_epoch += 1
+            self._quota_streak += 1
+            if self.concurrency > 1:
+                self.concurrency = max(1.0, self.concurrency / 2)
+                logger.info(f"📉 Embedding concurrency reduced to {int(self.concurrency)} after a quota error")
+            pause = random.uniform(0.5, 1.0) * min(60.0, 2.0 ** min(self._quota_streak, 6))
+            self._paused_until = max(self._paused_until, self._loop.time() + pause)
+
+    def _shrink(self, failed_items: int, batch_chars: int):
+        """Cap the request limits at half the size of the request that failed"""
+        with self.stats_lock:
+            # Relative to the failed request, so concurrent failures don't compound
+            self.batch_items = min(self.batch_items, max(1, failed_items // 2))
+            self.batch_chars = min(self.batch_chars, max(1, batch_chars // 2))
+            self._success_streak = 0
+            self.batch_shrinks += 1
+            logger.info(f"📉 Embedding batch limits reduced to {self.batch_items} chunks / {self.batch_chars:,} chars")
+
+    def _grow(self):
+        """Additively restore concurrency (about +1 per round of requests) and the request limits"""
+        with self.stats_lock:
+            self._quota_streak = 0
+            self.concurrency = min(float(self.max_in_flight), self.concurrency + 1 / self.concurrency)
+            self._success_streak += 1
+            if self._success_streak >= 10 and (self.batch_items < self.max_items or self.batch_chars < self.max_chars):
+                self.batch_items = min(self.max_items, self.batch_items + max(1, self.max_items // 10))
+                self.batch_chars = min(self.max_chars, self.batch_chars + max(1, self.max_chars // 10))
+                self._success_streak = 0
+
+    def queued(self) -> int:
+        """Chunks waiting to be packed into a request"""
+        return self._queue.qsize() if self._loop is not None else 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self.stats_lock:
+            elapsed = (self.last_result_at - self.first_request_at) if self.first_request_at and self.last_result_at else 0.0
+            return {
+                'requests': self.requests,
+                'chunks': self.chunks_embedded,
+                'retries': self.retries,
+                'batch_shrinks': self.batch_shrinks,
+                'rate_limited': self.rate_limited,
+                'requeued': self.requeued,
+                'failed_chunks': self.failed_chunks,
+                'throttled_requests': self.throttled_requests,
+                'throttled_seconds': self.throttled_seconds,
+                'avg_batch_size': self.chunks_embedded / self.requests if self.requests else 0.0,
+                'chunks_per_sec': self.chunks_embedded / elapsed if elapsed > 0 else 0.0,
+                'batch_items': self.batch_items,
+                'batch_chars': self.batch_chars,
+                'concurrency': int(self.concurrency)
+            }
+
+    async def _cancel_tasks(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close(self):
+        with self._start_lock:
+            if self._loop is None:
+                return
+            asyncio.run_coroutine_threadsafe(self._cancel_tasks(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._executor.shutdown(wait=False)
+            self._loop = None
+
+
+def shard_of(blob_name: str, shard_count: int) -> int:
+    """Shard that owns an object; crc32 of the name is stable across processes, machines and Python versions"""
+    return zlib.crc32(blob_name.encode('utf-8')) % shard_count
+
+
 class GeminiRAGPopulator:
-    def __init__(self, bucket_path: str, target_dimensions: int = 1536, firestore_mode: str = 'cloud'):
+    def __init__(self, bucket_path: str, target_dimensions: int = 1536, firestore_mode: str = 'cloud',
+                 pipeline: bool = False, workers: int = 4,
+                 process_workers: Optional[int] = None, pdf_page_timeout: float = 30.0,
+                 incremental: bool = False, manifest_backend: str = 'sqlite', manifest_path: str = 'rag_manifest.sqlite',
+                 embedding_cache_path: Optional[str] = None, embedding_cache_max_mb: int = 2048,
+                 embed_batch_size: int = 100, embed_batch_chars: int = 60_000, embed_concurrency: int = 4,
+                 embed_linger_ms: float = 50.0, embed_rpm: Optional[float] = None, embed_tpm: Optional[float] = None,
+                 stream_threshold_mb: int = 32, stream_window_mb: int = 8,
+                 write_concurrency: int = 8, write_max_ops_per_second: float = 10_000,
+                 checkpoint_path: Optional[str] = None, resume: bool = False,
+                 vector_encodings: Optional[List[str]] = None, vector_storage: str = 'alongside',
+                 ann_index_path: Optional[str] = None, ann_lists: Optional[int] = None,
+                 export_path: Optional[str] = None, export_format: str = 'npy', export_shard_rows: int = 10_000,
+                 matryoshka_dimensions: Optional[List[int]] = None,
+                 metrics_path: Optional[str] = None, metrics_format: str = 'json', metrics_interval: float = 30.0,
+                 project: str = 'shockproof-dev', location: str = 'us-central1',
+                 dedup: str = 'off', dedup_threshold: float = 0.9,
+                 shard: Optional[Tuple[int, int]] = None, list_page_size: int = 1000,
+                 source_storage: str = 'parts', source_text_uri: Optional[str] = None, source_part_kb: Optional[int] = None,
+                 splitter: str = 'span', storage_client=None, embeddings=None, db=None):
         self.bucket_path = bucket_path.rstrip('/')
         self.bucket_name = bucket_path.replace('gs://', '').split('/')[0]
         self.bucket_prefix = '/'.join(bucket_path.replace('gs://', '').split('/')[1:]) if '/' in bucket_path.replace('gs://', '') else ''
         self.target_dimensions = target_dimensions
         self.firestore_mode = firestore_mode
+        self.project = project
+        self.location = location
+        self.pipeline = pipeline
+        self.workers = max(1, workers)
+        self.process_workers = process_workers or os.cpu_count() or 1
+        self.pdf_page_timeout = pdf_page_timeout
+        self._process_pool: Optional[ProcessPoolExecutor] = None
+        self._process_pool_lock = threading.Lock()
+        self.stream_threshold_bytes = stream_threshold_mb * 1024 * 1024
+        self.stream_window_bytes = stream_window_mb * 1024 * 1024
+        # Chunks embedded and written per step on the streaming path (bounds memory per file)
+        self.stream_chunk_group = 200
+        self.vector_encodings = vector_encodings or []
+        self.vector_storage = vector_storage
+        self.matryoshka_dimensions = sorted(set(matryoshka_dimensions or []))
+        self.metrics = RunMetrics(metrics_path, fmt=metrics_format, interval=metrics_interval)
+        self.deduplicator = ChunkDeduplicator(near=dedup == 'near', threshold=dedup_threshold) if dedup != 'off' else None
+        self.shard = shard
+        self.list_page_size = list_page_size
 
         logger.info(f"🚀 Gemini RAG Populator initialized")
         logger.info(f"📦 Bucket: {self.bucket_name}")
         logger.info(f"📁 Prefix: {self.bucket_prefix}")
         logger.info(f"🎯 Target dimensions: {target_dimensions}")
         logger.info(f"🗄️  Firestore mode: {firestore_mode}")
+        if pipeline:
+            logger.info(f"🔀 Pipeline mode: {self.workers} workers per stage")
+        if shard is not None:
+            logger.info(f"🧱 Shard {shard[0]}/{shard[1]}: objects with crc32(name) % {shard[1]} == {shard[0]}")
+        if self.deduplicator is not None:
+            logger.info(f"♊ Deduplication: {dedup}" + (f" (Jaccard ≥ {dedup_threshold})" if dedup == 'near' else ""))
+        if self.matryoshka_dimensions:
+            logger.info(f"🪆 Matryoshka fields: {', '.join(matryoshka_field(size) for size in self.matryoshka_dimensions)} "
+                        f"(re-normalized prefixes of the {target_dimensions}D embedding"
+                        + (", which is not stored)" if vector_storage == 'replace' else ")"))
+        if self.vector_encodings:
+            logger.info(f"🗜️  Compact vectors: {', '.join(self.vector_encodings)} ({vector_storage} the float embedding)")
+        if incremental:
+            logger.info(f"♻️  Incremental mode: {manifest_backend} manifest" + (f" ({manifest_path})" if manifest_backend == 'sqlite' else ""))
 
-        # Initialize services
-        self._init_firebase()
-        self._init_storage()
-        self._init_langchain_embeddings()
-        self._init_text_splitter()
+        # Services, splitters, the write engine and the embedding batcher are built on first use
+        # (see the properties below); pre-built clients can be injected, e.g. local fakes for offline runs
+        self._lazy_lock = threading.RLock()
+        self._db = db
+        self._storage_client = storage_client
+        self._bucket = None
+        self._embeddings = embeddings
+        self._text_splitter = None
+        self._json_splitter = None
+        self._write_engine: Optional[FirestoreWriteEngine] = None
+        self._batcher: Optional[EmbeddingBatcher] = None
+        self._source_text_store: Optional[SourceTextStore] = None
+        self.splitter = splitter
+        self.source_storage = source_storage
+        self.source_text_uri = source_text_uri
+        # Firestore parts must stay under the 1 MiB document limit; GCS shards can be larger
+        self.source_part_bytes = (source_part_kb or (900 if source_storage == 'parts' else 8192)) * 1024
+        self.write_concurrency = write_concurrency
+        self.write_max_ops_per_second = write_max_ops_per_second
+        self.embed_batch_size = embed_batch_size
+        self.embed_batch_chars = embed_batch_chars
+        self.embed_concurrency = embed_concurrency
+        self.embed_rpm = embed_rpm
+        self.embed_tpm = embed_tpm
+        self.embed_linger_ms = embed_linger_ms
+        self.manifest = self._init_manifest(manifest_backend, manifest_path) if incremental else None
+        # Manifest entries of the blobs being processed, as read when they were listed
+        self._manifest_entries: Dict[str, Optional[Dict[str, Any]]] = {}
+        # Set by clear_collections: no earlier versions are left to look up or clean up
+        self.collections_cleared = False
+        self.embedding_cache = self._init_embedding_cache(embedding_cache_path, embedding_cache_max_mb) if embedding_cache_path else None
+        self.checkpoint = RunCheckpoint(checkpoint_path, resume=resume) if checkpoint_path else None
+        if resume and self.checkpoint is not None:
+            logger.info(f"⏯️  Resuming from {checkpoint_path}: {len(self.checkpoint.completed)} files already done")
+        # Incremental and resumed runs only see part of the corpus, so they update the existing index
+        self.ann_index = AnnIndexWriter(ann_index_path, self.target_dimensions, lists=ann_lists,
+                                        merge_existing=incremental or resume) if ann_index_path else None
+        if self.ann_index is not None:
+            logger.info(f"🧭 Local ANN index (IVF-flat): {ann_index_path}")
+        self.embedding_export = EmbeddingExportWriter(export_path, self.target_dimensions, fmt=export_format,
+                                                      shard_rows=export_shard_rows,
+                                                      merge_existing=incremental or resume) if export_path else None
+        if self.embedding_export is not None:
+            logger.info(f"📤 Embedding export ({export_format}, {export_shard_rows:,} rows per shard): {export_path}")
+        self.metrics.register_gauge('embed_queue', lambda: self._batcher.queued() if self._batcher else 0)
+        self.metrics.register_gauge('embed_in_flight', lambda: self._batcher.in_flight_requests if self._batcher else 0)
+        self.metrics.register_gauge('embed_concurrency', lambda: int(self._batcher.concurrency) if self._batcher else 0)
+        self.metrics.register_gauge('write_pending_batches', lambda: self._write_engine.pending_batches() if self._write_engine else 0)
+        self.metrics.start()
+        if metrics_path:
+            logger.info(f"📈 Metrics: {metrics_path} ({metrics_format}, every {metrics_interval:g}s)")
         
     def _init_firebase(self):
         """Initialize Firebase Admin SDK for emulator or cloud based on mode"""
         try:
+            if self.firestore_mode == 'memory':
+                import rag_local_backends
+                self._db = rag_local_backends.MemoryFirestore()
+                logger.info("✅ In-memory Firestore initialized")
+                return
+            import firebase_admin
+            from google.cloud import firestore
+
             if not firebase_admin._apps:
                 firebase_admin.initialize_app()
             if self.firestore_mode == 'emulator':
                 os.environ['FIRESTORE_EMULATOR_HOST'] = 'localhost:9198'
-                self.db = firestore.Client()
+                self._db = firestore.Client()
                 logger.info("✅ Firebase initialized for emulator")
             else:
                 # Remove emulator env if set
                 if 'FIRESTORE_EMULATOR_HOST' in os.environ:
                     del os.environ['FIRESTORE_EMULATOR_HOST']
-                # Use cloud Firestore for project shockproof-dev in us-central1
-                self.db = firestore.Client(project='shockproof-dev')
-                logger.info("✅ Firebase initialized for cloud Firestore (project shockproof-dev, us-central1)")
+                self._db = firestore.Client(project=self.project)
+                logger.info(f"✅ Firebase initialized for cloud Firestore (project {self.project})")
         except Exception as e:
             logger.error(f"❌ Failed to initialize Firebase: {e}")
             raise
@@ -88,8 +2550,9 @@ class GeminiRAGPopulator:
     def _init_storage(self):
         """Initialize Google Cloud Storage"""
         try:
-            self.storage_client = storage.Client()
-            self.bucket = self.storage_client.bucket(self.bucket_name)
+            from google.cloud import storage
+
+            self._storage_client = storage.Client()
             logger.info("✅ Google Cloud Storage initialized")
         except Exception as e:
             logger.error(f"❌ Failed to initialize Storage: {e}")
@@ -98,30 +2561,16 @@ class GeminiRAGPopulator:
     def _init_langchain_embeddings(self):
         """Initialize LangChain VertexAI embeddings with gemini-embedding-001"""
         try:
+            from langchain_google_vertexai.embeddings import VertexAIEmbeddings
+
             # Initialize LangChain VertexAI embeddings with output_dimensionality
-            self.embeddings = VertexAIEmbeddings(
-                model_name="gemini-embedding-001",
-                project="shockproof-dev",
-                location="us-central1"
-                #dimensions=1536 # Specify desired dimensions
+            self._embeddings = VertexAIEmbeddings(
+                model_name=EMBEDDING_MODEL,
+                project=self.project,
+                location=self.location
             )
-            
-            # Test embedding generation
-            #logger.info(f"🧪 Testing embedding generation with gemini-embedding-001...")
-            #test_embedding = self.embeddings.embed(["Test embedding with gemini-embedding-001"], dimensions=self.target_dimensions)
-            
-            #actual_dimensions = len(test_embedding)
             logger.info(f"📊 Embedding model: gemini-embedding-001")
             logger.info(f"📏 Requested dimensions: {self.target_dimensions}")
-            #logger.info(f"📏 Actual dimensions: {actual_dimensions}")
-            
-            #if actual_dimensions == self.target_dimensions:
-            #    logger.info(f"✅ Successfully configured embeddings to {self.target_dimensions}D using output_dimensionality")
-            #else:
-            #    logger.warning(f"⚠️  Expected {self.target_dimensions}D but got {actual_dimensions}D")
-            #    logger.info("💡 Using actual dimensions from the model")
-            #    self.target_dimensions = actual_dimensions
-            
             logger.info("✅ LangChain VertexAI embeddings initialized successfully")
             
         except Exception as e:
@@ -129,84 +2578,282 @@ class GeminiRAGPopulator:
             raise
     
     def _init_text_splitter(self):
-        """Initialize LangChain's RecursiveCharacterTextSplitter and RecursiveJSONSplitter"""
+        """Initialize the text splitter: SpanTextSplitter, or LangChain's RecursiveCharacterTextSplitter it reproduces"""
         try:
             # Use reasonable chunk size and overlap for RAG
-            self.text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=1024,
-                chunk_overlap=128
-            )
-            self.json_splitter = RecursiveJsonSplitter(
+            if self.splitter == 'span':
+                self._text_splitter = SpanTextSplitter(chunk_size=1024, chunk_overlap=128)
+            else:
+                from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+                self._text_splitter = RecursiveCharacterTextSplitter(
+                    chunk_size=1024,
+                    chunk_overlap=128
+                )
+            logger.info(f"✅ {type(self._text_splitter).__name__} initialized")
+        except Exception as e:
+            logger.error(f"❌ Failed to initialize text splitter: {e}")
+            raise
+
+    def _init_json_splitter(self):
+        """Initialize LangChain's RecursiveJSONSplitter"""
+        try:
+            from langchain.text_splitter import RecursiveJsonSplitter
+
+            self._json_splitter = RecursiveJsonSplitter(
                 max_chunk_size=1024,
                 min_chunk_size=200
             )
-            logger.info("✅ LangChain RecursiveCharacterTextSplitter and RecursiveJSONSplitter initialized")
+            logger.info("✅ LangChain RecursiveJSONSplitter initialized")
         except Exception as e:
-            logger.error(f"❌ Failed to initialize text splitters: {e}")
+            logger.error(f"❌ Failed to initialize JSON splitter: {e}")
             raise
     
+    def _init_embedding_cache(self, path: str, max_mb: int) -> EmbeddingCache:
+        """Open the persistent embedding cache"""
+        try:
+            cache = EmbeddingCache(path, EMBEDDING_MODEL, self.target_dimensions, max_mb * 1024 * 1024)
+            logger.info(f"✅ Embedding cache opened: {path} ({cache.total_bytes / 1024 / 1024:.1f} MB of {max_mb} MB)")
+            return cache
+        except Exception as e:
+            logger.error(f"❌ Failed to open embedding cache: {e}")
+            raise
+
+    def _init_manifest(self, manifest_backend: str, manifest_path: str):
+        """Open the incremental ingest manifest"""
+        try:
+            if manifest_backend == 'firestore':
+                manifest = FirestoreManifest(self.db)
+            else:
+                manifest = SQLiteManifest(manifest_path)
+            logger.info("✅ Ingest manifest opened")
+            return manifest
+        except Exception as e:
+            logger.error(f"❌ Failed to open ingest manifest: {e}")
+            raise
+
     def clear_collections(self):
         """Clear existing embeddings and sources collections"""
         logger.info("🧹 Clearing existing collections...")
         
         collections_to_clear = ['embeddings', 'sources']
         total_deleted = 0
-        
-        for collection_name in collections_to_clear:
-            logger.info(f"🗑️  Clearing {collection_name} collection...")
-            
-            collection_ref = self.db.collection(collection_name)
-            docs = list(collection_ref.stream())
-            
-            if not docs:
-                logger.info(f"   📭 {collection_name} collection is already empty")
-                continue
-            
-            logger.info(f"   📊 Found {len(docs)} documents to delete")
-            
-            # Delete in batches of 500 (Firestore limit)
-            batch_size = 500
-            for i in range(0, len(docs), batch_size):
-                batch = self.db.batch()
-                batch_docs = docs[i:i + batch_size]
-                
-                for doc in batch_docs:
-                    batch.delete(doc.reference)
-                
-                batch.commit()
-                total_deleted += len(batch_docs)
-                logger.info(f"   ✅ Deleted batch {i//batch_size + 1}: {len(batch_docs)} documents")
-        
+        # Deletes are small, so they can use full 500-operation batches (Firestore limit)
+        delete_engine = FirestoreWriteEngine(self.db, batch_size=500, max_in_flight=self.write_concurrency)
+        try:
+            for collection_name in collections_to_clear:
+                logger.info(f"🗑️  Clearing {collection_name} collection...")
+                if collection_name == 'sources':
+                    # Parts subcollections and GCS shards are not removed with their source document
+                    parted = self.db.collection('sources').where('textStorage', 'in', ['parts', 'gcs']).stream()
+                    for snapshot in parted:
+                        self.source_text_store.delete(snapshot.reference, snapshot.to_dict())
+                deleted = delete_engine.delete_collection(self.db.collection(collection_name))
+                if not deleted:
+                    logger.info(f"   📭 {collection_name} collection is already empty")
+                    continue
+                logger.info(f"   ✅ Deleted {deleted:,} documents from {collection_name}")
+                total_deleted += deleted
+        finally:
+            delete_engine.close()
+
         logger.info(f"🗑️  Total documents deleted: {total_deleted}")
+
+        self.collections_cleared = True
+        if self.manifest is not None:
+            # Everything the manifest points at is gone, so every blob must be re-ingested
+            self.manifest.clear()
+            logger.info("🗑️  Ingest manifest cleared")
+        if self.ann_index is not None:
+            self.ann_index.reset()
+        if self.embedding_export is not None:
+            self.embedding_export.reset()
+
+    def _delete_documents(self, collection_name: str, doc_ids: List[str]):
+        """Delete documents by ID through the write engine and wait for them"""
+        collection_ref = self.db.collection(collection_name)
+        if collection_name == 'sources':
+            for doc_id in doc_ids:
+                self.source_text_store.delete(collection_ref.document(doc_id))
+        self.write_engine.wait([self.write_engine.delete(collection_ref.document(doc_id)) for doc_id in doc_ids])
+        if collection_name == 'embeddings' and self.ann_index is not None and doc_ids:
+            self.ann_index.remove(doc_ids)
+        if collection_name == 'embeddings' and self.embedding_export is not None and doc_ids:
+            self.embedding_export.remove(doc_ids)
     
     def generate_embedding(self, text: str) -> List[float]:
-        """Generate embedding using LangChain VertexAI embeddings with output_dimensionality"""
+        """Generate embedding using LangChain VertexAI embeddings with output_dimensionality, through the rate-limited batcher"""
         try:
-            embedding = self.embeddings.embed([text], dimensions=self.target_dimensions)[0]
+            embedding = self.batcher.embed([text])[0]
             actual_dim = len(embedding)
             if actual_dim != self.target_dimensions:
                 logger.warning(f"⚠️  Embedding dimension mismatch: requested {self.target_dimensions}, got {actual_dim}")
             else:
-                logger.info(f"✅ Embedding dimension: {actual_dim}")
+                logger.debug(f"✅ Embedding dimension: {actual_dim}")
             return embedding
         except Exception as e:
             logger.error(f"❌ Failed to generate embedding: {e}")
             raise
     
+    @property
+    def db(self):
+        """Firestore client, created on first use"""
+        with self._lazy_lock:
+            if self._db is None:
+                self._init_firebase()
+            return self._db
+
+    @property
+    def bucket(self):
+        """GCS bucket handle, created on first use"""
+        with self._lazy_lock:
+            if self._bucket is None:
+                self._bucket = self.storage_client.bucket(self.bucket_name)
+            return self._bucket
+
+    @property
+    def storage_client(self):
+        """GCS client, created on first use"""
+        with self._lazy_lock:
+            if self._storage_client is None:
+                self._init_storage()
+            return self._storage_client
+
+    @property
+    def source_text_store(self) -> SourceTextStore:
+        """Storage for source text too large for one document, set up on first use"""
+        with self._lazy_lock:
+            if self._source_text_store is None:
+                self._source_text_store = SourceTextStore(
+                    self.db, backend=self.source_storage, part_bytes=self.source_part_bytes, uri=self.source_text_uri,
+                    storage_client=self.storage_client if self.source_storage == 'gcs' else None,
+                    max_in_flight=self.write_concurrency, metrics=self.metrics
+                )
+            return self._source_text_store
+
+    @property
+    def embeddings(self):
+        """Vertex AI embeddings client, created on first use"""
+        with self._lazy_lock:
+            if self._embeddings is None:
+                self._init_langchain_embeddings()
+            return self._embeddings
+
+    @property
+    def text_splitter(self):
+        with self._lazy_lock:
+            if self._text_splitter is None:
+                self._init_text_splitter()
+            return self._text_splitter
+
+    @property
+    def json_splitter(self):
+        with self._lazy_lock:
+            if self._json_splitter is None:
+                self._init_json_splitter()
+            return self._json_splitter
+
+    @property
+    def write_engine(self) -> FirestoreWriteEngine:
+        """Parallel Firestore committer, started on the first write or delete"""
+        with self._lazy_lock:
+            if self._write_engine is None:
+                # Embedding documents carry large vectors, so keep 50 per batch to stay under the request size limit
+                self._write_engine = FirestoreWriteEngine(self.db, batch_size=50, max_in_flight=self.write_concurrency,
+                                                          max_ops_per_second=self.write_max_ops_per_second, metrics=self.metrics)
+            return self._write_engine
+
+    @property
+    def batcher(self) -> EmbeddingBatcher:
+        """Cross-file embedding request batcher, started on the first embedding request"""
+        with self._lazy_lock:
+            if self._batcher is None:
+                # Lingering only pays off when other files' chunks can arrive, i.e. in pipeline mode
+                self._batcher = EmbeddingBatcher(self.embeddings, self.target_dimensions, max_items=self.embed_batch_size,
+                                                 max_chars=self.embed_batch_chars, max_in_flight=self.embed_concurrency,
+                                                 linger_seconds=self.embed_linger_ms / 1000 if self.pipeline else 0.0,
+                                                 requests_per_minute=self.embed_rpm, tokens_per_minute=self.embed_tpm,
+                                                 metrics=self.metrics)
+            return self._batcher
+
+    @property
+    def process_pool(self) -> ProcessPoolExecutor:
+        """Process pool for CPU-bound extraction, created on first use"""
+        with self._process_pool_lock:
+            if self._process_pool is None:
+                # spawn rather than fork: the parent holds gRPC clients and pipeline threads
+                self._process_pool = ProcessPoolExecutor(
+                    max_workers=self.process_workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+                logger.info(f"⚙️  Process pool started with {self.process_workers} workers")
+            return self._process_pool
+
+    def _replace_process_pool(self, broken: ProcessPoolExecutor):
+        """Drop a pool whose worker died (e.g. killed by the OOM killer), so the next use starts a fresh one"""
+        with self._process_pool_lock:
+            if self._process_pool is broken:
+                broken.shutdown(wait=False, cancel_futures=True)
+                self._process_pool = None
+                logger.warning("⚠️  A process pool worker died, the pool will be restarted")
+
+    def close(self):
+        """Flush pending writes and release the process pool, the embedding batcher and the ingest manifest"""
+        with self._process_pool_lock:
+            if self._process_pool is not None:
+                self._process_pool.shutdown(cancel_futures=True)
+                self._process_pool = None
+        if self._write_engine is not None:
+            self._write_engine.close()
+        if self._batcher is not None:
+            self._batcher.close()
+        if self._source_text_store is not None:
+            self._source_text_store.close()
+        if self.manifest is not None:
+            self.manifest.close()
+        if self.checkpoint is not None:
+            self.checkpoint.close()
+        if self.embedding_cache is not None:
+            self.embedding_cache.close()
+        if self.ann_index is not None:
+            self.ann_index.close()
+        if self.embedding_export is not None:
+            self.embedding_export.close()
+        try:
+            self.metrics.close()
+        except OSError as e:
+            logger.warning(f"⚠️  Failed to write metrics: {e}")
+
     def extract_text_from_pdf(self, blob) -> str:
-        """Extract text from PDF blob"""
+        """
+        Extract text from PDF blob, pages are extracted in parallel on the process pool.
+        If a worker dies the pool is restarted and the PDF tried once more; a PDF that breaks the
+        pool again raises BrokenProcessPool, so the file fails instead of passing as empty.
+        """
+        fd, pdf_path = tempfile.mkstemp(suffix='.pdf')
+        os.close(fd)
         try:
-            pdf_content = blob.download_as_bytes()
-            pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_content))
-            
-            text = ""
-            for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
-            
-            return text.strip()
+            # Spool to disk so neither this process nor the workers hold the PDF bytes in memory
+            with self.metrics.timer('download'):
+                blob.download_to_filename(pdf_path)
+            for attempt in (1, 2):
+                pool = self.process_pool
+                try:
+                    with self.metrics.timer('extract'):
+                        pages = iter_pdf_pages(pdf_path, pool, page_timeout=self.pdf_page_timeout)
+                        return "\n".join(pages).strip()
+                except BrokenProcessPool:
+                    self._replace_process_pool(pool)
+                    if attempt == 2:
+                        raise
+                    logger.warning(f"⚠️  Process pool broke while extracting {blob.name}, retrying on a new pool")
+        except BrokenProcessPool:
+            raise
         except Exception as e:
             logger.warning(f"⚠️  Failed to extract text from PDF {blob.name}: {e}")
             return ""
+        finally:
+            os.unlink(pdf_path)
     
     def extract_text_from_file(self, blob) -> str:
         """Extract text from any file, including JSON"""
@@ -216,19 +2863,11 @@ class GeminiRAGPopulator:
             if file_name.endswith('.pdf'):
                 return self.extract_text_from_pdf(blob)
             elif file_name.endswith(('.txt', '.md', '.csv')):
-                return blob.download_as_text(encoding='utf-8')
+                with self.metrics.timer('download'):
+                    return blob.download_as_text(encoding='utf-8')
             elif file_name.endswith('.json'):
-                # Download and parse JSON
-                try:
-                    json_text = blob.download_as_text(encoding='utf-8')
-                    json_obj = json.loads(json_text)
-                    # Use RecursiveJSONSplitter to chunk JSON
-                    json_chunks = self.json_splitter.split_json(json_obj)
-                    # Join chunks as newline-separated strings for downstream chunking/embedding
-                    return '\n'.join([json.dumps(chunk, ensure_ascii=False) for chunk in json_chunks])
-                except Exception as e:
-                    logger.error(f"❌ Failed to parse or split JSON from {blob.name}: {e}")
-                    return ""
+                # Join chunks as newline-separated strings for the source document
+                return '\n'.join(self.extract_json_chunks(blob))
             elif file_name.endswith('.docx'):
                 # For now, return empty - would need python-docx
                 logger.warning(f"⚠️  DOCX files not supported yet: {blob.name}")
@@ -236,22 +2875,51 @@ class GeminiRAGPopulator:
             else:
                 logger.warning(f"⚠️  Unsupported file type: {blob.name}")
                 return ""
+        except BrokenProcessPool:
+            # Not an empty file: let the caller record it as failed
+            raise
         except Exception as e:
             logger.error(f"❌ Failed to extract text from {blob.name}: {e}")
             return ""
     
-    def split_text(self, text: str, file_name: Optional[str] = None) -> List[str]:
+    def extract_json_chunks(self, blob) -> List[str]:
+        """Download and parse a JSON file and chunk it with RecursiveJSONSplitter, one serialized chunk per string"""
+        try:
+            with self.metrics.timer('download'):
+                json_text = blob.download_as_text(encoding='utf-8')
+            with self.metrics.timer('extract'):
+                json_obj = json.loads(json_text)
+                json_chunks = self.json_splitter.split_json(json_obj)
+                # Serialized without indent, a chunk never contains a newline and is never blank
+                return [json.dumps(chunk, ensure_ascii=False) for chunk in json_chunks]
+        except Exception as e:
+            logger.error(f"❌ Failed to parse or split JSON from {blob.name}: {e}")
+            return []
+
+    def extract_and_split(self, blob) -> Tuple[str, List[str]]:
         """
-        Use LangChain's RecursiveCharacterTextSplitter for most files, but skip for JSON (already chunked)
+        Text of a file and its chunks. JSON chunks come straight from the JSON splitter instead of
+        being joined into the text and split on newlines again.
         """
+        if blob.name.lower().endswith('.json'):
+            chunks = self.extract_json_chunks(blob)
+            return '\n'.join(chunks), chunks
+        text = self.extract_text_from_file(blob)
+        return text, self.split_text(text, file_name=blob.name)
+
+    def split_text(self, text: str, file_name: Optional[str] = None) -> List[str]:
+        """Split text with the text splitter, but skip for JSON (already chunked)"""
         if not text or len(text.strip()) == 0:
             return []
         try:
-            # If file is .json, treat each line as a chunk (from extract_text_from_file)
-            if file_name and file_name.lower().endswith('.json'):
-                return [line for line in text.split('\n') if line.strip()]
-            # Otherwise, use text splitter
-            chunks = self.text_splitter.split_text(text)
+            with self.metrics.timer('split') as timed:
+                # If file is .json, treat each line as a chunk (from extract_text_from_file)
+                if file_name and file_name.lower().endswith('.json'):
+                    chunks = [line for line in text.split('\n') if line.strip()]
+                else:
+                    # Otherwise, use text splitter
+                    chunks = self.text_splitter.split_text(text)
+                timed['items'] = len(chunks)
             return chunks
         except Exception as e:
             logger.error(f"❌ Error in text splitting: {e}")
@@ -259,15 +2927,370 @@ class GeminiRAGPopulator:
     
 
     
-    def process_file(self, blob, file_index: int, total_files: int) -> Dict[str, Any]:
+    def _source_doc_id(self, blob_name: str) -> str:
+        """Deterministic source document ID derived from the file's identity (bucket and object name)"""
+        return hashlib.sha1(f"{self.bucket_name}/{blob_name}".encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _chunk_doc_id(source_doc_id: str, chunk_index: int) -> str:
+        """Deterministic embedding document ID, so re-running a file overwrites its chunks instead of duplicating them"""
+        return f"{source_doc_id}_chunk_{chunk_index}"
+
+    def _previous_source(self, blob) -> Optional[Dict[str, Any]]:
+        """
+        Fields of the file's source document from an earlier run (None if there is none), read before it is
+        overwritten. Incremental runs take the text layout from the manifest instead, so the document is only
+        read for entries written before layouts were recorded; other runs read it for its chunkCount too.
+        """
+        if self.collections_cleared:
+            return None
+        if self.manifest is not None:
+            entry = self._manifest_entry(blob)
+            if entry is None:
+                return None
+            if entry['text_layout'] is not None:
+                return entry['text_layout']
+        snapshot = self.db.collection('sources').document(self._source_doc_id(blob.name)).get()
+        return snapshot.to_dict() if snapshot.exists else None
+
+    def _manifest_entry(self, blob) -> Optional[Dict[str, Any]]:
+        """The blob's manifest entry as read when it was listed, or read now if it was not listed by this run"""
+        if blob.name in self._manifest_entries:
+            return self._manifest_entries[blob.name]
+        return self.manifest.get(self._manifest_key(blob.name))
+
+    def _remove_stale_chunks(self, source_doc_id: str, previous: Optional[Dict[str, Any]], chunk_ids: List[str]):
+        """
+        Delete chunks of the previous version of a file that this version did not overwrite (its tail when
+        the file shrank, or indices now left out as duplicates). Incremental runs do this through the manifest.
+        """
+        if self.manifest is not None or not previous:
+            return
+        written = set(chunk_ids)
+        stale = [chunk_id for chunk_id in (self._chunk_doc_id(source_doc_id, index) for index in range(previous.get('chunkCount') or 0))
+                 if chunk_id not in written]
+        if stale:
+            logger.info(f"   🗑️  Removing {len(stale)} chunks left from the previous version")
+            self._delete_documents('embeddings', stale)
+
+    def create_source_document(self, blob, text: Optional[str], previous: Optional[Dict[str, Any]] = None,
+                               chunk_count: int = 0):
+        """
+        Create the source document with FULL TEXT; text over 1MB goes to parts through the source text store.
+        Streamed files (text=None) start with a metadata-only document with status 'processing'; their text
+        is stored window by window through a SourceTextWriter and the document only gets its text fields
+        and status 'processed' once all chunks are written. Until then, or after a failed or interrupted
+        stream, readers see a 'processing' document with no text while some of its chunks already exist.
+        previous is the document as _previous_source read it. Returns the document reference and the
+        text fields written ({} for streamed files).
+
+        chunkCount is the chunk count of the new version (chunk_count) or of the previous one, whichever is
+        larger, until the new chunks commit: if this run fails, the next one still finds every chunk index
+        either version may have written when it removes stale chunks.
+        """
+        source_doc_ref = self.db.collection('sources').document(self._source_doc_id(blob.name))
+        chunk_count = max(chunk_count, (previous or {}).get('chunkCount') or 0)
+        if text is None:
+            source_doc_ref.set({
+                'fileName': blob.name,
+                'createdAt': _server_timestamp(self.db),
+                'status': 'processing',
+                'streamed': True,
+                'contentType': blob.content_type or 'application/octet-stream',
+                'fileSize': blob.size,
+                'chunkCount': chunk_count  # Raised as chunk groups commit past it, set when streaming finishes
+            })
+            return source_doc_ref, {}
+        source_doc_data = {
+            'fileName': blob.name,
+            'createdAt': _server_timestamp(self.db),
+            'status': 'processed',
+            'contentType': blob.content_type or 'application/octet-stream',
+            'fileSize': blob.size,
+            'chunkCount': chunk_count  # Set to this version's count once its chunks are written
+        }
+        text_fields = self.source_text_store.write(source_doc_ref, text, previous)
+        if text_fields['textStorage'] != 'inline':
+            logger.info(f"   📚 Text is {text_fields['textBytes'] / 1024 / 1024:.1f} MB, stored as "
+                        f"{text_fields['partCount']} {text_fields['textStorage']} parts")
+        source_doc_data.update(text_fields)
+        source_doc_ref.set(source_doc_data)
+        return source_doc_ref, text_fields
+
+    def embed_chunks(self, chunks: List[str]) -> List[List[float]]:
+        """Embed chunks, serving repeated content from the embedding cache so only misses reach Vertex AI"""
+        with self.metrics.timer('embed', len(chunks)):
+            return self._embed_chunks(chunks)
+
+    def _embed_chunks(self, chunks: List[str]) -> List[List[float]]:
+        if self.embedding_cache is None:
+            return self.batcher.embed(chunks)
+        cached = self.embedding_cache.get_many(chunks)
+        # Each distinct missing text is embedded once, even if it repeats within the file
+        missing = list(dict.fromkeys(chunk for chunk, embedding in zip(chunks, cached) if embedding is None))
+        generated = {}
+        if missing:
+            missing_embeddings = self.batcher.embed(missing)
+            self.embedding_cache.put_many(missing, missing_embeddings)
+            generated = dict(zip(missing, missing_embeddings))
+        with self.embedding_cache.lock:
+            self.embedding_cache.hits += len(chunks) - len(missing)
+            self.embedding_cache.misses += len(missing)
+        return [embedding if embedding is not None else generated[chunk] for chunk, embedding in zip(chunks, cached)]
+
+    def write_chunk_embeddings(self, source_doc_id: str, file_name: str, chunks: List[str], all_embeddings: List[List[float]],
+                               first_chunk_index: int = 0, total_chunks: Optional[int] = None,
+                               chunk_indices: Optional[List[int]] = None) -> List[str]:
+        """
+        Write embedding documents through the write engine and wait until they are committed,
+        so a file only counts as processed once its chunks are durable. Chunks are numbered from
+        first_chunk_index, or by chunk_indices when duplicates were left out. Streamed files write
+        their chunks in groups; their total is not known while streaming, so totalChunks is
+        omitted (the source document has chunkCount).
+        Returns the IDs of the embedding documents written, in chunk order.
+        """
+        write_start = time.perf_counter()
+        if chunk_indices is None:
+            chunk_indices = list(range(first_chunk_index, first_chunk_index + len(chunks)))
+        needs_matrix = (self.vector_encodings or self.matryoshka_dimensions or self.ann_index is not None
+                        or self.embedding_export is not None)
+        matrix = np.asarray(all_embeddings, dtype=np.float32) if chunks and needs_matrix else None
+        chunk_doc_ids, write_futures = self._submit_chunk_embeddings(source_doc_id, file_name, chunks, all_embeddings,
+                                                                     matrix, chunk_indices, total_chunks)
+        self.write_engine.wait(write_futures)
+        self.metrics.observe('write', time.perf_counter() - write_start, len(chunks))
+        if self.ann_index is not None and chunks:
+            # Only committed chunks are indexed
+            self.ann_index.add(chunk_doc_ids, matrix)
+        if self.embedding_export is not None and chunks:
+            self.embedding_export.add([
+                {'chunkId': chunk_id, 'sourceId': source_doc_id, 'fileName': file_name, 'chunkIndex': chunk_index,
+                 'totalChunks': total_chunks, 'text': chunk_text}
+                for chunk_id, chunk_index, chunk_text in zip(chunk_doc_ids, chunk_indices, chunks)
+            ], matrix)
+        if self.deduplicator is not None and chunks:
+            self.deduplicator.register(source_doc_id, chunk_doc_ids)
+        if chunks:
+            logger.info(f"     💾 Chunks committed: {len(chunks)} ({chunk_doc_ids[0]} to {chunk_doc_ids[-1]})")
+        return chunk_doc_ids
+
+    def _submit_chunk_embeddings(self, source_doc_id: str, file_name: str, chunks: List[str], all_embeddings: List[List[float]],
+                                 matrix: Optional[np.ndarray], chunk_indices: List[int],
+                                 total_chunks: Optional[int]) -> Tuple[List[str], List[Future]]:
+        """
+        Queue the embedding documents of one file's chunks on the write engine; returns their IDs and
+        write futures. matrix is all_embeddings as float32, needed only for compact encodings and
+        Matryoshka fields.
+        """
+        Vector = _vector_type(self.db)
+
+        chunk_doc_ids = []
+        write_futures = []
+        # Compact encodings are computed for the whole group at once
+        encoded = {}
+        if self.vector_encodings and chunks:
+            for encoding in self.vector_encodings:
+                encoded[encoding] = quantize_embeddings(matrix, encoding)
+        truncations = matryoshka_truncations(matrix, self.matryoshka_dimensions) if self.matryoshka_dimensions and chunks else {}
+        for position in range(len(chunks)):
+            chunk_index = chunk_indices[position]
+            chunk_text = chunks[position]
+            chunk_id = self._chunk_doc_id(source_doc_id, chunk_index)
+            embedding = Vector(all_embeddings[position])
+            if chunk_index % CHUNK_LOG_SAMPLE == 0 and logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"   🧩 Chunk {chunk_index + 1}/{total_chunks or '?'} ({len(chunk_text):,} chars, {len(embedding)}D embedding)")
+            embedding_doc_data = {
+                'text': chunk_text,
+                'fileName': file_name,
+                'sourceId': source_doc_id,
+                'chunkIndex': chunk_index,
+                'chunkSize': len(chunk_text),
+                'chunkId': chunk_id,
+                'createdAt': _server_timestamp(self.db),
+                'status': 'active'
+            }
+            if total_chunks is not None:
+                embedding_doc_data['totalChunks'] = total_chunks
+            if self.vector_storage == 'alongside':
+                embedding_doc_data['embedding'] = embedding
+            for size, truncated in truncations.items():
+                embedding_doc_data[matryoshka_field(size)] = Vector(truncated[position].tolist())
+            for encoding, (codes, scales) in encoded.items():
+                embedding_doc_data[VECTOR_ENCODING_FIELDS[encoding]] = codes[position].tobytes()
+                if scales is not None:
+                    embedding_doc_data[f"{VECTOR_ENCODING_FIELDS[encoding]}Scale"] = float(scales[position])
+            embedding_doc_ref = self.db.collection('embeddings').document(chunk_id)
+            write_futures.append(self.write_engine.set(embedding_doc_ref, embedding_doc_data))
+            chunk_doc_ids.append(embedding_doc_ref.id)
+        return chunk_doc_ids, write_futures
+
+    def _dedup_chunks(self, source_doc_id: str, chunks: List[str], first_chunk_index: int = 0) -> Tuple[List[int], Dict[str, str]]:
+        """Indices of the chunks to embed and write, and {chunk index: canonical chunk ID} for the duplicates"""
+        indices = list(range(first_chunk_index, first_chunk_index + len(chunks)))
+        if self.deduplicator is None:
+            return indices, {}
+        keep, duplicates = self.deduplicator.filter(source_doc_id, chunks, [self._chunk_doc_id(source_doc_id, index) for index in indices], indices)
+        if duplicates:
+            logger.info(f"   ♊ {len(duplicates)} of {len(chunks)} chunks duplicate existing chunks, not re-embedded")
+        # Firestore map keys must be strings
+        return [indices[position] for position in keep], {str(indices[position]): canonical for position, canonical in duplicates.items()}
+
+    def _duplicate_document(self, blob, start_time: float) -> Optional[Dict[str, Any]]:
+        """Files identical to one already processed in this run only get a source document pointing at it"""
+        if self.deduplicator is None:
+            return None
+        canonical_source_id = self.deduplicator.document(blob)
+        if canonical_source_id is None:
+            return None
+        source_doc_ref = self.db.collection('sources').document(self._source_doc_id(blob.name))
+        source_doc_ref.set({
+            'fileName': blob.name,
+            'createdAt': _server_timestamp(self.db),
+            'status': 'duplicate',
+            'duplicateOf': canonical_source_id,
+            'contentType': blob.content_type or 'application/octet-stream',
+            'fileSize': blob.size,
+            'chunkCount': 0
+        })
+        logger.info(f"   ♊ Identical to an already processed file (source {canonical_source_id}), skipped")
+        return {
+            'status': 'duplicate',
+            'chunks_created': 0,
+            'processing_time': time.time() - start_time,
+            'source_id': source_doc_ref.id,
+            'chunk_ids': []
+        }
+
+    @staticmethod
+    def _chunk_count_update(chunk_count: int, duplicates: Dict[str, str]) -> Dict[str, Any]:
+        update = {'chunkCount': chunk_count}
+        if duplicates:
+            update['duplicateChunks'] = duplicates
+        return update
+
+    def _should_stream(self, blob) -> bool:
+        """Large text-like files are streamed instead of being loaded whole"""
+        return (blob.size or 0) > self.stream_threshold_bytes and blob.name.lower().endswith(STREAMABLE_EXTENSIONS)
+
+    def process_file_streaming(self, blob) -> Dict[str, Any]:
+        """
+        Process a large text/CSV/JSON file with memory bounded independently of its size:
+        the blob is read in ranges, split with a windowed splitter, and chunks are embedded and
+        written in groups as they are produced. JSON is split as raw text on this path, since
+        RecursiveJsonSplitter needs the whole parsed document.
+        """
+        file_name = blob.name
+        start_time = time.time()
+        logger.info(f"   🌊 Streaming {file_name} in {self.stream_window_bytes // (1024 * 1024)} MB windows...")
+        try:
+            # Read before the metadata-only document replaces the fields that locate the previous parts and chunks
+            previous = self._previous_source(blob)
+            source_doc_ref, _ = self.create_source_document(blob, None, previous)
+            recorded_chunk_count = (previous or {}).get('chunkCount') or 0
+            text_writer = SourceTextWriter(self.source_text_store, source_doc_ref, previous)
+            # Chunk IDs are deterministic, so batches committed before an interruption need no re-embedding.
+            # Only the chunks they wrote count as written: indices left out as duplicates have no document.
+            resume_from, written, duplicates = self.checkpoint.resume_state(blob) if self.checkpoint is not None else (0, [], {})
+            if resume_from:
+                logger.info(f"   ⏯️  Resuming after {resume_from:,} chunks already done")
+            chunk_ids = [self._chunk_doc_id(source_doc_ref.id, i) for i in written]
+            chunks_done = resume_from
+            text_length = 0
+            embedding_dimensions = self.target_dimensions
+
+            def counted_windows():
+                nonlocal text_length
+                windows = iter_blob_text(blob, self.stream_window_bytes)
+                while True:
+                    with self.metrics.timer('download'):
+                        window = next(windows, None)
+                    if window is None:
+                        return
+                    text_length += len(window)
+                    # Windows before a resume point are read again anyway, so the stored text is always complete
+                    text_writer.append(window)
+                    yield window
+
+            group = []
+            chunk_stream = itertools.islice(iter_windowed_chunks(counted_windows(), self.text_splitter, self.metrics), resume_from, None)
+            while True:
+                chunk = next(chunk_stream, None)
+                if chunk is not None:
+                    group.append(chunk)
+                if group and (chunk is None or len(group) >= self.stream_chunk_group):
+                    keep_indices, group_duplicates = self._dedup_chunks(source_doc_ref.id, group, first_chunk_index=chunks_done)
+                    unique_chunks = [group[index - chunks_done] for index in keep_indices]
+                    if unique_chunks:
+                        group_embeddings = self.embed_chunks(unique_chunks)
+                        embedding_dimensions = len(group_embeddings[0])
+                        chunk_ids.extend(self.write_chunk_embeddings(source_doc_ref.id, file_name, unique_chunks, group_embeddings,
+                                                                     chunk_indices=keep_indices))
+                    duplicates.update(group_duplicates)
+                    chunks_done += len(group)
+                    if chunks_done > recorded_chunk_count:
+                        # Cover the indices written so far, in case the stream fails before it finishes
+                        source_doc_ref.update({'chunkCount': chunks_done})
+                        recorded_chunk_count = chunks_done
+                    if self.checkpoint is not None:
+                        self.checkpoint.record_batch(blob, chunks_done, keep_indices, group_duplicates)
+                    logger.info(f"   🌊 {chunks_done:,} chunks done ({text_length:,} chars read)")
+                    group = []
+                if chunk is None:
+                    break
+
+            text_fields = text_writer.close()
+            if not chunks_done:
+                source_doc_ref.update({'status': 'failed', 'error': 'No text extracted', 'chunkCount': 0, **text_fields})
+                self._remove_stale_chunks(source_doc_ref.id, previous, [])
+                return {
+                    'status': 'no_text',
+                    'chunks_created': 0,
+                    'processing_time': time.time() - start_time,
+                    'source_id': source_doc_ref.id,
+                    'chunk_ids': [],
+                    'text_layout': SourceTextStore.layout(text_fields)
+                }
+            logger.info(f"   📚 Text is {text_fields['textBytes'] / 1024 / 1024:.1f} MB, stored as "
+                        f"{text_fields.get('partCount', 1)} {text_fields['textStorage']} parts")
+            source_doc_ref.update({'status': 'processed', 'textLength': text_length, **text_fields,
+                                   **self._chunk_count_update(chunks_done, duplicates)})
+            self._remove_stale_chunks(source_doc_ref.id, previous, chunk_ids)
+            processing_time = time.time() - start_time
+            logger.info(f"   ✅ File streamed in {processing_time:.2f}s: {len(chunk_ids)} chunks, {text_length:,} chars")
+            return {
+                'status': 'success',
+                'chunks_created': len(chunk_ids),
+                'processing_time': processing_time,
+                'text_length': text_length,
+                'embedding_dimensions': embedding_dimensions,
+                'duplicate_chunks': len(duplicates),
+                'source_id': source_doc_ref.id,
+                'chunk_ids': chunk_ids,
+                'text_layout': SourceTextStore.layout(text_fields)
+            }
+        except Exception as e:
+            logger.error(f"   ❌ Failed to stream {file_name}: {e}")
+            return {
+                'status': 'error',
+                'error': str(e),
+                'chunks_created': 0,
+                'processing_time': time.time() - start_time
+            }
+
+    def process_file(self, blob, file_index: int, total_files: Optional[int] = None) -> Dict[str, Any]:
         """Process a single file and return processing stats"""
         file_name = blob.name
-        logger.info(f"📄 [{file_index}/{total_files}] Processing: {file_name}")
+        logger.info(f"📄 [{file_index}/{total_files if total_files else '?'}] Processing: {file_name}")
         start_time = time.time()
+        duplicate_result = self._duplicate_document(blob, start_time)
+        if duplicate_result is not None:
+            return duplicate_result
+        if self._should_stream(blob):
+            return self.process_file_streaming(blob)
         try:
             # Extract text
             logger.info(f"   📖 Extracting text...")
-            text = self.extract_text_from_file(blob)
+            text, chunks = self.extract_and_split(blob)
             if not text or len(text.strip()) == 0:
                 logger.warning(f"   ⚠️  No text extracted from {file_name}")
                 return {
@@ -278,55 +3301,10 @@ class GeminiRAGPopulator:
             logger.info(f"   📊 Extracted {len(text):,} characters")
             # Create source document with FULL TEXT, split if >1MB
             logger.info(f"   💾 Creating source document...")
-            source_doc_ref = self.db.collection('sources').document()
-            max_field_size = 1_000_000  # 1MB in bytes (safe margin for Firestore)
-            text_bytes = text.encode('utf-8')
-            if len(text_bytes) <= max_field_size:
-                # Store as single field
-                source_doc_data = {
-                    'fileName': file_name,
-                    'text': text,
-                    'createdAt': firestore.SERVER_TIMESTAMP,
-                    'status': 'processed',
-                    'contentType': blob.content_type or 'application/octet-stream',
-                    'fileSize': blob.size,
-                    'chunkCount': 0  # Will be updated after chunking
-                }
-            else:
-                # Split into multiple fields
-                logger.info(f"   ⚠️  Text exceeds 1MB, splitting into multiple fields...")
-                text_fields = {}
-                start = 0
-                idx = 1
-                while start < len(text_bytes):
-                    end = min(start + max_field_size, len(text_bytes))
-                    # Ensure we don't split in the middle of a multi-byte character
-                    chunk = text_bytes[start:end]
-                    # Try to decode, if fails, backtrack until valid
-                    while True:
-                        try:
-                            chunk_str = chunk.decode('utf-8')
-                            break
-                        except UnicodeDecodeError:
-                            chunk = chunk[:-1]
-                    text_fields[f'text{idx}'] = chunk_str
-                    start += len(chunk)
-                    idx += 1
-                source_doc_data = {
-                    'fileName': file_name,
-                    'createdAt': firestore.SERVER_TIMESTAMP,
-                    'status': 'processed',
-                    'contentType': blob.content_type or 'application/octet-stream',
-                    'fileSize': blob.size,
-                    'chunkCount': 0  # Will be updated after chunking
-                }
-                source_doc_data.update(text_fields)
-            source_doc_ref.set(source_doc_data)
+            previous = self._previous_source(blob)
+            source_doc_ref, text_fields = self.create_source_document(blob, text, previous, len(chunks))
             source_doc_id = source_doc_ref.id
             logger.info(f"   ✅ Source document created: {source_doc_id}")
-            # Chunking using RecursiveCharacterTextSplitter
-            logger.info(f"   🔪 Performing RecursiveCharacterTextSplitter chunking...")
-            chunks = self.split_text(text, file_name=file_name)
             if not chunks:
                 logger.error(f"   ❌ Text splitting failed for {file_name}")
                 # Update source document to reflect failure
@@ -335,71 +3313,43 @@ class GeminiRAGPopulator:
                     'error': 'Text splitting failed',
                     'chunkCount': 0
                 })
+                self._remove_stale_chunks(source_doc_id, previous, [])
                 return {
                     'status': 'chunking_failed',
                     'chunks_created': 0,
-                    'processing_time': time.time() - start_time
+                    'processing_time': time.time() - start_time,
+                    'source_id': source_doc_id,
+                    'chunk_ids': [],
+                    'text_layout': SourceTextStore.layout(text_fields)
                 }
             logger.info(f"   📋 Created {len(chunks)} text chunks")
-            # Batch embed chunks in groups of 100 (VertexAI API limit is 250, exclusive of 251)
-            logger.info(f"     🔢 Generating embeddings for {len(chunks)} chunks (batch size ≤ 100)...")
+            keep_indices, duplicates = self._dedup_chunks(source_doc_id, chunks)
+            unique_chunks = [chunks[index] for index in keep_indices]
+            logger.info(f"     🔢 Generating embeddings for {len(unique_chunks)} chunks (batch size ≤ {self.embed_batch_size})...")
             embedding_start = time.time()
-            all_embeddings = []
-            max_batch = 100
-            for batch_start in range(0, len(chunks), max_batch):
-                batch_chunks = chunks[batch_start:batch_start+max_batch]
-                batch_embeddings = self.embeddings.embed(batch_chunks, dimensions=self.target_dimensions)
-                # Check dimension for first batch only
-                if batch_embeddings:
-                    actual_dim = len(batch_embeddings[0])
-                    if actual_dim != self.target_dimensions:
-                        logger.warning(f"⚠️  Embedding dimension mismatch in batch: requested {self.target_dimensions}, got {actual_dim}")
-                    else:
-                        logger.info(f"✅ Embedding dimension in batch: {actual_dim}")
-                all_embeddings.extend(batch_embeddings)
+            all_embeddings = self.embed_chunks(unique_chunks) if unique_chunks else []
             embedding_time = time.time() - embedding_start
             logger.info(f"     ✅ Generated {len(all_embeddings)} embeddings in {embedding_time:.2f}s")
-            # Batch write embedding documents (max 50 per Firestore batch to avoid transaction size limits)
-            chunks_created = 0
-            batch_size = 50
-            total_chunks = len(chunks)
-            batch = self.db.batch()
-            for chunk_index in range(total_chunks):
-                chunk_text = chunks[chunk_index]
-                embedding = Vector(all_embeddings[chunk_index])
-                logger.info(f"   🧩 Processing chunk {chunk_index + 1}/{total_chunks} ({len(chunk_text):,} chars)")
-                logger.info(f"   🔎 Embedding length before Firestore write: {len(embedding)}")
-                embedding_doc_data = {
-                    'text': chunk_text,
-                    'embedding': embedding,
-                    'fileName': file_name,
-                    'sourceId': source_doc_id,
-                    'chunkIndex': chunk_index,
-                    'totalChunks': total_chunks,
-                    'chunkSize': len(chunk_text),
-                    'chunkId': f"{source_doc_id}_chunk_{chunk_index}",
-                    'createdAt': firestore.SERVER_TIMESTAMP,
-                    'status': 'active'
-                }
-                embedding_doc_ref = self.db.collection('embeddings').document()
-                batch.set(embedding_doc_ref, embedding_doc_data)
-                chunks_created += 1
-                # Commit every batch_size chunks
-                if (chunks_created % batch_size == 0) or (chunk_index == total_chunks - 1):
-                    batch.commit()
-                    logger.info(f"     💾 Batch committed: chunks {chunk_index - batch_size + 2} to {chunk_index + 1}")
-                    batch = self.db.batch()
+            chunk_ids = self.write_chunk_embeddings(source_doc_id, file_name, unique_chunks, all_embeddings,
+                                                    total_chunks=len(chunks), chunk_indices=keep_indices)
+            chunks_created = len(chunk_ids)
+            embedding_dimensions = len(all_embeddings[0]) if all_embeddings else self.target_dimensions
             # Update source document with chunk count
-            source_doc_ref.update({'chunkCount': chunks_created})
+            source_doc_ref.update(self._chunk_count_update(len(chunks), duplicates))
+            self._remove_stale_chunks(source_doc_id, previous, chunk_ids)
             processing_time = time.time() - start_time
             logger.info(f"   ✅ File processed in {processing_time:.2f}s")
-            logger.info(f"   📊 Summary: {chunks_created} chunks, {len(text):,} chars, {len(all_embeddings[0])}D embeddings")
+            logger.info(f"   📊 Summary: {chunks_created} chunks, {len(text):,} chars, {embedding_dimensions}D embeddings")
             return {
                 'status': 'success',
                 'chunks_created': chunks_created,
                 'processing_time': processing_time,
                 'text_length': len(text),
-                'embedding_dimensions': len(all_embeddings[0])
+                'embedding_dimensions': embedding_dimensions,
+                'duplicate_chunks': len(duplicates),
+                'source_id': source_doc_id,
+                'chunk_ids': chunk_ids,
+                'text_layout': SourceTextStore.layout(text_fields)
             }
         except Exception as e:
             logger.error(f"   ❌ Failed to process {file_name}: {e}")
@@ -409,103 +3359,1002 @@ class GeminiRAGPopulator:
                 'chunks_created': 0,
                 'processing_time': time.time() - start_time
             }
-    
-    def process_all_files(self):
-        """Process all files in the bucket"""
-        logger.info(f"🔍 Scanning bucket for files...")
-        
-        # List all files
-        blobs = list(self.bucket.list_blobs(prefix=self.bucket_prefix))
-        
-        # Filter out directories and hidden files
-        file_blobs = [blob for blob in blobs if not blob.name.endswith('/') and not blob.name.split('/')[-1].startswith('.')]
-        
-        logger.info(f"📊 Found {len(file_blobs)} files to process")
-        
-        if not file_blobs:
-            logger.warning("⚠️  No files found in bucket")
+
+    def _pipeline_extract(self, item: Dict[str, Any]):
+        """Pipeline stage 1: download, extract and split one file (large files are streamed end to end here)"""
+        item['result'] = self._duplicate_document(item['blob'], item['start_time'])
+        if item['result'] is not None:
             return
-        
-        # Process each file
+        if self._should_stream(item['blob']):
+            item['result'] = self.process_file_streaming(item['blob'])
+            return
+        text, chunks = self.extract_and_split(item['blob'])
+        if not text or len(text.strip()) == 0:
+            logger.warning(f"   ⚠️  No text extracted from {item['blob'].name}")
+            item['result'] = {
+                'status': 'no_text',
+                'chunks_created': 0,
+                'processing_time': time.time() - item['start_time']
+            }
+            return
+        item['text'] = text
+        item['chunks'] = chunks
+
+    def _pipeline_embed(self, item: Dict[str, Any]):
+        """Pipeline stage 2: drop duplicate chunks and generate embeddings for the rest"""
+        if item['chunks']:
+            keep_indices, item['duplicates'] = self._dedup_chunks(self._source_doc_id(item['blob'].name), item['chunks'])
+            item['unique_chunks'] = [item['chunks'][index] for index in keep_indices]
+            item['chunk_indices'] = keep_indices
+            item['embeddings'] = self.embed_chunks(item['unique_chunks']) if item['unique_chunks'] else []
+
+    def _pipeline_write(self, item: Dict[str, Any]):
+        """Pipeline stage 3: write the source document and chunk embeddings to Firestore"""
+        blob = item['blob']
+        text = item['text']
+        chunks = item['chunks']
+        previous = self._previous_source(blob)
+        source_doc_ref, text_fields = self.create_source_document(blob, text, previous, len(chunks))
+        if not chunks:
+            logger.error(f"   ❌ Text splitting failed for {blob.name}")
+            source_doc_ref.update({
+                'status': 'failed',
+                'error': 'Text splitting failed',
+                'chunkCount': 0
+            })
+            self._remove_stale_chunks(source_doc_ref.id, previous, [])
+            item['result'] = {
+                'status': 'chunking_failed',
+                'chunks_created': 0,
+                'processing_time': time.time() - item['start_time'],
+                'source_id': source_doc_ref.id,
+                'chunk_ids': [],
+                'text_layout': SourceTextStore.layout(text_fields)
+            }
+            return
+        all_embeddings = item['embeddings']
+        chunk_ids = self.write_chunk_embeddings(source_doc_ref.id, blob.name, item['unique_chunks'], all_embeddings,
+                                                total_chunks=len(chunks), chunk_indices=item['chunk_indices'])
+        source_doc_ref.update(self._chunk_count_update(len(chunks), item['duplicates']))
+        self._remove_stale_chunks(source_doc_ref.id, previous, chunk_ids)
+        item['result'] = {
+            'status': 'success',
+            'chunks_created': len(chunk_ids),
+            'processing_time': time.time() - item['start_time'],
+            'text_length': len(text),
+            'embedding_dimensions': len(all_embeddings[0]) if all_embeddings else self.target_dimensions,
+            'duplicate_chunks': len(item['duplicates']),
+            'source_id': source_doc_ref.id,
+            'chunk_ids': chunk_ids,
+            'text_layout': SourceTextStore.layout(text_fields)
+        }
+
+    def _pipeline_worker(self, stage_name: str, stage_fn, in_queue: queue.Queue, out_queue: queue.Queue, stage_state: Dict[str, Any]):
+        """Run one pipeline stage worker until the upstream stage signals completion"""
+        while True:
+            item = in_queue.get()
+            if item is _PIPELINE_DONE:
+                break
+            if item['result'] is None:
+                if 'start_time' not in item:
+                    item['start_time'] = time.time()
+                try:
+                    stage_fn(item)
+                except Exception as e:
+                    logger.error(f"   ❌ Failed to process {item['blob'].name} ({stage_name} stage): {e}")
+                    item['result'] = {
+                        'status': 'error',
+                        'error': str(e),
+                        'chunks_created': 0,
+                        'processing_time': time.time() - item['start_time']
+                    }
+            if item['result'] is not None and item['result']['status'] != 'success' and self.deduplicator is not None:
+                # Released here rather than by the collector, which may be waiting on these claims
+                self.deduplicator.release_source(self._source_doc_id(item['blob'].name))
+            if item['result'] is not None:
+                # Drop the bulky intermediates as soon as the file is finished
+                item['text'] = item['chunks'] = item['unique_chunks'] = item['embeddings'] = None
+            out_queue.put(item)
+        # The last worker of a stage to finish tells the downstream stage to stop
+        with stage_state['lock']:
+            stage_state['remaining'] -= 1
+            is_last = stage_state['remaining'] == 0
+        if is_last:
+            for _ in range(stage_state['downstream_workers']):
+                out_queue.put(_PIPELINE_DONE)
+
+    def _run_pipeline(self, file_blobs: Iterable[Any]) -> Iterator[Tuple[Any, Dict[str, Any]]]:
+        """
+        Process files through bounded queues so that download/extraction, embedding and
+        Firestore writes of different files overlap. Files are pulled from `file_blobs` only
+        as the first stage has room, so a paged listing is never held in memory.
+        Yields (blob, result) in file order.
+        """
+        stages = [
+            ('extract', self._pipeline_extract),
+            ('embed', self._pipeline_embed),
+            ('write', self._pipeline_write),
+        ]
+        # Bounded queues provide backpressure: at most a few files are buffered between stages
+        queues = [queue.Queue(maxsize=self.workers * 2) for _ in stages]
+        results_queue = queue.Queue()
+        queues.append(results_queue)
+        for (stage_name, _), stage_queue in zip(stages, queues):
+            self.metrics.register_gauge(f"pipeline_{stage_name}_queue", stage_queue.qsize)
+
+        threads = []
+        for stage_index, (stage_name, stage_fn) in enumerate(stages):
+            is_last_stage = stage_index == len(stages) - 1
+            stage_state = {
+                'lock': threading.Lock(),
+                'remaining': self.workers,
+                # The last stage tells the collector once every file has come through
+                'downstream_workers': 1 if is_last_stage else self.workers
+            }
+            for worker_index in range(self.workers):
+                thread = threading.Thread(
+                    target=self._pipeline_worker,
+                    args=(stage_name, stage_fn, queues[stage_index], queues[stage_index + 1], stage_state),
+                    name=f"rag-{stage_name}-{worker_index}",
+                    daemon=True
+                )
+                thread.start()
+                threads.append(thread)
+
+        listing = {'fed': 0, 'done': False, 'error': None}
+
+        def feed():
+            try:
+                for index, blob in enumerate(file_blobs):
+                    queues[0].put({'index': index, 'blob': blob, 'result': None, 'text': None, 'chunks': None,
+                                   'unique_chunks': None, 'chunk_indices': None, 'duplicates': None, 'embeddings': None})
+                    listing['fed'] = index + 1
+            except Exception as e:
+                logger.error(f"❌ Listing failed: {e}")
+                listing['error'] = e
+            finally:
+                listing['done'] = True
+                for _ in range(self.workers):
+                    queues[0].put(_PIPELINE_DONE)
+
+        feeder = threading.Thread(target=feed, name='rag-feeder', daemon=True)
+        feeder.start()
+
+        # Files finish out of order; hold the early finishers until the files before them are done
+        finished: Dict[int, Tuple[Any, Dict[str, Any]]] = {}
+        next_index = 0
+        completed = 0
+        while True:
+            item = results_queue.get()
+            if item is _PIPELINE_DONE:
+                break
+            result = item['result']
+            self._on_file_done(item['blob'], result)
+            completed += 1
+            listed = f"{listing['fed']}" if listing['done'] else f"{listing['fed']}+"
+            logger.info(f"📄 [{completed}/{listed}] {item['blob'].name}: {result['status']} ({result['processing_time']:.2f}s)")
+            finished[item['index']] = (item['blob'], result)
+            while next_index in finished:
+                yield finished.pop(next_index)
+                next_index += 1
+
+        feeder.join()
+        for thread in threads:
+            thread.join()
+        if listing['error'] is not None:
+            raise listing['error']
+
+    def _manifest_key(self, blob_name: str) -> str:
+        return f"{self.bucket_name}/{blob_name}"
+
+    def _blob_unchanged(self, blob, entry: Optional[Dict[str, Any]]) -> bool:
+        """Compare a listed blob with its manifest entry: content hash first, generation as a fallback"""
+        if entry is None or entry['dimensions'] != self.target_dimensions:
+            return False
+        if blob.md5_hash and entry['md5_hash']:
+            return blob.md5_hash == entry['md5_hash']
+        # Composite objects have no MD5, only CRC32C
+        if blob.crc32c and entry['crc32c']:
+            return blob.crc32c == entry['crc32c']
+        return blob.generation is not None and str(blob.generation) == entry['generation']
+
+    def _on_file_done(self, blob, result: Dict[str, Any]):
+        """Persist a finished file in the manifest and the run checkpoint"""
+        if self.deduplicator is not None:
+            if result['status'] == 'success':
+                self._settle_duplicates(blob, result)
+            if result['status'] == 'success':
+                self.deduplicator.register_document(blob, result['source_id'])
+            else:
+                self.deduplicator.release_source(self._source_doc_id(blob.name))
+        if self.manifest is not None:
+            self._update_manifest(blob, result)
+        if self.checkpoint is not None and result['status'] != 'error':
+            self.checkpoint.record_file(blob, result['status'], result['chunks_created'])
+
+    def _settle_duplicates(self, blob, result: Dict[str, Any]):
+        """Wait for the canonical chunks this file points at; write its own copies of any whose file failed"""
+        orphans = self.deduplicator.settle(result['source_id'])
+        if not orphans:
+            return
+        logger.warning(f"   ♊ {len(orphans)} chunks of {blob.name} duplicated chunks of a failed file, embedding them")
+        indices = sorted(orphans)
+        texts = [orphans[index] for index in indices]
+        try:
+            chunk_ids = self.write_chunk_embeddings(result['source_id'], blob.name, texts, self.embed_chunks(texts),
+                                                    chunk_indices=indices)
+            source_doc_ref = self.db.collection('sources').document(result['source_id'])
+            duplicates = source_doc_ref.get().to_dict().get('duplicateChunks', {})
+            source_doc_ref.update({'duplicateChunks': {index: canonical for index, canonical in duplicates.items()
+                                                       if int(index) not in orphans}})
+        except Exception as e:
+            logger.error(f"   ❌ Failed to write duplicate chunks of {blob.name}: {e}")
+            result.update({'status': 'error', 'error': str(e)})
+            return
+        result['chunk_ids'] = result['chunk_ids'] + chunk_ids
+        result['chunks_created'] += len(chunk_ids)
+        result['duplicate_chunks'] -= len(chunk_ids)
+
+    def _update_manifest(self, blob, result: Dict[str, Any]):
+        """Record a processed blob and remove the documents written for its previous version"""
+        previous = self._manifest_entry(blob)
+        self._manifest_entries.pop(blob.name, None)
+        if result['status'] == 'error':
+            # Leave the previous entry (and its documents) in place so the blob is retried next run
+            return
+        key = self._manifest_key(blob.name)
+        if previous is not None:
+            # New documents are already written, so the old version can go without a gap in search results
+            current_chunk_ids = set(result.get('chunk_ids', []))
+            stale_chunk_ids = [chunk_id for chunk_id in previous['chunk_ids'] if chunk_id not in current_chunk_ids]
+            self._delete_documents('embeddings', stale_chunk_ids)
+            if previous['source_id'] and previous['source_id'] != result.get('source_id'):
+                self._delete_documents('sources', [previous['source_id']])
+        self.manifest.put({
+            'name': key,
+            'generation': str(blob.generation) if blob.generation is not None else None,
+            'md5_hash': blob.md5_hash,
+            'crc32c': blob.crc32c,
+            'dimensions': self.target_dimensions,
+            'source_id': result.get('source_id'),
+            'chunk_ids': result.get('chunk_ids', []),
+            # Results without one wrote no source document, and a previous one was deleted above
+            'text_layout': result.get('text_layout', {})
+        })
+
+    def _remove_deleted_files(self, listed_names: set) -> int:
+        """Delete the documents of blobs (of this shard) that are in the manifest but no longer in the bucket"""
+        deleted = 0
+        for key in self.manifest.names(self._manifest_key(self.bucket_prefix)):
+            blob_name = key[len(self.bucket_name) + 1:]
+            if blob_name in listed_names or not self._in_shard(blob_name):
+                continue
+            entry = self.manifest.get(key)
+            logger.info(f"🗑️  Removing deleted file: {key} ({len(entry['chunk_ids'])} chunks)")
+            self._delete_documents('embeddings', entry['chunk_ids'])
+            if entry['source_id']:
+                self._delete_documents('sources', [entry['source_id']])
+            self.manifest.delete(key)
+            deleted += 1
+        return deleted
+
+    def _in_shard(self, blob_name: str) -> bool:
+        return self.shard is None or shard_of(blob_name, self.shard[1]) == self.shard[0]
+
+    def _iter_file_blobs(self) -> Iterator[Any]:
+        """Files under the prefix that belong to this worker's shard, listed one page at a time"""
+        pages = iter(self.bucket.list_blobs(prefix=self.bucket_prefix, page_size=self.list_page_size).pages)
+        while True:
+            with self.metrics.timer('list') as timed:
+                page = next(pages, None)
+                page_blobs = list(page) if page is not None else []
+                timed['items'] = len(page_blobs)
+            if page is None:
+                return
+            for blob in page_blobs:
+                # Skip directories, hidden files and other shards' objects
+                if blob.name.endswith('/') or blob.name.split('/')[-1].startswith('.') or not self._in_shard(blob.name):
+                    continue
+                yield blob
+
+    def _record_result(self, total_stats: Dict[str, Any], blob, result: Dict[str, Any]):
+        """Fold one file's result into the run statistics"""
+        total_stats['file_results'].append({'file': blob.name, **result})
+        if result['status'] == 'success':
+            total_stats['successful'] += 1
+            total_stats['total_chunks'] += result['chunks_created']
+        elif result['status'] == 'error':
+            total_stats['failed'] += 1
+            total_stats['failed_files'].append({'file': blob.name, 'error': result.get('error', 'Unknown error')})
+        elif result['status'] == 'no_text':
+            total_stats['no_text'] += 1
+        elif result['status'] == 'duplicate':
+            total_stats['duplicate_files'] += 1
+        elif result['status'] == 'chunking_failed':
+            total_stats['chunking_failed'] += 1
+            total_stats['failed_files'].append({'file': blob.name, 'error': 'Text splitting failed'})
+
+    def _build_ann_index(self) -> Optional[Dict[str, Any]]:
+        """Rebuild the local ANN index from this run's vectors (merged with the existing index when updating)"""
+        if self.ann_index is None:
+            return None
+        start = time.time()
+        try:
+            stats = self.ann_index.build()
+        except Exception as e:
+            logger.error(f"❌ Failed to build ANN index: {e}")
+            return None
+        logger.info(f"🧭 ANN index: {stats['vectors']:,} vectors in {stats['lists']:,} lists, "
+                    f"built in {time.time() - start:.1f}s ({stats['path']})")
+        return stats
+
+    def _flush_embedding_export(self) -> Optional[Dict[str, Any]]:
+        """Seal the rows still spooled for the embedding export into a last shard"""
+        if self.embedding_export is None:
+            return None
+        try:
+            self.embedding_export.flush()
+        except Exception as e:
+            logger.error(f"❌ Failed to write embedding export shard: {e}")
+            return None
+        return self.embedding_export.stats()
+
+    def process_all_files(self) -> Dict[str, Any]:
+        """Process all files in the bucket (or this worker's shard), consuming the listing page by page"""
+        shard_label = f"{self.shard[0]}/{self.shard[1]}" if self.shard is not None else None
+        logger.info(f"🔍 Scanning bucket for files" + (f" (shard {shard_label})" if shard_label else "") + "...")
+
         total_stats = {
-            'total_files': len(file_blobs),
+            'shard': shard_label,
+            'dimensions': self.target_dimensions,
+            'matryoshka_dimensions': self.matryoshka_dimensions,
+            'incremental': self.manifest is not None,
+            'listed_files': 0,
+            'total_files': 0,
             'successful': 0,
             'failed': 0,
             'no_text': 0,
             'chunking_failed': 0,
+            'duplicate_files': 0,
             'total_chunks': 0,
+            'unchanged_skipped': 0,
+            'deleted_files': 0,
+            'resumed_skipped': 0,
             'start_time': time.time(),
-            'failed_files': []  # List of dicts: {'file': ..., 'error': ...}
+            'failed_files': [],  # List of dicts: {'file': ..., 'error': ...}
+            'file_results': []  # Per-file results in listing order: {'file': ..., 'status': ..., ...}
         }
-        
-        for i, blob in enumerate(file_blobs, 1):
-            logger.info(f"\n{'='*100}")
-            logger.info(f"🎯 PROCESSING FILE {i}/{len(file_blobs)} ({i/len(file_blobs)*100:.1f}%)")
-            logger.info(f"📁 File: {blob.name}")
-            logger.info(f"📊 Size: {blob.size:,} bytes")
-            logger.info(f"⏱️  Estimated completion: {((time.time() - total_stats['start_time']) / i * (len(file_blobs) - i) / 60):.1f} minutes")
-            logger.info(f"{'='*100}")
-            
-            result = self.process_file(blob, i, len(file_blobs))
+        # Only names are kept (and only this shard's), to find manifest entries of deleted blobs at the end
+        listed_names: Optional[set] = set() if self.manifest is not None else None
+
+        def pending_blobs():
+            for blob in self._iter_file_blobs():
+                total_stats['listed_files'] += 1
+                if listed_names is not None:
+                    listed_names.add(blob.name)
+                    entry = self.manifest.get(self._manifest_key(blob.name))
+                    if self._blob_unchanged(blob, entry):
+                        total_stats['unchanged_skipped'] += 1
+                        continue
+                if self.checkpoint is not None and self.checkpoint.is_complete(blob):
+                    total_stats['resumed_skipped'] += 1
+                    continue
+                if listed_names is not None:
+                    self._manifest_entries[blob.name] = entry
+                total_stats['total_files'] += 1
+                yield blob
+
+        if self.pipeline:
+            for blob, result in self._run_pipeline(pending_blobs()):
+                self._record_result(total_stats, blob, result)
+        else:
+            for i, blob in enumerate(pending_blobs(), 1):
+                elapsed = time.time() - total_stats['start_time']
+                logger.info(f"\n{'='*100}")
+                logger.info(f"🎯 PROCESSING FILE {i} ({total_stats['listed_files']:,} listed so far)")
+                logger.info(f"📁 File: {blob.name}")
+                logger.info(f"📊 Size: {blob.size:,} bytes")
+                logger.info(f"⏱️  Average so far: {elapsed / max(i - 1, 1):.1f} seconds per file")
+                logger.info(f"{'='*100}")
+
+                result = self.process_file(blob, i)
+                self._on_file_done(blob, result)
+
+                # Update statistics
+                self._record_result(total_stats, blob, result)
+
+        logger.info(f"📊 Listed {total_stats['listed_files']:,} files" + (f" in shard {shard_label}" if shard_label else ""))
+        if self.manifest is not None:
+            # The listing is complete only now, so deleted blobs are found after the changed ones are written
+            total_stats['deleted_files'] = self._remove_deleted_files(listed_names)
+            logger.info(f"♻️  Incremental: {total_stats['total_files']} new or changed, "
+                        f"{total_stats['unchanged_skipped']} unchanged, {total_stats['deleted_files']} deleted")
+        if total_stats['resumed_skipped']:
+            logger.info(f"⏯️  Resume: {total_stats['resumed_skipped']} files already completed by the interrupted run")
+
+        if not total_stats['total_files']:
+            total_stats['end_time'] = time.time()
+            if not total_stats['listed_files']:
+                logger.warning("⚠️  No files found in bucket")
+            elif total_stats['unchanged_skipped']:
+                logger.info("✅ Nothing changed since the last run")
+            else:
+                logger.info("✅ All files were completed by the interrupted run")
+            if total_stats['deleted_files'] or total_stats['resumed_skipped']:
+                # Deleted vectors, or vectors spooled by the interrupted run, still need an index build
+                ann_stats = self._build_ann_index()
+                if ann_stats is not None:
+                    total_stats['ann_index'] = ann_stats
+            export_stats = self._flush_embedding_export()
+            if export_stats is not None:
+                total_stats['embedding_export'] = export_stats
+            return total_stats
+
+        # Stats of the clients this run actually built; reading them must not build the others
+        if self._write_engine is not None:
+            total_stats['firestore_writes'] = self._write_engine.stats()
+        batcher_stats = self._batcher.stats() if self._batcher is not None else None
+        if batcher_stats is not None:
+            total_stats['embedding_requests'] = batcher_stats
+        if self.deduplicator is not None:
+            dedup_stats = self.deduplicator.stats()
+            duplicate_chunks = dedup_stats['exact_duplicates'] + dedup_stats['near_duplicates']
+            # Requests saved are estimated at the average request size of this run
+            average_request = (batcher_stats or {}).get('avg_batch_size') or self.embed_batch_size
+            dedup_stats['embedding_requests_saved'] = math.ceil(duplicate_chunks / average_request)
+            dedup_stats['firestore_writes_saved'] = duplicate_chunks
+            total_stats['dedup'] = dedup_stats
+        if self.embedding_cache is not None:
+            total_stats['embedding_cache'] = self.embedding_cache.stats()
+        if self._source_text_store is not None:
+            total_stats['source_text'] = self._source_text_store.stats()
+        ann_stats = self._build_ann_index()
+        if ann_stats is not None:
+            total_stats['ann_index'] = ann_stats
+        export_stats = self._flush_embedding_export()
+        if export_stats is not None:
+            total_stats['embedding_export'] = export_stats
+        self.metrics.sample_gauges()
+        total_stats['metrics'] = self.metrics.snapshot()
+        total_stats['end_time'] = time.time()
+        log_run_summary(total_stats)
+        return total_stats
+
+    def import_embedding_shards(self, path: str, block_rows: int = 2000) -> Dict[str, Any]:
+        """
+        Bulk-write the embedding documents of an export (see EmbeddingExportWriter) through the write
+        engine, without calling the embedding API. Vectors exported at more dimensions than
+        target_dimensions are truncated and re-normalized; --vector-encodings and --vector-storage
+        apply as in a normal run. Only the embeddings collection is written.
+        """
+        reader = EmbeddingShardReader(path)
+        if reader.dimensions < self.target_dimensions:
+            raise ValueError(f"export has {reader.dimensions}-dimensional vectors, fewer than the {self.target_dimensions} requested")
+        logger.info(f"📥 Importing {len(reader.shards):,} shards of {reader.dimensions}D embeddings from {path}"
+                    + (f", truncated to {self.target_dimensions}D" if reader.dimensions > self.target_dimensions else ""))
+        stats = {'shards': len(reader.shards), 'rows_read': 0, 'imported': 0, 'superseded': 0,
+                 'dimensions': self.target_dimensions, 'start_time': time.time()}
+        pending: Tuple[List[str], List[Future], Optional[np.ndarray]] = ([], [], None)
+
+        def settle(block: Tuple[List[str], List[Future], Optional[np.ndarray]]):
+            chunk_ids, futures, vectors = block
+            self.write_engine.wait(futures)
+            if self.ann_index is not None and chunk_ids:
+                self.ann_index.add(chunk_ids, vectors)
+            stats['imported'] += len(chunk_ids)
+
+        for shard, rows, vectors in reader.iter_live():
+            stats['rows_read'] += shard['rows']
+            stats['superseded'] += shard['rows'] - len(rows)
+            if reader.dimensions > self.target_dimensions:
+                vectors = _normalize_rows(vectors[:, :self.target_dimensions]).astype(np.float32)
+            for start in range(0, len(rows), block_rows):
+                block, block_vectors = rows[start:start + block_rows], vectors[start:start + block_rows]
+                chunk_ids, futures = [], []
+                # Consecutive rows of one file were exported by one write, so they share their file fields
+                for (source_id, file_name, total_chunks), group in itertools.groupby(
+                        range(len(block)), key=lambda i: (block[i]['sourceId'], block[i]['fileName'], block[i]['totalChunks'])):
+                    group = list(group)
+                    group_vectors = block_vectors[group]
+                    group_ids, group_futures = self._submit_chunk_embeddings(
+                        source_id, file_name, [block[i]['text'] for i in group], group_vectors.tolist(), group_vectors,
+                        [block[i]['chunkIndex'] for i in group], total_chunks)
+                    chunk_ids.extend(group_ids)
+                    futures.extend(group_futures)
+                # The previous block is waited for only now, so the write engine is never drained between blocks
+                settle(pending)
+                pending = (chunk_ids, futures, block_vectors)
+            logger.info(f"   💾 {shard['name']}: {len(rows):,} of {shard['rows']:,} rows live")
+        settle(pending)
+        stats['end_time'] = time.time()
+        if self._write_engine is not None:
+            stats['firestore_writes'] = self._write_engine.stats()
+        ann_stats = self._build_ann_index()
+        if ann_stats is not None:
+            stats['ann_index'] = ann_stats
+        elapsed = stats['end_time'] - stats['start_time']
+        logger.info(f"📥 Imported {stats['imported']:,} embedding documents from {stats['shards']:,} shards in {elapsed:.1f}s "
+                    f"({stats['imported'] / elapsed if elapsed > 0 else 0.0:.0f} docs/sec); "
+                    f"{stats['superseded']:,} superseded or removed rows skipped")
+        return stats
+
+
+def log_run_summary(total_stats: Dict[str, Any]):
+    """Log the end-of-run summary of one worker's statistics, or of several merged with merge_run_stats"""
+    total_time = total_stats['end_time'] - total_stats['start_time']
+    logger.info(f"\n{'='*100}")
+    logger.info(f"🏁 PROCESSING COMPLETE - RECURSIVE CHARACTER TEXT SPLITTER WITH GEMINI-EMBEDDING-001")
+    logger.info(f"{'='*100}")
+    if total_stats.get('workers'):
+        logger.info(f"🧱 Workers merged: {total_stats['workers']} (shards {', '.join(str(shard) for shard in total_stats['shards'])})")
+    elif total_stats.get('shard'):
+        logger.info(f"🧱 Shard: {total_stats['shard']}")
+    logger.info(f"📊 Total files processed: {total_stats['total_files']}")
+    logger.info(f"✅ Successful: {total_stats['successful']}")
+    logger.info(f"❌ Failed: {total_stats['failed']}")
+    logger.info(f"📝 No text: {total_stats['no_text']}")
+    logger.info(f"🔪 Chunking failed: {total_stats['chunking_failed']}")
+    if 'dedup' in total_stats:
+        logger.info(f"♊ Duplicate files (skipped): {total_stats['duplicate_files']}")
+    if total_stats['resumed_skipped']:
+        logger.info(f"⏯️  Completed by the interrupted run (skipped): {total_stats['resumed_skipped']}")
+    if total_stats.get('incremental'):
+        logger.info(f"♻️  Unchanged (skipped): {total_stats['unchanged_skipped']}")
+        logger.info(f"🗑️  Deleted from bucket: {total_stats['deleted_files']}")
+    logger.info(f"🧩 Total chunks created: {total_stats['total_chunks']:,}")
+    logger.info(f"🎯 Embedding dimensions: {total_stats['dimensions']}")
+    if total_stats.get('matryoshka_dimensions'):
+        logger.info(f"🪆 Matryoshka fields: {', '.join(matryoshka_field(size) for size in total_stats['matryoshka_dimensions'])} "
+                    f"(same embedding request, re-normalized prefixes)")
+    logger.info(f"⏱️  Total processing time: {total_time/60:.1f} minutes")
+    logger.info(f"📈 Average time per file: {total_time/max(total_stats['total_files'], 1):.1f} seconds")
+    logger.info(f"🔢 Average chunks per file: {total_stats['total_chunks']/max(total_stats['successful'], 1):.1f}")
+    logger.info(f"💾 Sources collection: Full text stored for each file (parts for text over 1MB, streamed files included)")
+    logger.info(f"🔍 Embeddings collection: RecursiveCharacterTextSplitter chunks with {total_stats['dimensions']}D vectors")
+    logger.info(f"🤖 Model: gemini-embedding-001 via LangChain VertexAI")
+    if 'firestore_writes' in total_stats:
+        write_stats = total_stats['firestore_writes']
+        logger.info(f"💾 Firestore writes: {write_stats['writes']:,} written, {write_stats['deletes']:,} deleted in "
+                    f"{write_stats['batches']:,} batches ({write_stats['retries']:,} retries, {write_stats['failures']:,} failed), "
+                    f"{write_stats['ops_per_sec']:.1f} ops/sec")
+    if 'embedding_requests' in total_stats:
+        batcher_stats = total_stats['embedding_requests']
+        logger.info(f"📦 Embedding requests: {batcher_stats['requests']:,} ({batcher_stats['avg_batch_size']:.1f} chunks avg, "
+                    f"{batcher_stats['retries']:,} retries), {batcher_stats['chunks_per_sec']:.1f} chunks/sec")
+        if batcher_stats.get('rate_limited') or batcher_stats.get('throttled_requests'):
+            logger.info(f"🚦 Quota: {batcher_stats['rate_limited']:,} rate-limited requests, {batcher_stats['requeued']:,} chunks requeued, "
+                        f"{batcher_stats['failed_chunks']:,} failed; {batcher_stats['throttled_requests']:,} requests waited "
+                        f"on the rpm/tpm budgets ({batcher_stats['throttled_seconds']:.1f}s summed)")
+    if 'dedup' in total_stats:
+        dedup_stats = total_stats['dedup']
+        logger.info(f"♊ Dedup: {dedup_stats['exact_duplicates']:,} exact + {dedup_stats['near_duplicates']:,} near-duplicate "
+                    f"of {dedup_stats['chunks_checked']:,} chunks; {dedup_stats['bytes_saved'] / 1024 / 1024:.1f} MB not embedded, "
+                    f"~{dedup_stats['embedding_requests_saved']:,} embedding requests and "
+                    f"{dedup_stats['firestore_writes_saved']:,} Firestore writes saved; "
+                    f"{dedup_stats['duplicate_documents']:,} identical files ({dedup_stats['document_bytes_saved'] / 1024 / 1024:.1f} MB) skipped")
+    if 'embedding_cache' in total_stats:
+        cache_stats = total_stats['embedding_cache']
+        logger.info(f"🗃️  Embedding cache: {cache_stats['hits']:,} hits, {cache_stats['misses']:,} misses "
+                    f"({cache_stats['hit_rate']*100:.1f}% hit rate), {cache_stats['evictions']:,} evicted, "
+                    f"{cache_stats['size_bytes'] / 1024 / 1024:.1f} MB")
+    if total_stats.get('source_text', {}).get('parted_documents'):
+        text_stats = total_stats['source_text']
+        logger.info(f"📚 Large sources: {text_stats['parted_documents']:,} stored as {text_stats['parts_written']:,} "
+                    f"parts in {text_stats['backend']} ({text_stats['bytes_stored'] / 1024 / 1024:.1f} MB)")
+    if total_stats.get('embedding_export', {}).get('rows'):
+        export_stats = total_stats['embedding_export']
+        logger.info(f"📤 Embedding export: {export_stats['rows']:,} rows in {export_stats['shards']:,} {export_stats['format']} "
+                    f"shards ({export_stats['bytes'] / 1024 / 1024:.1f} MB)" + (f" in {export_stats['path']}" if 'path' in export_stats else ""))
+    if 'metrics' in total_stats:
+        metrics_snapshot = total_stats['metrics']
+        logger.info(f"⏱️  Stage timings (summed over threads):")
+        for stage_name, stage in sorted(metrics_snapshot['stages'].items(), key=lambda entry: -entry[1]['seconds']):
+            logger.info(f"   {stage_name:<14} {stage['seconds']:>9.1f}s ({stage['share_of_wall']*100:5.1f}% of wall) "
+                        f"{stage['calls']:>7,} calls, {stage['items_per_sec']:>9.1f} items/sec, "
+                        f"p50 {stage['p50']*1000:.1f} ms, p99 {stage['p99']*1000:.1f} ms")
+        for queue_name, depth in metrics_snapshot['queues'].items():
+            logger.info(f"   📥 {queue_name}: max depth {depth['max']:g}, mean {depth['mean']:.1f}")
+    if total_stats['failed_files']:
+        logger.info(f"\n❌ Failed files:")
+        for fail in total_stats['failed_files']:
+            logger.info(f"   - {fail['file']}: {fail['error']}")
+    logger.info(f"{'='*100}")
+
+
+# Run counters that add up across the workers of a sharded run
+RUN_COUNTERS = ('listed_files', 'total_files', 'successful', 'failed', 'no_text', 'chunking_failed', 'duplicate_files',
+                'total_chunks', 'unchanged_skipped', 'deleted_files', 'resumed_skipped')
+
+
+def merge_run_stats(stats_list: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Combine the --stats-out files of the workers of a sharded run into one set of run statistics.
+    Counters are summed, and rates are recomputed over the combined wall time (first start to last end).
+    """
+    start_time = min(stats['start_time'] for stats in stats_list)
+    end_time = max(stats.get('end_time', stats['start_time']) for stats in stats_list)
+    wall_seconds = end_time - start_time
+    merged: Dict[str, Any] = {key: sum(stats.get(key, 0) for stats in stats_list) for key in RUN_COUNTERS}
+    merged.update({
+        'workers': len(stats_list),
+        'shards': sorted(stats.get('shard') or '-' for stats in stats_list),
+        'dimensions': stats_list[0].get('dimensions'),
+        'matryoshka_dimensions': stats_list[0].get('matryoshka_dimensions'),
+        'incremental': any(stats.get('incremental') for stats in stats_list),
+        'start_time': start_time,
+        'end_time': end_time,
+        'failed_files': [fail for stats in stats_list for fail in stats.get('failed_files', [])],
+        'file_results': [result for stats in stats_list for result in stats.get('file_results', [])]
+    })
+
+    def summed(section: str, keys: Tuple[str, ...]) -> Optional[Dict[str, Any]]:
+        parts = [stats[section] for stats in stats_list if section in stats]
+        return {key: sum(part.get(key, 0) for part in parts) for key in keys} if parts else None
+
+    write_stats = summed('firestore_writes', ('writes', 'deletes', 'batches', 'retries', 'failures'))
+    if write_stats is not None:
+        write_stats['ops_per_sec'] = (write_stats['writes'] + write_stats['deletes']) / wall_seconds if wall_seconds > 0 else 0.0
+        merged['firestore_writes'] = write_stats
+    batcher_stats = summed('embedding_requests', ('requests', 'chunks', 'retries', 'batch_shrinks', 'rate_limited',
+                                                  'requeued', 'failed_chunks', 'throttled_requests', 'throttled_seconds'))
+    if batcher_stats is not None:
+        batcher_stats['avg_batch_size'] = batcher_stats['chunks'] / batcher_stats['requests'] if batcher_stats['requests'] else 0.0
+        batcher_stats['chunks_per_sec'] = batcher_stats['chunks'] / wall_seconds if wall_seconds > 0 else 0.0
+        merged['embedding_requests'] = batcher_stats
+    # Each worker deduplicates within its own shard only
+    dedup_stats = summed('dedup', ('chunks_checked', 'exact_duplicates', 'near_duplicates', 'bytes_saved',
+                                   'duplicate_documents', 'document_bytes_saved', 'embedding_requests_saved',
+                                   'firestore_writes_saved'))
+    if dedup_stats is not None:
+        merged['dedup'] = dedup_stats
+    cache_stats = summed('embedding_cache', ('hits', 'misses', 'evictions'))
+    if cache_stats is not None:
+        lookups = cache_stats['hits'] + cache_stats['misses']
+        cache_stats['hit_rate'] = cache_stats['hits'] / lookups if lookups else 0.0
+        # Workers on one machine may share the cache file, so sizes are not added up
+        cache_stats['size_bytes'] = max(stats['embedding_cache']['size_bytes'] for stats in stats_list if 'embedding_cache' in stats)
+        merged['embedding_cache'] = cache_stats
+    text_stats = summed('source_text', ('parted_documents', 'parts_written', 'bytes_stored'))
+    if text_stats is not None:
+        text_stats['backend'] = next(stats['source_text']['backend'] for stats in stats_list if 'source_text' in stats)
+        merged['source_text'] = text_stats
+    # Each worker exports to its own directory (see shard_path)
+    export_stats = summed('embedding_export', ('rows', 'shards', 'bytes'))
+    if export_stats is not None:
+        export_stats['format'] = next(stats['embedding_export']['format'] for stats in stats_list if 'embedding_export' in stats)
+        merged['embedding_export'] = export_stats
+    snapshots = [stats['metrics'] for stats in stats_list if 'metrics' in stats]
+    if snapshots:
+        merged['metrics'] = RunMetrics.merge(snapshots, wall_seconds)
+    return merged
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """argparse type for --shard i/N, with 0 <= i < N"""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N (e.g. 0/4), got {value!r}")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must be between 0 and {count - 1}, got {value!r}")
+    return index, count
+
+
+def shard_path(path: str, shard: Tuple[int, int]) -> str:
+    """Per-worker variant of a local output path: rag_checkpoint.jsonl -> rag_checkpoint.shard-0-of-4.jsonl"""
+    root, extension = os.path.splitext(path.rstrip('/'))
+    return f"{root}.shard-{shard[0]}-of-{shard[1]}{extension}"
+
+
+def write_stats_file(path: str, total_stats: Dict[str, Any]):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(total_stats, f, default=str)
+    os.replace(tmp_path, path)
+    logger.info(f"📝 Run statistics written to {path}")
+
+
+def merge_stats_files(paths: List[str], output_path: Optional[str] = None) -> Dict[str, Any]:
+    """Coordinator step of a sharded run: load the workers' --stats-out files and log one combined summary"""
+    stats_list = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            stats_list.append(json.load(f))
+    shards = [stats.get('shard') for stats in stats_list if stats.get('shard')]
+    if shards:
+        count = int(shards[0].split('/')[1])
+        missing = sorted(set(range(count)) - {int(shard.split('/')[0]) for shard in shards})
+        if missing:
+            logger.warning(f"⚠️  No statistics for shards {', '.join(f'{index}/{count}' for index in missing)}")
+        if len(set(shards)) < len(shards):
+            logger.warning(f"⚠️  Some shards appear more than once: {', '.join(sorted(shards))}")
+    merged = merge_run_stats(stats_list)
+    log_run_summary(merged)
+    if output_path:
+        write_stats_file(output_path, merged)
+    return merged
+
+
+def build_backends(args, local_storage_root: Optional[str] = None) -> Dict[str, Any]:
+    """Local stand-ins selected on the command line, injected into the populator in place of the cloud clients"""
+    backends = {}
+    if args.storage_backend == 'local' or local_storage_root or args.embedding_backend == 'hash' or args.firestore_mode == 'memory':
+        import rag_local_backends
+    if args.storage_backend == 'local' or local_storage_root:
+        backends['storage_client'] = rag_local_backends.LocalStorageClient(local_storage_root or args.local_storage_root)
+    if args.embedding_backend == 'hash':
+        backends['embeddings'] = rag_local_backends.HashEmbeddings(
+            latency_ms=args.fake_embed_latency_ms, per_text_latency_ms=args.fake_embed_per_text_ms,
+            rate_limit_rpm=args.fake_embed_rpm, rate_limit_tpm=args.fake_embed_tpm, error_rate=args.fake_embed_error_rate
+        )
+    if args.firestore_mode == 'memory':
+        backends['db'] = rag_local_backends.MemoryFirestore(commit_latency_ms=args.fake_commit_latency_ms)
+    return backends
+
+
+def run_benchmark(args, populator_kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Populate from a synthetic corpus with local backends (directory bucket, hash embedder and,
+    unless --firestore-mode emulator, in-memory Firestore) and report files/sec, chunks/sec and
+    per-stage latency percentiles. Every other option applies as in a normal run, so
+    configurations can be compared offline.
+    """
+    import rag_local_backends
+
+    args.embedding_backend = 'hash'
+    if args.firestore_mode == 'cloud':
+        args.firestore_mode = 'memory'
+    populator_kwargs = {**populator_kwargs, 'firestore_mode': args.firestore_mode, 'checkpoint_path': None, 'resume': False}
+    with tempfile.TemporaryDirectory(prefix='rag-benchmark-') as corpus_root:
+        start = time.time()
+        corpus = rag_local_backends.generate_synthetic_corpus(corpus_root, 'benchmark', 'corpus', args.benchmark_files,
+                                                              args.benchmark_file_kb, seed=args.benchmark_seed)
+        logger.info(f"🧪 Synthetic corpus: {corpus['files']:,} files, {corpus['bytes'] / 1024 / 1024:.1f} MB "
+                    f"(generated in {time.time() - start:.1f}s)")
+        populator = GeminiRAGPopulator('gs://benchmark/corpus', args.dimensions, **populator_kwargs,
+                                       **build_backends(args, local_storage_root=corpus_root))
+        try:
+            if args.clear_collections:
+                populator.clear_collections()
+            start = time.time()
+            total_stats = populator.process_all_files() or {}
+            elapsed = time.time() - start
+            metrics = populator.metrics.snapshot()
+        finally:
+            populator.close()
+
+    chunks = total_stats.get('total_chunks', 0)
+    report = {
+        'files': corpus['files'],
+        'bytes': corpus['bytes'],
+        'seconds': elapsed,
+        'files_per_sec': corpus['files'] / elapsed if elapsed > 0 else 0.0,
+        'chunks': chunks,
+        'chunks_per_sec': chunks / elapsed if elapsed > 0 else 0.0,
+        'mb_per_sec': corpus['bytes'] / 1024 / 1024 / elapsed if elapsed > 0 else 0.0,
+        'failed': total_stats.get('failed', 0),
+        'embedding_requests': total_stats.get('embedding_requests', {}),
+        'stages': {name: {key: stage[key] for key in ('calls', 'items', 'seconds', 'p50', 'p90', 'p99', 'max')}
+                   for name, stage in metrics['stages'].items()},
+        'queues': metrics['queues']
+    }
+    logger.info(f"\n🧪 BENCHMARK: {report['files_per_sec']:.1f} files/sec, {report['chunks_per_sec']:.1f} chunks/sec, "
+                f"{report['mb_per_sec']:.2f} MB/sec ({chunks:,} chunks in {elapsed:.1f}s, {report['failed']} failed)")
+    logger.info(f"   {'stage':<14} {'calls':>7} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, stage in sorted(report['stages'].items()):
+        logger.info(f"   {name:<14} {stage['calls']:>7,} {stage['p50']*1000:>9.2f} {stage['p99']*1000:>9.2f} {stage['max']*1000:>9.2f}")
+    if args.benchmark_output:
+        with open(args.benchmark_output, 'w') as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"💾 Benchmark report written to {args.benchmark_output}")
+    return report
 
-            # Update statistics
-            if result['status'] == 'success':
-                total_stats['successful'] += 1
-                total_stats['total_chunks'] += result['chunks_created']
-            elif result['status'] == 'error':
-                total_stats['failed'] += 1
-                total_stats['failed_files'].append({'file': blob.name, 'error': result.get('error', 'Unknown error')})
-            elif result['status'] == 'no_text':
-                total_stats['no_text'] += 1
-            elif result['status'] == 'chunking_failed':
-                total_stats['chunking_failed'] += 1
-                total_stats['failed_files'].append({'file': blob.name, 'error': 'Text splitting failed'})
-        
-        # Final summary (moved inside method for correct scope)
-        total_time = time.time() - total_stats['start_time']
-        logger.info(f"\n{'='*100}")
-        logger.info(f"🏁 PROCESSING COMPLETE - RECURSIVE CHARACTER TEXT SPLITTER WITH GEMINI-EMBEDDING-001")
-        logger.info(f"{'='*100}")
-        logger.info(f"📊 Total files processed: {total_stats['total_files']}")
-        logger.info(f"✅ Successful: {total_stats['successful']}")
-        logger.info(f"❌ Failed: {total_stats['failed']}")
-        logger.info(f"📝 No text: {total_stats['no_text']}")
-        logger.info(f"🔪 Chunking failed: {total_stats['chunking_failed']}")
-        logger.info(f"🧩 Total chunks created: {total_stats['total_chunks']:,}")
-        logger.info(f"🎯 Embedding dimensions: {self.target_dimensions}")
-        logger.info(f"⏱️  Total processing time: {total_time/60:.1f} minutes")
-        logger.info(f"📈 Average time per file: {total_time/total_stats['total_files']:.1f} seconds")
-        logger.info(f"🔢 Average chunks per file: {total_stats['total_chunks']/max(total_stats['successful'], 1):.1f}")
-        logger.info(f"💾 Sources collection: Full text stored for each file")
-        logger.info(f"🔍 Embeddings collection: RecursiveCharacterTextSplitter chunks with {self.target_dimensions}D vectors")
-        logger.info(f"🤖 Model: gemini-embedding-001 via LangChain VertexAI")
-        if total_stats['failed_files']:
-            logger.info(f"\n❌ Failed files:")
-            for fail in total_stats['failed_files']:
-                logger.info(f"   - {fail['file']}: {fail['error']}")
-        logger.info(f"{'='*100}")
 
 def main():
     parser = argparse.ArgumentParser(description='Populate RAG with gemini-embedding-001 and configurable dimensions')
-    parser.add_argument('bucket_path', help='GCS bucket path (e.g., gs://bucket_name/path/)')
-    parser.add_argument('--dimensions', type=int, default=1536, help='Target embedding dimensions (max 3072)')
+    parser.add_argument('bucket_path', nargs='?', help='GCS bucket path (e.g., gs://bucket_name/path/)')
+    parser.add_argument('--dimensions', type=int, default=None, help='Target embedding dimensions (max 3072; default: 1536, or the exported size with --import-shards)')
+    parser.add_argument('--matryoshka-dimensions', default='', help='Comma-separated smaller sizes (e.g. 256,768) also stored as re-normalized prefixes of each embedding, in embedding{N} fields')
     parser.add_argument('--clear-collections', action='store_true', help='Clear existing collections before processing')
-    parser.add_argument('--firestore-mode', choices=['cloud', 'emulator'], default='cloud', help='Use Firestore emulator or cloud (default: cloud)')
+    parser.add_argument('--firestore-mode', choices=['cloud', 'emulator', 'memory'], default='cloud', help='Use Firestore emulator, cloud or an in-memory stand-in (default: cloud)')
+    parser.add_argument('--pipeline', action='store_true', help='Overlap download/extraction, embedding and Firestore writes across files')
+    parser.add_argument('--workers', type=int, default=4, help='Worker threads per pipeline stage (default: 4, used with --pipeline)')
+    parser.add_argument('--process-workers', type=int, default=None, help='Processes for PDF extraction (default: CPU count)')
+    parser.add_argument('--incremental', action='store_true', help='Only process new or changed blobs and remove documents of deleted blobs')
+    parser.add_argument('--manifest-backend', choices=['sqlite', 'firestore'], default='sqlite', help='Where the incremental manifest is kept (default: sqlite)')
+    parser.add_argument('--manifest-path', default='rag_manifest.sqlite', help='SQLite manifest file (default: rag_manifest.sqlite)')
+    parser.add_argument('--embedding-cache', default=None, help='SQLite file caching embeddings by content so repeated chunks are not re-embedded')
+    parser.add_argument('--embedding-cache-max-mb', type=int, default=2048, help='Size cap of the embedding cache before LRU eviction (default: 2048)')
+    parser.add_argument('--embed-batch-size', type=int, default=100, help='Maximum chunks per embedding request (default: 100)')
+    parser.add_argument('--embed-batch-chars', type=int, default=60_000, help='Maximum characters per embedding request (default: 60000)')
+    parser.add_argument('--embed-concurrency', type=int, default=4, help='Maximum embedding requests in flight (default: 4)')
+    parser.add_argument('--embed-rpm', type=float, default=None, help='Embedding requests per minute budget, e.g. your Vertex AI quota (default: unlimited)')
+    parser.add_argument('--embed-tpm', type=float, default=None, help=f'Embedding input tokens per minute budget, estimated at {CHARS_PER_TOKEN} chars/token (default: unlimited)')
+    parser.add_argument('--embed-linger-ms', type=float, default=50.0, help='How long a partial request waits for chunks from other files in pipeline mode (default: 50)')
+    parser.add_argument('--stream-threshold-mb', type=int, default=32, help='Text/CSV/JSON files larger than this are streamed in ranges (default: 32)')
+    parser.add_argument('--stream-window-mb', type=int, default=8, help='Range size read per step when streaming (default: 8)')
+    parser.add_argument('--write-concurrency', type=int, default=8, help='Firestore batch commits in flight (default: 8)')
+    parser.add_argument('--write-max-ops', type=float, default=10_000, help='Ceiling of the Firestore write rate ramp-up, ops/sec (default: 10000)')
+    parser.add_argument('--checkpoint', default=None, help='Record completed files and batches in this file, so an interrupted run can be continued with --resume (default: off)')
+    parser.add_argument('--resume', action='store_true', help='Skip files (and streamed batches) completed by an interrupted run recorded in --checkpoint')
+    parser.add_argument('--vector-encodings', default='', help='Comma-separated compact encodings to store per chunk: float16, int8, binary')
+    parser.add_argument('--vector-storage', choices=['alongside', 'replace'], default='alongside', help='Store compact encodings and Matryoshka fields next to the float embedding or instead of it (default: alongside)')
+    parser.add_argument('--ann-index', default=None, help='Directory for a local IVF-flat ANN index built from the written embeddings')
+    parser.add_argument('--ann-lists', type=int, default=None, help='Inverted lists in the ANN index (default: sqrt of the vector count)')
+    parser.add_argument('--export-dir', default=None, help='Also write the embeddings and chunk metadata to local shards in this directory')
+    parser.add_argument('--export-format', choices=['npy', 'parquet'], default='npy', help='Export shard format: .npy matrix + .jsonl metadata, or Parquet (needs pyarrow) (default: npy)')
+    parser.add_argument('--export-shard-rows', type=int, default=10_000, help='Rows per export shard (default: 10000)')
+    parser.add_argument('--import-shards', default=None, metavar='EXPORT_DIR', help='Write the embeddings collection from an --export-dir export instead of embedding the bucket, then exit')
+    parser.add_argument('--metrics-file', default=None, help='Write per-stage timings and queue depths to this file during and after the run')
+    parser.add_argument('--metrics-format', choices=['json', 'prometheus'], default='json', help='Metrics file format; prometheus writes a node-exporter textfile (default: json)')
+    parser.add_argument('--metrics-interval', type=float, default=30.0, help='Seconds between metrics file updates during the run (default: 30, 0 writes only at the end)')
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING'], default='INFO', help='Log level; DEBUG adds sampled per-chunk lines (default: INFO)')
+    parser.add_argument('--dedup', choices=['off', 'exact', 'near'], default='off', help='Skip embedding duplicate chunks (exact content hash, or also MinHash near-duplicates) and identical files within a run (default: off)')
+    parser.add_argument('--dedup-threshold', type=float, default=0.9, help='Estimated Jaccard similarity of word shingles for a near-duplicate (default: 0.9)')
+    parser.add_argument('--project', default='shockproof-dev', help='Google Cloud project for Firestore and Vertex AI (default: shockproof-dev)')
+    parser.add_argument('--location', default='us-central1', help='Vertex AI location (default: us-central1)')
+    parser.add_argument('--storage-backend', choices=['gcs', 'local'], default='gcs', help='Read gs://bucket/prefix from GCS or from --local-storage-root/bucket/prefix (default: gcs)')
+    parser.add_argument('--local-storage-root', default='.', help='Directory holding one subdirectory per bucket for --storage-backend local (default: .)')
+    parser.add_argument('--embedding-backend', choices=['vertex', 'hash'], default='vertex', help='Vertex AI, or deterministic hash vectors for offline runs (default: vertex)')
+    parser.add_argument('--fake-embed-latency-ms', type=float, default=0.0, help='Hash embedder: latency per request (default: 0)')
+    parser.add_argument('--fake-embed-per-text-ms', type=float, default=0.0, help='Hash embedder: extra latency per text in a request (default: 0)')
+    parser.add_argument('--fake-embed-rpm', type=int, default=None, help='Hash embedder: requests per minute before 429 errors are injected')
+    parser.add_argument('--fake-embed-tpm', type=int, default=None, help='Hash embedder: input tokens per minute before 429 errors are injected')
+    parser.add_argument('--fake-embed-error-rate', type=float, default=0.0, help='Hash embedder: fraction of requests failing with 503 (default: 0)')
+    parser.add_argument('--fake-commit-latency-ms', type=float, default=0.0, help='In-memory Firestore: latency per batch commit (default: 0)')
+    parser.add_argument('--benchmark', action='store_true', help='Run offline on a synthetic corpus with local backends and report throughput and stage latencies')
+    parser.add_argument('--benchmark-files', type=int, default=200, help='Synthetic corpus size in files (default: 200)')
+    parser.add_argument('--benchmark-file-kb', type=int, default=64, help='Approximate size of each synthetic file in KB (default: 64)')
+    parser.add_argument('--benchmark-seed', type=int, default=0, help='Seed of the synthetic corpus (default: 0)')
+    parser.add_argument('--benchmark-output', default=None, help='Write the benchmark report as JSON to this path')
+    parser.add_argument('--shard', type=parse_shard, default=None, help='Process only shard i of N (e.g. 0/4): objects whose crc32(name) %% N == i; run one worker per shard')
+    parser.add_argument('--list-page-size', type=int, default=1000, help='Objects per bucket listing page (default: 1000)')
+    parser.add_argument('--stats-out', default=None, help='Write the run statistics as JSON to this path (per shard when --shard is given)')
+    parser.add_argument('--merge-stats', nargs='+', default=None, metavar='STATS_FILE', help='Merge the --stats-out files of sharded workers into one summary and exit')
+    parser.add_argument('--splitter', choices=['span', 'langchain'], default='span', help="Text splitter: span (same chunks as LangChain's RecursiveCharacterTextSplitter, faster) or langchain (default: span)")
+    parser.add_argument('--source-storage', choices=['parts', 'gcs'], default='parts', help='Where source text over 1MB goes: a sources/{id}/parts subcollection or gzip shards in GCS (default: parts)')
+    parser.add_argument('--source-text-uri', default=None, help='gs://bucket/prefix for --source-storage gcs shards')
+    parser.add_argument('--source-part-kb', type=int, default=None, help='Part size in KB (default: 900 for parts, 8192 for gcs)')
+    parser.add_argument('--pdf-page-timeout', type=float, default=30.0, help='Seconds before a single PDF page is skipped (default: 30, 0 disables)')
 
     args = parser.parse_args()
+    if not args.bucket_path and not args.benchmark and not args.merge_stats and not args.import_shards:
+        parser.error('bucket_path is required unless --benchmark, --merge-stats or --import-shards is given')
+    configure_logging(args.log_level)
+
+    if args.merge_stats:
+        merge_stats_files(args.merge_stats, args.stats_out)
+        return
 
     # Validate dimensions
+    try:
+        matryoshka_dimensions = sorted({int(size) for size in args.matryoshka_dimensions.split(',') if size.strip()})
+    except ValueError:
+        logger.error(f"❌ --matryoshka-dimensions must be comma-separated integers, got {args.matryoshka_dimensions!r}")
+        sys.exit(1)
+    import_reader = None
+    if args.import_shards:
+        try:
+            import_reader = EmbeddingShardReader(args.import_shards)
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"❌ Cannot read the export manifest in {args.import_shards}: {e}")
+            sys.exit(1)
+    if args.dimensions is None:
+        # An import keeps the exported size unless asked to truncate
+        args.dimensions = import_reader.dimensions if import_reader is not None else 1536
     if args.dimensions > 3072:
         logger.error("❌ Maximum dimensions for gemini-embedding-001 is 3072")
         sys.exit(1)
+    if args.workers < 1:
+        logger.error("❌ --workers must be at least 1")
+        sys.exit(1)
+    vector_encodings = [encoding.strip() for encoding in args.vector_encodings.split(',') if encoding.strip()]
+    unknown_encodings = [encoding for encoding in vector_encodings if encoding not in VECTOR_ENCODING_FIELDS]
+    if unknown_encodings:
+        logger.error(f"❌ Unknown vector encodings: {', '.join(unknown_encodings)} (choose from {', '.join(VECTOR_ENCODING_FIELDS)})")
+        sys.exit(1)
+    if matryoshka_dimensions and not 0 < matryoshka_dimensions[0] <= matryoshka_dimensions[-1] < args.dimensions:
+        logger.error(f"❌ --matryoshka-dimensions must be between 1 and {args.dimensions - 1} (below --dimensions)")
+        sys.exit(1)
+    if matryoshka_dimensions and args.dimensions > FIRESTORE_MAX_VECTOR_DIMENSIONS and args.vector_storage == 'alongside':
+        # The point of the extra fields is vector search, next to an embedding field that can be indexed too
+        logger.error(f"❌ With --matryoshka-dimensions, --dimensions must stay within Firestore's "
+                     f"{FIRESTORE_MAX_VECTOR_DIMENSIONS}-dimension vector index limit for the embedding field, "
+                     f"unless --vector-storage replace leaves that field out")
+        sys.exit(1)
+    if matryoshka_dimensions and matryoshka_dimensions[-1] > FIRESTORE_MAX_VECTOR_DIMENSIONS:
+        logger.error(f"❌ --matryoshka-dimensions must stay within Firestore's {FIRESTORE_MAX_VECTOR_DIMENSIONS}-dimension "
+                     f"vector index limit")
+        sys.exit(1)
+    if args.vector_storage == 'replace' and not vector_encodings and not matryoshka_dimensions:
+        # Something has to stand in for the float embedding: compact encodings or Matryoshka fields
+        logger.error("❌ --vector-storage replace requires --vector-encodings or --matryoshka-dimensions")
+        sys.exit(1)
+    if args.resume and not args.checkpoint:
+        logger.error("❌ --resume requires the --checkpoint file of the interrupted run")
+        sys.exit(1)
+    if args.resume and args.clear_collections:
+        # The checkpoint would skip files whose documents are about to be deleted
+        logger.error("❌ --resume cannot be combined with --clear-collections")
+        sys.exit(1)
+    if args.dedup != 'off' and args.incremental:
+        # A later run can remove the canonical chunks that an unchanged file's duplicateChunks point at
+        logger.error("❌ --dedup cannot be combined with --incremental")
+        sys.exit(1)
+    if args.source_storage == 'gcs' and not (args.source_text_uri or '').startswith('gs://'):
+        logger.error("❌ --source-storage gcs requires --source-text-uri gs://bucket/prefix")
+        sys.exit(1)
+    if args.source_storage == 'parts' and args.source_part_kb and args.source_part_kb * 1024 > SourceTextStore.INLINE_BYTES:
+        logger.error(f"❌ --source-part-kb must keep parts under Firestore's 1 MiB document limit (at most {SourceTextStore.INLINE_BYTES // 1024})")
+        sys.exit(1)
+    if args.export_format == 'parquet' and args.export_dir and importlib.util.find_spec('pyarrow') is None:
+        logger.error("❌ --export-format parquet requires pyarrow (pip install pyarrow)")
+        sys.exit(1)
+    # An import reads shards in the formats its manifest lists, whatever --export-format says
+    if import_reader is not None and any(shard['format'] == 'parquet' for shard in import_reader.shards) \
+            and importlib.util.find_spec('pyarrow') is None:
+        logger.error(f"❌ {args.import_shards} has Parquet shards, which require pyarrow to import (pip install pyarrow)")
+        sys.exit(1)
+    if args.import_shards and (args.export_dir or args.shard is not None):
+        logger.error("❌ --import-shards cannot be combined with --export-dir or --shard")
+        sys.exit(1)
+    if args.shard is not None:
+        if args.clear_collections:
+            # One worker clearing would delete what the others have already written
+            logger.error("❌ --clear-collections cannot be combined with --shard; clear once before starting the workers")
+            sys.exit(1)
+        # Local files each worker writes get the shard in their name, so workers on one machine don't collide
+        # (or contend for the same SQLite manifest and embedding cache)
+        (args.checkpoint, args.ann_index, args.export_dir, args.metrics_file, args.stats_out, args.manifest_path,
+         args.embedding_cache) = (
+            shard_path(path, args.shard) if path else path
+            for path in (args.checkpoint, args.ann_index, args.export_dir, args.metrics_file, args.stats_out,
+                         args.manifest_path, args.embedding_cache)
+        )
+
+    populator_kwargs = dict(firestore_mode=args.firestore_mode,
+                            pipeline=args.pipeline, workers=args.workers,
+                            process_workers=args.process_workers, pdf_page_timeout=args.pdf_page_timeout,
+                            incremental=args.incremental, manifest_backend=args.manifest_backend,
+                            manifest_path=args.manifest_path, embedding_cache_path=args.embedding_cache,
+                            embedding_cache_max_mb=args.embedding_cache_max_mb,
+                            embed_batch_size=args.embed_batch_size, embed_batch_chars=args.embed_batch_chars,
+                            embed_concurrency=args.embed_concurrency, embed_linger_ms=args.embed_linger_ms,
+                            embed_rpm=args.embed_rpm, embed_tpm=args.embed_tpm,
+                            stream_threshold_mb=args.stream_threshold_mb, stream_window_mb=args.stream_window_mb,
+                            write_concurrency=args.write_concurrency, write_max_ops_per_second=args.write_max_ops,
+                            checkpoint_path=args.checkpoint, resume=args.resume,
+                            vector_encodings=vector_encodings, vector_storage=args.vector_storage,
+                            ann_index_path=args.ann_index, ann_lists=args.ann_lists,
+                            export_path=args.export_dir, export_format=args.export_format,
+                            export_shard_rows=args.export_shard_rows, matryoshka_dimensions=matryoshka_dimensions,
+                            metrics_path=args.metrics_file, metrics_format=args.metrics_format,
+                            metrics_interval=args.metrics_interval, project=args.project, location=args.location,
+                            dedup=args.dedup, dedup_threshold=args.dedup_threshold,
+                            shard=args.shard, list_page_size=args.list_page_size,
+                            source_storage=args.source_storage, source_text_uri=args.source_text_uri,
+                            source_part_kb=args.source_part_kb, splitter=args.splitter)
+
+    if args.benchmark:
+        run_benchmark(args, populator_kwargs)
+        return
+    if args.import_shards:
+        # An import embeds nothing, so it must not truncate the checkpoint of an interrupted run
+        populator_kwargs['checkpoint_path'] = None
 
+    populator = None
     try:
-        populator = GeminiRAGPopulator(args.bucket_path, args.dimensions, firestore_mode=args.firestore_mode)
+        populator = GeminiRAGPopulator(args.bucket_path or '', args.dimensions, **populator_kwargs, **build_backends(args))
 
         if args.clear_collections:
             populator.clear_collections()
 
-        populator.process_all_files()
+        if args.import_shards:
+            total_stats = populator.import_embedding_shards(args.import_shards)
+        else:
+            total_stats = populator.process_all_files()
+        if args.stats_out:
+            write_stats_file(args.stats_out, total_stats)
 
     except KeyboardInterrupt:
         logger.info("\n⏹️  Processing interrupted by user")
@@ -513,6 +4362,9 @@ def main():
     except Exception as e:
         logger.error(f"❌ Fatal error: {e}")
         sys.exit(1)
+    finally:
+        if populator is not None:
+            populator.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
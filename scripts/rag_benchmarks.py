@@ -0,0 +1,701 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the RAG population script (gemini_rag_1536.py)
+
+Each benchmark runs against local inputs so results can be compared between changes
+without touching production GCS, Vertex AI or Firestore.
+"""
+
+import argparse
+import importlib.util
+import io
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import statistics
+import tempfile
+import time
+from typing import List, Dict, Any, Tuple
+
+import numpy as np
+
+import gemini_rag_1536 as rag
+
+logger = logging.getLogger(__name__)
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _peak_rss_mb() -> Dict[str, float]:
+    """Peak RSS of this process and of its largest (terminated) child, in MB"""
+    # ru_maxrss is reported in KB on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+    }
+
+
+def _list_pdfs(corpus_dir: str) -> List[str]:
+    pdfs = []
+    for root, _, files in os.walk(corpus_dir):
+        pdfs.extend(os.path.join(root, name) for name in files if name.lower().endswith('.pdf'))
+    return sorted(pdfs)
+
+
+def _legacy_pdf_text(pdf_path: str) -> Tuple[str, int]:
+    """The original PyPDF2 loop: whole file in memory, text built with repeated +="""
+    import PyPDF2
+
+    with open(pdf_path, 'rb') as f:
+        pdf_content = f.read()
+    pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_content))
+    text = ""
+    for page in pdf_reader.pages:
+        text += page.extract_text() + "\n"
+    return text.strip(), len(pdf_reader.pages)
+
+
+def run_pdf_variant(corpus_dir: str, variant: str, workers: int, page_timeout: float) -> Dict[str, Any]:
+    """Extract every PDF in the corpus with one variant and report throughput"""
+    pdfs = _list_pdfs(corpus_dir)
+    pages = 0
+    chars = 0
+    start = time.perf_counter()
+    if variant == 'legacy':
+        for pdf_path in pdfs:
+            text, page_count = _legacy_pdf_text(pdf_path)
+            pages += page_count
+            chars += len(text)
+    else:
+        with rag.ProcessPoolExecutor(max_workers=workers,
+                                     mp_context=rag.multiprocessing.get_context('spawn')) as executor:
+            for pdf_path in pdfs:
+                page_texts = list(rag.iter_pdf_pages(pdf_path, executor, page_timeout=page_timeout))
+                pages += len(page_texts)
+                chars += len("\n".join(page_texts).strip())
+    elapsed = time.perf_counter() - start
+    return {
+        'variant': variant,
+        'files': len(pdfs),
+        'pages': pages,
+        'chars': chars,
+        'seconds': elapsed,
+        'pages_per_sec': pages / elapsed if elapsed > 0 else 0.0,
+        'peak_rss_mb': _peak_rss_mb()
+    }
+
+
+def bench_pdf_extraction(args):
+    """Compare the legacy PyPDF2 loop with process-pool streaming extraction"""
+    if args.variant:
+        # Child mode: run one variant in a fresh process so peak RSS is not shared
+        print(json.dumps(run_pdf_variant(args.corpus_dir, args.variant, args.workers, args.page_timeout)))
+        return
+
+    if not _list_pdfs(args.corpus_dir):
+        logger.error(f"❌ No PDFs found in {args.corpus_dir}")
+        sys.exit(1)
+
+    results = []
+    for variant in ('legacy', 'pool'):
+        for _ in range(args.repeat):
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), 'pdf-extraction', args.corpus_dir,
+                 '--variant', variant, '--workers', str(args.workers), '--page-timeout', str(args.page_timeout)],
+                check=True, capture_output=True, text=True
+            ).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+
+    logger.info(f"{'variant':<8} {'files':>6} {'pages':>7} {'seconds':>9} {'pages/sec':>10} {'rss MB':>8} {'worker rss MB':>14}")
+    for result in results:
+        logger.info(f"{result['variant']:<8} {result['files']:>6} {result['pages']:>7} {result['seconds']:>9.2f} "
+                    f"{result['pages_per_sec']:>10.1f} {result['peak_rss_mb']['self']:>8.1f} "
+                    f"{result['peak_rss_mb']['children']:>14.1f}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"💾 Results written to {args.output}")
+
+
+def _synthetic_embedding_doc(index: int, dimensions: int) -> Dict[str, Any]:
+    from google.cloud.firestore_v1.vector import Vector
+
+    return {
+        'text': f"benchmark chunk {index} " * 40,
+        'embedding': Vector([random.random() for _ in range(dimensions)]),
+        'fileName': 'benchmark.txt',
+        'sourceId': 'benchmark',
+        'chunkIndex': index,
+        'status': 'active'
+    }
+
+
+def _legacy_write(db, collection_name: str, docs: List[Dict[str, Any]]):
+    """The original write loop: batches of 50 committed one after another"""
+    batch = db.batch()
+    for i, doc in enumerate(docs, 1):
+        batch.set(db.collection(collection_name).document(), doc)
+        if i % 50 == 0 or i == len(docs):
+            batch.commit()
+            batch = db.batch()
+
+
+def _legacy_delete(db, collection_name: str) -> int:
+    """The original clear: load every document, then delete serially in batches of 500"""
+    docs = list(db.collection(collection_name).stream())
+    for i in range(0, len(docs), 500):
+        batch = db.batch()
+        for doc in docs[i:i + 500]:
+            batch.delete(doc.reference)
+        batch.commit()
+    return len(docs)
+
+
+def bench_firestore_writes(args):
+    """Writes/sec and deletes/sec: sequential batches vs the parallel write engine, against the Firestore emulator"""
+    from google.cloud import firestore
+
+    os.environ['FIRESTORE_EMULATOR_HOST'] = args.emulator_host
+    db = firestore.Client(project=args.project)
+    random.seed(0)
+    docs = [_synthetic_embedding_doc(i, args.dimensions) for i in range(args.docs)]
+    results = []
+
+    for variant in ('legacy', 'engine'):
+        collection_name = f"{args.collection}_{variant}"
+        start = time.perf_counter()
+        if variant == 'legacy':
+            _legacy_write(db, collection_name, docs)
+        else:
+            engine = rag.FirestoreWriteEngine(db, batch_size=50, max_in_flight=args.concurrency,
+                                              initial_ops_per_second=args.initial_ops, max_ops_per_second=args.initial_ops)
+            for doc in docs:
+                engine.set(db.collection(collection_name).document(), doc)
+            engine.flush()
+        write_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if variant == 'legacy':
+            deleted = _legacy_delete(db, collection_name)
+        else:
+            delete_engine = rag.FirestoreWriteEngine(db, batch_size=500, max_in_flight=args.concurrency,
+                                                     initial_ops_per_second=args.initial_ops, max_ops_per_second=args.initial_ops)
+            deleted = delete_engine.delete_collection(db.collection(collection_name))
+            delete_engine.close()
+            engine.close()
+        delete_seconds = time.perf_counter() - start
+
+        results.append({
+            'variant': variant,
+            'docs': len(docs),
+            'write_seconds': write_seconds,
+            'writes_per_sec': len(docs) / write_seconds,
+            'deleted': deleted,
+            'delete_seconds': delete_seconds,
+            'deletes_per_sec': deleted / delete_seconds if delete_seconds > 0 else 0.0
+        })
+
+    logger.info(f"{'variant':<8} {'docs':>7} {'writes/sec':>11} {'deletes/sec':>12}")
+    for result in results:
+        logger.info(f"{result['variant']:<8} {result['docs']:>7} {result['writes_per_sec']:>11.1f} {result['deletes_per_sec']:>12.1f}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"💾 Results written to {args.output}")
+
+
+def _synthetic_vectors(count: int, dimensions: int, clusters: int = 64, seed: int = 0, decay: float = 0.0) -> np.ndarray:
+    """
+    Clustered unit vectors, a rough stand-in for real embeddings (which are far from uniform).
+    With decay > 0, dimension i is scaled by (1 + i) ** -decay, so information is front-loaded
+    the way Matryoshka-trained embeddings are.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dimensions)).astype(np.float32)
+    assignments = rng.integers(0, clusters, count)
+    vectors = centers[assignments] + 0.5 * rng.standard_normal((count, dimensions)).astype(np.float32)
+    if decay:
+        vectors *= (1.0 + np.arange(dimensions, dtype=np.float32)) ** -decay
+    return vectors
+
+
+def _load_vectors(args, decay: float = 0.0) -> np.ndarray:
+    """Unit-normalised vectors from an .npy file or an --export-dir export, or a synthetic clustered set"""
+    if args.vectors and os.path.isdir(args.vectors):
+        vectors = np.concatenate([shard_vectors for _, _, shard_vectors in rag.EmbeddingShardReader(args.vectors).iter_live()])
+        if args.limit:
+            vectors = vectors[:args.limit]
+    elif args.vectors:
+        vectors = np.load(args.vectors, mmap_mode='r')
+        if args.limit:
+            vectors = vectors[:args.limit]
+        vectors = np.asarray(vectors, dtype=np.float32)
+    else:
+        vectors = _synthetic_vectors(args.synthetic, args.dimensions, seed=args.seed, decay=decay)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores per row (unordered within the top k)"""
+    return np.argpartition(-scores, k - 1, axis=1)[:, :k]
+
+
+def _recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    hits = sum(len(np.intersect1d(f, t, assume_unique=True)) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def _hamming_scores(query_bits: np.ndarray, corpus_bits: np.ndarray, chunk_size: int = 256) -> np.ndarray:
+    """Negated Hamming distance between packed sign codes (higher is closer)"""
+    popcount = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.int32)
+    scores = np.empty((len(query_bits), len(corpus_bits)), dtype=np.int32)
+    for start in range(0, len(query_bits), chunk_size):
+        xor = np.bitwise_xor(query_bits[start:start + chunk_size, None, :], corpus_bits[None, :, :])
+        scores[start:start + chunk_size] = -popcount[xor].sum(axis=2)
+    return scores
+
+
+def bench_quantization_recall(args):
+    """Recall@k and bytes/vector of each compact encoding against exact float32 cosine search"""
+    vectors = _load_vectors(args)
+    if args.queries >= len(vectors):
+        logger.error(f"❌ Need more than {args.queries} vectors (have {len(vectors)})")
+        sys.exit(1)
+    # Held-out split: queries are never part of the indexed corpus
+    order = np.random.default_rng(args.seed).permutation(len(vectors))
+    queries = vectors[order[:args.queries]]
+    corpus = vectors[order[args.queries:]]
+    dimensions = corpus.shape[1]
+    k = min(args.k, len(corpus))
+    truth = _top_k(queries @ corpus.T, k)
+    logger.info(f"📐 {len(corpus):,} corpus vectors, {len(queries):,} held-out queries, {dimensions} dimensions, k={k}")
+
+    results = [{'encoding': 'float32', 'bytes_per_vector': dimensions * 4, 'recall': 1.0, 'rescored_recall': 1.0}]
+    for encoding in rag.VECTOR_ENCODING_FIELDS:
+        start = time.perf_counter()
+        codes, scales = rag.quantize_embeddings(corpus, encoding)
+        encode_seconds = time.perf_counter() - start
+        if encoding == 'binary':
+            query_codes, _ = rag.quantize_embeddings(queries, encoding)
+            scores = _hamming_scores(query_codes, codes)
+        else:
+            # Asymmetric search: full-precision queries against decoded corpus vectors
+            scores = queries @ rag.dequantize_embeddings(codes, scales, encoding, dimensions).T
+        found = _top_k(scores, k)
+        # Shortlist k * rescore_factor candidates by compact score, then rescore them exactly
+        shortlist = _top_k(scores, min(len(corpus), k * args.rescore_factor))
+        exact = np.einsum('qd,qcd->qc', queries, corpus[shortlist])
+        rescored = np.take_along_axis(shortlist, _top_k(exact, k), axis=1)
+        bytes_per_vector = codes.shape[1] * codes.itemsize + (4 if scales is not None else 0)
+        results.append({
+            'encoding': encoding,
+            'bytes_per_vector': bytes_per_vector,
+            'recall': _recall_at_k(found, truth),
+            'rescored_recall': _recall_at_k(rescored, truth),
+            'encode_vectors_per_sec': len(corpus) / encode_seconds if encode_seconds > 0 else 0.0
+        })
+
+    logger.info(f"{'encoding':<9} {'bytes/vec':>10} {'saving':>7} {f'recall@{k}':>10} {f'rescored x{args.rescore_factor}':>12}")
+    for result in results:
+        saving = 1 - result['bytes_per_vector'] / (dimensions * 4)
+        logger.info(f"{result['encoding']:<9} {result['bytes_per_vector']:>10,} {saving:>7.0%} "
+                    f"{result['recall']:>10.3f} {result['rescored_recall']:>12.3f}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"💾 Results written to {args.output}")
+
+
+def bench_ann_recall(args):
+    """Recall@k and queries/sec of the local IVF-flat index against brute-force search"""
+    vectors = _load_vectors(args)
+    if args.queries >= len(vectors):
+        logger.error(f"❌ Need more than {args.queries} vectors (have {len(vectors)})")
+        sys.exit(1)
+    order = np.random.default_rng(args.seed).permutation(len(vectors))
+    queries = vectors[order[:args.queries]]
+    corpus = vectors[order[args.queries:]]
+    chunk_ids = [f"chunk_{i}" for i in range(len(corpus))]
+    k = min(args.k, len(corpus))
+
+    with tempfile.TemporaryDirectory() as index_dir:
+        writer = rag.AnnIndexWriter(index_dir, corpus.shape[1], lists=args.lists)
+        for start in range(0, len(corpus), 10_000):
+            writer.add(chunk_ids[start:start + 10_000], corpus[start:start + 10_000])
+        start = time.perf_counter()
+        build_stats = writer.build(seed=args.seed)
+        build_seconds = time.perf_counter() - start
+        writer.close()
+        index = rag.IvfFlatIndex(index_dir)
+        logger.info(f"🧭 {len(corpus):,} vectors in {build_stats['lists']:,} lists, built in {build_seconds:.1f}s; "
+                    f"{len(queries):,} held-out queries, k={k}")
+
+        # Brute force answers one query at a time too, so queries/sec are comparable
+        start = time.perf_counter()
+        truth = np.stack([_top_k((corpus @ query)[None, :], k)[0] for query in queries])
+        brute_seconds = time.perf_counter() - start
+        results = [{'method': 'brute-force', 'n_probe': None, 'recall': 1.0, 'qps': len(queries) / brute_seconds}]
+        truth_ids = [{chunk_ids[i] for i in row} for row in truth]
+
+        for n_probe in sorted({min(n, build_stats['lists']) for n in args.n_probe}):
+            start = time.perf_counter()
+            found = [index.search(query, k=k, n_probe=n_probe) for query in queries]
+            seconds = time.perf_counter() - start
+            hits = sum(len(truth_row & {chunk_id for chunk_id, _ in row}) for truth_row, row in zip(truth_ids, found))
+            results.append({'method': 'ivf-flat', 'n_probe': n_probe, 'recall': hits / (k * len(queries)),
+                            'qps': len(queries) / seconds})
+
+    logger.info(f"{'method':<12} {'n_probe':>8} {f'recall@{k}':>10} {'queries/sec':>12}")
+    for result in results:
+        logger.info(f"{result['method']:<12} {result['n_probe'] or '-':>8} {result['recall']:>10.3f} {result['qps']:>12.1f}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'build_seconds': build_seconds, 'lists': build_stats['lists'], 'results': results}, f, indent=2)
+        logger.info(f"💾 Results written to {args.output}")
+
+
+def bench_matryoshka_recall(args):
+    """
+    Recall@k and per-query latency of brute-force search over re-normalized prefixes of the full
+    vectors (what --matryoshka-dimensions stores), alone and with the shortlist re-ranked at full size
+    """
+    vectors = _load_vectors(args, decay=args.spectrum_decay)
+    if args.queries >= len(vectors):
+        logger.error(f"❌ Need more than {args.queries} vectors (have {len(vectors)})")
+        sys.exit(1)
+    order = np.random.default_rng(args.seed).permutation(len(vectors))
+    queries = vectors[order[:args.queries]]
+    corpus = vectors[order[args.queries:]]
+    full = corpus.shape[1]
+    k = min(args.k, len(corpus))
+    shortlist_size = min(len(corpus), k * args.rerank_factor)
+    sizes = sorted({size for size in args.sizes if 0 < size < full})
+    truth = _top_k(queries @ corpus.T, k)
+    corpus_prefixes = {**rag.matryoshka_truncations(corpus, sizes), full: corpus}
+    query_prefixes = {**rag.matryoshka_truncations(queries, sizes), full: queries}
+    source = args.vectors or f"synthetic, spectrum decay {args.spectrum_decay:g}"
+    logger.info(f"🪆 {len(corpus):,} corpus vectors ({source}), {len(queries):,} held-out queries, {full} dimensions, "
+                f"k={k}, re-rank shortlist {shortlist_size}")
+
+    results = []
+    for size in sizes + [full]:
+        index = np.ascontiguousarray(corpus_prefixes[size])
+        found, reranked, latencies, rerank_latencies = [], [], [], []
+        # One query at a time, as a request would search
+        for query, full_query in zip(query_prefixes[size], queries):
+            start = time.perf_counter()
+            scores = index @ query
+            scored = time.perf_counter()
+            found.append(np.argpartition(-scores, k - 1)[:k])
+            searched = time.perf_counter()
+            shortlist = np.argpartition(-scores, shortlist_size - 1)[:shortlist_size]
+            exact = corpus[shortlist] @ full_query
+            reranked.append(shortlist[np.argpartition(-exact, k - 1)[:k]])
+            done = time.perf_counter()
+            latencies.append(searched - start)
+            rerank_latencies.append((scored - start) + (done - searched))
+        results.append({
+            'dimensions': size,
+            'bytes_per_vector': size * 4,
+            'recall': _recall_at_k(np.stack(found), truth),
+            'p50_ms': float(np.percentile(latencies, 50)) * 1000,
+            'p99_ms': float(np.percentile(latencies, 99)) * 1000,
+            'reranked_recall': _recall_at_k(np.stack(reranked), truth),
+            'reranked_p50_ms': float(np.percentile(rerank_latencies, 50)) * 1000
+        })
+
+    logger.info(f"{'dims':>6} {'bytes/vec':>10} {f'recall@{k}':>10} {'p50 ms':>8} {'p99 ms':>8} "
+                f"{f're-ranked x{args.rerank_factor}':>14} {'p50 ms':>8}")
+    for result in results:
+        logger.info(f"{result['dimensions']:>6} {result['bytes_per_vector']:>10,} {result['recall']:>10.3f} "
+                    f"{result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f} {result['reranked_recall']:>14.3f} "
+                    f"{result['reranked_p50_ms']:>8.2f}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"💾 Results written to {args.output}")
+
+
+def _langchain_splitter_class():
+    """LangChain's RecursiveCharacterTextSplitter, from whichever package is installed (None if neither is)"""
+    for module_name in ('langchain_text_splitters', 'langchain.text_splitter'):
+        try:
+            module = importlib.import_module(module_name)
+            return module.RecursiveCharacterTextSplitter
+        except (ImportError, AttributeError):
+            continue
+    return None
+
+
+def _fuzz_text(rng: random.Random) -> str:
+    """Random text over the splitter's separators, multibyte and whitespace characters, with long unbroken runs"""
+    pieces = ['a', 'é', '𝄞', ' ', '  ', '\t', '\n', '\n\n', '\n\n\n', '\r\n', '\u3000', 'word ', 'x' * 40]
+    if rng.random() < 0.1:
+        return 'z' * rng.randint(0, 5000)
+    return ''.join(rng.choice(pieces) for _ in range(rng.choice([0, 1, 5, 50, 500, 3000, 20000])))
+
+
+def _load_split_corpus(args, workdir: str) -> List[str]:
+    if args.corpus_dir:
+        directory = args.corpus_dir
+    else:
+        import rag_local_backends
+
+        directory = rag_local_backends.generate_synthetic_corpus(workdir, 'split', 'corpus', args.files, args.file_kb,
+                                                                 seed=args.seed)['path']
+    texts = []
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith(('.txt', '.md', '.csv')):
+            with open(os.path.join(directory, name), encoding='utf-8') as f:
+                texts.append(f.read())
+    return texts
+
+
+def bench_splitting(args):
+    """Parity of SpanTextSplitter with LangChain's RecursiveCharacterTextSplitter, and chunks/sec of both"""
+    langchain_class = _langchain_splitter_class()
+    if langchain_class is None:
+        logger.warning("⚠️  LangChain text splitters not installed: parity checks and the LangChain baseline are skipped")
+
+    with tempfile.TemporaryDirectory(prefix='rag-split-') as workdir:
+        texts = _load_split_corpus(args, workdir)
+    if not texts:
+        logger.error("❌ No .txt/.md/.csv files to split")
+        sys.exit(1)
+    total_mb = sum(len(text.encode('utf-8')) for text in texts) / 1024 / 1024
+    logger.info(f"📚 {len(texts):,} texts, {total_mb:.1f} MB; chunk size {args.chunk_size}, overlap {args.chunk_overlap}")
+
+    span_splitter = rag.SpanTextSplitter(args.chunk_size, args.chunk_overlap)
+    parity = None
+    if langchain_class is not None:
+        # The corpus at the benchmark settings, then random texts at random settings
+        mismatches = []
+        langchain_splitter = langchain_class(chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap)
+        for index, text in enumerate(texts):
+            if langchain_splitter.split_text(text) != span_splitter.split_text(text):
+                mismatches.append(f"corpus text {index}")
+        rng = random.Random(args.seed)
+        for case in range(args.fuzz):
+            chunk_size = rng.choice([1, 2, 5, 10, 30, 100, 1024])
+            chunk_overlap = rng.randint(0, chunk_size)
+            text = _fuzz_text(rng)
+            expected = langchain_class(chunk_size=chunk_size, chunk_overlap=chunk_overlap).split_text(text)
+            if rag.SpanTextSplitter(chunk_size, chunk_overlap).split_text(text) != expected:
+                mismatches.append(f"fuzz case {case} ({len(text)} chars, {chunk_size}/{chunk_overlap})")
+        parity = {'checked': len(texts) + args.fuzz, 'mismatches': mismatches}
+        if mismatches:
+            logger.error(f"❌ {len(mismatches)} parity mismatches, first: {', '.join(mismatches[:5])}")
+        else:
+            logger.info(f"✅ Identical chunks for {len(texts):,} corpus texts and {args.fuzz:,} fuzz cases")
+
+    variants = {'span': lambda: [span_splitter.split_text(text) for text in texts]}
+    if langchain_class is not None:
+        variants = {'langchain': lambda: [langchain_splitter.split_text(text) for text in texts], **variants}
+    results = []
+    for variant, run in variants.items():
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            chunks = run()
+            timings.append(time.perf_counter() - start)
+        seconds = min(timings)
+        chunk_count = sum(len(text_chunks) for text_chunks in chunks)
+        results.append({'variant': variant, 'seconds': seconds, 'chunks': chunk_count,
+                        'mb_per_sec': total_mb / seconds, 'chunks_per_sec': chunk_count / seconds})
+
+    logger.info(f"{'variant':<22} {'seconds':>8} {'MB/s':>8} {'chunks/sec':>11} {'speedup':>8}")
+    baseline = results[0]['seconds']
+    for result in results:
+        logger.info(f"{result['variant']:<22} {result['seconds']:>8.3f} {result['mb_per_sec']:>8.1f} "
+                    f"{result['chunks_per_sec']:>11,.0f} {baseline / result['seconds']:>7.1f}x")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'texts': len(texts), 'mb': total_mb, 'parity': parity, 'results': results}, f, indent=2)
+        logger.info(f"💾 Results written to {args.output}")
+    if parity is not None and parity['mismatches']:
+        sys.exit(1)
+
+
+# Modules the population script imported at startup before they were deferred to first use
+DEFERRED_IMPORTS = ('google.cloud.storage', 'google.cloud.firestore', 'google.cloud.firestore_v1.vector', 'firebase_admin',
+                    'langchain.text_splitter', 'langchain_google_vertexai.embeddings', 'PyPDF2')
+
+
+def _module_available(name: str) -> bool:
+    if name in sys.modules:
+        return True
+    try:
+        return importlib.util.find_spec(name) is not None
+    except ModuleNotFoundError:
+        return False
+
+
+def _run_timed(command: List[str], cwd: str) -> Tuple[float, str]:
+    """Wall seconds of a fresh interpreter running `command`, and its stderr"""
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [SCRIPTS_DIR, os.environ.get('PYTHONPATH')]))}
+    start = time.perf_counter()
+    completed = subprocess.run(command, cwd=cwd, env=env, check=True, capture_output=True, text=True)
+    return time.perf_counter() - start, completed.stderr
+
+
+def _parse_importtime(stderr: str) -> Dict[str, float]:
+    """Cumulative seconds of each top-level import in `python -X importtime` output"""
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Nested imports are indented by two spaces per level below the single leading space
+        if len(name) - len(name.lstrip()) == 1:
+            imports[name.strip()] = int(cumulative) / 1e6
+    return imports
+
+
+def bench_startup(args):
+    """Fixed startup cost of the population script: import time (lazy vs the old eager imports) and short runs"""
+    script = os.path.join(SCRIPTS_DIR, 'gemini_rag_1536.py')
+    eager = [name for name in DEFERRED_IMPORTS if _module_available(name)]
+    missing = sorted(set(DEFERRED_IMPORTS) - set(eager))
+    if missing:
+        logger.warning(f"⚠️  Not installed, left out of the eager import: {', '.join(missing)}")
+
+    with tempfile.TemporaryDirectory(prefix='rag-startup-') as workdir:
+        import rag_local_backends
+
+        # A one-file bucket: the shape of a run triggered by a single object notification
+        rag_local_backends.generate_synthetic_corpus(workdir, 'startup', 'corpus', 1, 8, seed=0)
+        scenarios = {
+            'import (lazy)': [sys.executable, '-X', 'importtime', '-c', 'import gemini_rag_1536'],
+            'import (eager)': [sys.executable, '-X', 'importtime', '-c', '; '.join(['import gemini_rag_1536', *(f'import {name}' for name in eager)])],
+            '--help': [sys.executable, script, '--help'],
+            'one-file run': [sys.executable, '-X', 'importtime', script, 'gs://startup/corpus', '--storage-backend', 'local',
+                             '--local-storage-root', workdir, '--embedding-backend', 'hash', '--firestore-mode', 'memory',
+                             '--checkpoint', '', '--log-level', 'WARNING']
+        }
+        results = []
+        for scenario, command in scenarios.items():
+            walls = []
+            imports: Dict[str, float] = {}
+            for _ in range(args.repeat):
+                wall, stderr = _run_timed(command, workdir)
+                walls.append(wall)
+                imports = _parse_importtime(stderr)
+            heaviest = sorted(imports.items(), key=lambda entry: -entry[1])[:args.top]
+            results.append({
+                'scenario': scenario,
+                'wall_seconds_median': statistics.median(walls),
+                'wall_seconds_min': min(walls),
+                'import_seconds': sum(imports.values()),
+                'heaviest_imports': heaviest
+            })
+
+    logger.info(f"{'scenario':<16} {'median s':>9} {'min s':>7} {'imports s':>10}")
+    for result in results:
+        logger.info(f"{result['scenario']:<16} {result['wall_seconds_median']:>9.3f} {result['wall_seconds_min']:>7.3f} "
+                    f"{result['import_seconds']:>10.3f}")
+    for result in results:
+        if result['heaviest_imports']:
+            logger.info(f"\n{result['scenario']}: heaviest top-level imports")
+            for name, seconds in result['heaviest_imports']:
+                logger.info(f"   {seconds * 1000:>9.1f} ms  {name}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"💾 Results written to {args.output}")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stderr)
+    parser = argparse.ArgumentParser(description='Benchmarks for the gemini_rag_1536.py RAG population script')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    pdf_parser = subparsers.add_parser('pdf-extraction', help='Pages/sec and peak RSS: legacy PyPDF2 loop vs process pool')
+    pdf_parser.add_argument('corpus_dir', help='Directory of PDFs to extract')
+    pdf_parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Process pool size (default: CPU count)')
+    pdf_parser.add_argument('--page-timeout', type=float, default=30.0, help='Per-page timeout in seconds (default: 30)')
+    pdf_parser.add_argument('--repeat', type=int, default=1, help='Runs per variant (default: 1)')
+    pdf_parser.add_argument('--output', help='Write raw results as JSON to this path')
+    pdf_parser.add_argument('--variant', choices=['legacy', 'pool'], help=argparse.SUPPRESS)
+    pdf_parser.set_defaults(func=bench_pdf_extraction)
+
+    writes_parser = subparsers.add_parser('firestore-writes', help='Writes/sec and deletes/sec: sequential batches vs write engine (emulator)')
+    writes_parser.add_argument('--docs', type=int, default=5000, help='Synthetic embedding documents to write (default: 5000)')
+    writes_parser.add_argument('--dimensions', type=int, default=1536, help='Vector size of each document (default: 1536)')
+    writes_parser.add_argument('--concurrency', type=int, default=8, help='Write engine batches in flight (default: 8)')
+    writes_parser.add_argument('--initial-ops', type=float, default=10_000, help='Write engine ops/sec limit (default: 10000, no ramp-up)')
+    writes_parser.add_argument('--emulator-host', default='localhost:9198', help='Firestore emulator host (default: localhost:9198)')
+    writes_parser.add_argument('--project', default='demo-rag-benchmark', help='Emulator project ID (default: demo-rag-benchmark)')
+    writes_parser.add_argument('--collection', default='benchmark_embeddings', help='Collection prefix used for the run')
+    writes_parser.add_argument('--output', help='Write raw results as JSON to this path')
+    writes_parser.set_defaults(func=bench_firestore_writes)
+
+    recall_parser = subparsers.add_parser('quantization-recall', help='Recall@k lost by float16/int8/binary vector encodings')
+    recall_parser.add_argument('--vectors', help='.npy file of (n, d) embeddings or an --export-dir export; synthetic clustered vectors if omitted')
+    recall_parser.add_argument('--limit', type=int, help='Use only the first N vectors from --vectors')
+    recall_parser.add_argument('--synthetic', type=int, default=20_000, help='Synthetic vectors to generate (default: 20000)')
+    recall_parser.add_argument('--dimensions', type=int, default=1536, help='Synthetic vector size (default: 1536)')
+    recall_parser.add_argument('--queries', type=int, default=500, help='Held-out query vectors (default: 500)')
+    recall_parser.add_argument('--k', type=int, default=10, help='Neighbours per query (default: 10)')
+    recall_parser.add_argument('--rescore-factor', type=int, default=4, help='Shortlist size multiplier for exact rescoring (default: 4)')
+    recall_parser.add_argument('--seed', type=int, default=0, help='Random seed for the split and synthetic data')
+    recall_parser.add_argument('--output', help='Write raw results as JSON to this path')
+    recall_parser.set_defaults(func=bench_quantization_recall)
+
+    ann_parser = subparsers.add_parser('ann-recall', help='Recall@k and queries/sec of the local IVF-flat index vs brute force')
+    ann_parser.add_argument('--vectors', help='.npy file of (n, d) embeddings or an --export-dir export; synthetic clustered vectors if omitted')
+    ann_parser.add_argument('--limit', type=int, help='Use only the first N vectors from --vectors')
+    ann_parser.add_argument('--synthetic', type=int, default=100_000, help='Synthetic vectors to generate (default: 100000)')
+    ann_parser.add_argument('--dimensions', type=int, default=1536, help='Synthetic vector size (default: 1536)')
+    ann_parser.add_argument('--queries', type=int, default=200, help='Held-out query vectors (default: 200)')
+    ann_parser.add_argument('--k', type=int, default=10, help='Neighbours per query (default: 10)')
+    ann_parser.add_argument('--lists', type=int, default=None, help='Inverted lists (default: sqrt of the corpus size)')
+    ann_parser.add_argument('--n-probe', type=int, nargs='+', default=[1, 4, 8, 16, 32], help='Lists scanned per query (default: 1 4 8 16 32)')
+    ann_parser.add_argument('--seed', type=int, default=0, help='Random seed for the split, synthetic data and k-means')
+    ann_parser.add_argument('--output', help='Write raw results as JSON to this path')
+    ann_parser.set_defaults(func=bench_ann_recall)
+
+    matryoshka_parser = subparsers.add_parser('matryoshka-recall', help='Recall@k vs per-query latency at each Matryoshka prefix size, alone and re-ranked at full size')
+    matryoshka_parser.add_argument('--vectors', help='.npy file of (n, d) embeddings or an --export-dir export (ideally 3072-D); synthetic if omitted')
+    matryoshka_parser.add_argument('--limit', type=int, help='Use only the first N vectors from --vectors')
+    matryoshka_parser.add_argument('--synthetic', type=int, default=20_000, help='Synthetic vectors to generate (default: 20000)')
+    matryoshka_parser.add_argument('--dimensions', type=int, default=3072, help='Synthetic vector size (default: 3072)')
+    matryoshka_parser.add_argument('--spectrum-decay', type=float, default=0.5, help='Synthetic per-dimension scale (1 + i) ** -decay, mimicking front-loaded Matryoshka embeddings (default: 0.5)')
+    matryoshka_parser.add_argument('--sizes', type=int, nargs='+', default=[128, 256, 512, 768, 1536], help='Prefix sizes to compare with the full vectors (default: 128 256 512 768 1536)')
+    matryoshka_parser.add_argument('--queries', type=int, default=200, help='Held-out query vectors (default: 200)')
+    matryoshka_parser.add_argument('--k', type=int, default=10, help='Neighbours per query (default: 10)')
+    matryoshka_parser.add_argument('--rerank-factor', type=int, default=4, help='Shortlist size multiplier for re-ranking at full size (default: 4)')
+    matryoshka_parser.add_argument('--seed', type=int, default=0, help='Random seed for the split and synthetic data')
+    matryoshka_parser.add_argument('--output', help='Write raw results as JSON to this path')
+    matryoshka_parser.set_defaults(func=bench_matryoshka_recall)
+
+    startup_parser = subparsers.add_parser('startup', help='Startup cost: -X importtime of lazy vs eager imports, --help and a one-file run')
+    startup_parser.add_argument('--repeat', type=int, default=5, help='Fresh interpreters per scenario (default: 5)')
+    startup_parser.add_argument('--top', type=int, default=10, help='Heaviest top-level imports listed per scenario (default: 10)')
+    startup_parser.add_argument('--output', help='Write raw results as JSON to this path')
+    startup_parser.set_defaults(func=bench_startup)
+
+    split_parser = subparsers.add_parser('splitting', help="Chunk parity with LangChain's splitter, and MB/s: LangChain vs span splitter")
+    split_parser.add_argument('--corpus-dir', help='Directory of .txt/.md/.csv files; a synthetic corpus if omitted')
+    split_parser.add_argument('--files', type=int, default=200, help='Synthetic files to generate (default: 200)')
+    split_parser.add_argument('--file-kb', type=int, default=256, help='Size of each synthetic file in KB (default: 256)')
+    split_parser.add_argument('--chunk-size', type=int, default=1024, help='Chunk size in characters (default: 1024)')
+    split_parser.add_argument('--chunk-overlap', type=int, default=128, help='Chunk overlap in characters (default: 128)')
+    split_parser.add_argument('--fuzz', type=int, default=500, help='Random texts checked for parity at random settings (default: 500)')
+    split_parser.add_argument('--repeat', type=int, default=3, help='Runs per variant; the fastest is reported (default: 3)')
+    split_parser.add_argument('--seed', type=int, default=0, help='Random seed for the synthetic corpus and fuzz cases')
+    split_parser.add_argument('--output', help='Write raw results as JSON to this path')
+    split_parser.set_defaults(func=bench_splitting)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
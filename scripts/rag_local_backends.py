@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+"""
+Local stand-ins for the cloud services used by gemini_rag_1536.py
+
+- LocalStorageClient: a directory tree served as GCS buckets (gs://bucket/prefix -> root/bucket/prefix)
+- HashEmbeddings: deterministic hash-based vectors with injectable latency, rate limits and errors
+- MemoryFirestore: a thread-safe in-memory Firestore with the client surface the populator uses
+
+They let the populator run, and be benchmarked, without GCS, Vertex AI or Firestore.
+"""
+
+import base64
+import hashlib
+import itertools
+import json
+import os
+import random
+import shutil
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Iterator, Optional
+
+import numpy as np
+
+
+class LocalPreconditionFailed(Exception):
+    """Raised like GCS's 412 when a blob changed since it was listed"""
+    code = 412
+
+
+class LocalNotFound(Exception):
+    """Raised like GCS's 404 for a blob that does not exist"""
+    code = 404
+
+
+class LocalBlob:
+    """A file under a LocalBucket, with the GCS Blob attributes and downloads the populator uses"""
+
+    def __init__(self, bucket: 'LocalBucket', name: str, stat: Optional[os.stat_result]):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.root, name)
+        # Like bucket.blob() in GCS, a blob that does not exist yet has no size or generation
+        self.size = stat.st_size if stat is not None else None
+        self.generation = stat.st_mtime_ns if stat is not None else None
+        self.content_type = _guess_content_type(name)
+        self._md5_hash: Optional[str] = None
+
+    @property
+    def md5_hash(self) -> str:
+        """Base64 MD5 like GCS reports; computed on first use since listing should not read every file"""
+        if self._md5_hash is None:
+            digest = hashlib.md5()
+            with open(self.path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+            self._md5_hash = base64.b64encode(digest.digest()).decode('ascii')
+        return self._md5_hash
+
+    @property
+    def crc32c(self) -> Optional[str]:
+        return None
+
+    def _check_generation(self, if_generation_match: Optional[int]):
+        if if_generation_match is not None and os.stat(self.path).st_mtime_ns != if_generation_match:
+            raise LocalPreconditionFailed(f"412 {self.name} changed since it was listed")
+
+    def download_as_bytes(self, start: Optional[int] = None, end: Optional[int] = None,
+                          if_generation_match: Optional[int] = None, **kwargs) -> bytes:
+        """Like GCS, `end` is inclusive"""
+        self._check_generation(if_generation_match)
+        with open(self.path, 'rb') as f:
+            if start is None:
+                return f.read()
+            f.seek(start)
+            return f.read(-1 if end is None else end - start + 1)
+
+    def download_as_text(self, encoding: str = 'utf-8', **kwargs) -> str:
+        return self.download_as_bytes(**kwargs).decode(encoding)
+
+    def download_to_filename(self, filename: str, **kwargs):
+        self._check_generation(kwargs.get('if_generation_match'))
+        shutil.copyfile(self.path, filename)
+
+    def upload_from_string(self, data, content_type: Optional[str] = None, **kwargs):
+        """Write through a temporary file so a concurrent reader never sees a partial object"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f"{self.path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data.encode('utf-8') if isinstance(data, str) else data)
+        os.replace(temp_path, self.path)
+        stat = os.stat(self.path)
+        self.size = stat.st_size
+        self.generation = stat.st_mtime_ns
+        if content_type:
+            self.content_type = content_type
+
+    def delete(self, **kwargs):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            raise LocalNotFound(f"404 No such object: {self.bucket.name}/{self.name}")
+
+
+def _guess_content_type(name: str) -> str:
+    extension = os.path.splitext(name)[1].lower()
+    return {
+        '.pdf': 'application/pdf', '.txt': 'text/plain', '.md': 'text/markdown',
+        '.csv': 'text/csv', '.json': 'application/json'
+    }.get(extension, 'application/octet-stream')
+
+
+class LocalBucket:
+    def __init__(self, root: str, name: str):
+        self.name = name
+        self.root = os.path.join(root, name)
+
+    def list_blobs(self, prefix: str = '', page_size: int = 1000, **kwargs) -> 'LocalBlobListing':
+        """Files under the bucket directory in lexicographic name order, as GCS lists them"""
+        names = []
+        for directory, _, files in os.walk(self.root):
+            for file_name in files:
+                name = os.path.relpath(os.path.join(directory, file_name), self.root).replace(os.sep, '/')
+                if name.startswith(prefix):
+                    names.append(name)
+        return LocalBlobListing(self, sorted(names), page_size)
+
+    def blob(self, name: str) -> LocalBlob:
+        try:
+            stat = os.stat(os.path.join(self.root, name))
+        except FileNotFoundError:
+            stat = None
+        return LocalBlob(self, name, stat)
+
+
+class LocalBlobListing:
+    """Listing result shaped like GCS's HTTPIterator: iterate blobs, or `.pages` of up to page_size blobs"""
+
+    def __init__(self, bucket: 'LocalBucket', names: List[str], page_size: int):
+        self.bucket = bucket
+        self.names = names
+        self.page_size = max(1, page_size)
+
+    @property
+    def pages(self) -> Iterator[Iterator[LocalBlob]]:
+        for start in range(0, len(self.names), self.page_size):
+            # Blobs are stat'ed when their page is read, as GCS fetches a page per request
+            yield iter([self.bucket.blob(name) for name in self.names[start:start + self.page_size]])
+
+    def __iter__(self) -> Iterator[LocalBlob]:
+        return itertools.chain.from_iterable(self.pages)
+
+
+class LocalStorageClient:
+    """Serves gs://<bucket>/<prefix> from <root>/<bucket>/<prefix>"""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def bucket(self, name: str) -> LocalBucket:
+        return LocalBucket(self.root, name)
+
+
+class InjectedRateLimit(Exception):
+    """Shaped like the Vertex AI quota error so the populator's retry logic treats it the same way"""
+    code = 429
+
+
+class InjectedFailure(Exception):
+    code = 503
+
+
+class HashEmbeddings:
+    """
+    Deterministic embedder: each text maps to a unit vector seeded by its SHA-256, so identical
+    texts always get identical vectors. Each call sleeps latency_ms + per_text_latency_ms * len(texts),
+    jittered by +/- jitter. Calls beyond rate_limit_rpm, or input beyond rate_limit_tpm tokens (4 chars
+    each), in any 60-second window, or beyond max_texts_per_request, fail the way Vertex AI does;
+    error_rate fails that fraction of calls at random.
+    """
+
+    def __init__(self, latency_ms: float = 0.0, per_text_latency_ms: float = 0.0, jitter: float = 0.1,
+                 rate_limit_rpm: Optional[int] = None, rate_limit_tpm: Optional[int] = None, error_rate: float = 0.0,
+                 max_texts_per_request: Optional[int] = None, seed: int = 0):
+        self.latency_ms = latency_ms
+        self.per_text_latency_ms = per_text_latency_ms
+        self.jitter = jitter
+        self.rate_limit_rpm = rate_limit_rpm
+        self.rate_limit_tpm = rate_limit_tpm
+        self.error_rate = error_rate
+        self.max_texts_per_request = max_texts_per_request
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self._request_times = deque()
+        self._token_times = deque()
+        self._window_tokens = 0
+        self.calls = 0
+        self.texts = 0
+        self.rate_limited = 0
+        self.failures = 0
+
+    @staticmethod
+    def vector(text: str, dimensions: int) -> List[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+        vector = np.random.default_rng(seed).standard_normal(dimensions)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def _admit(self, count: int, tokens: int = 0):
+        with self.lock:
+            self.calls += 1
+            now = time.monotonic()
+            if self.rate_limit_tpm:
+                while self._token_times and now - self._token_times[0][0] >= 60.0:
+                    self._window_tokens -= self._token_times.popleft()[1]
+                if self._window_tokens + tokens > self.rate_limit_tpm:
+                    self.rate_limited += 1
+                    raise InjectedRateLimit("429 Quota exceeded for embedding input tokens per minute (injected)")
+                self._token_times.append((now, tokens))
+                self._window_tokens += tokens
+            if self.rate_limit_rpm:
+                while self._request_times and now - self._request_times[0] >= 60.0:
+                    self._request_times.popleft()
+                if len(self._request_times) >= self.rate_limit_rpm:
+                    self.rate_limited += 1
+                    raise InjectedRateLimit("429 Quota exceeded for embedding requests per minute (injected)")
+                self._request_times.append(now)
+            if self.max_texts_per_request and count > self.max_texts_per_request:
+                self.failures += 1
+                raise ValueError(f"400 Request too large: {count} texts exceed the limit of {self.max_texts_per_request} (injected)")
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.failures += 1
+                raise InjectedFailure("503 Service unavailable (injected)")
+            delay = (self.latency_ms + self.per_text_latency_ms * count) / 1000
+            delay *= 1 + self.random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def embed(self, texts: List[str], dimensions: int = 768, **kwargs) -> List[List[float]]:
+        self._admit(len(texts), sum(-(-len(text) // 4) for text in texts))
+        with self.lock:
+            self.texts += len(texts)
+        return [self.vector(text, dimensions) for text in texts]
+
+    def embed_documents(self, texts: List[str], **kwargs) -> List[List[float]]:
+        return self.embed(texts, **kwargs)
+
+
+class MemorySnapshot:
+    def __init__(self, reference: 'MemoryDocumentReference', data: Optional[Dict[str, Any]]):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field: str) -> Any:
+        return (self._data or {}).get(field)
+
+
+class MemoryDocumentReference:
+    def __init__(self, db: 'MemoryFirestore', collection: str, doc_id: Optional[str] = None):
+        self.db = db
+        self.collection_name = collection
+        self.id = doc_id or uuid.uuid4().hex[:20]
+        self.path = f"{collection}/{self.id}"
+
+    def set(self, data: Dict[str, Any], merge: bool = False):
+        self.db._apply([('set', self, data, merge)])
+
+    def update(self, data: Dict[str, Any]):
+        self.db._apply([('update', self, data, False)])
+
+    def delete(self):
+        self.db._apply([('delete', self, None, False)])
+
+    def get(self) -> MemorySnapshot:
+        with self.db.lock:
+            data = self.db.collections.get(self.collection_name, {}).get(self.id)
+            return MemorySnapshot(self, dict(data) if data is not None else None)
+
+    def collection(self, name: str) -> 'MemoryCollection':
+        """Subcollections are stored under their full path, e.g. 'sources/abc/parts'"""
+        return MemoryCollection(self.db, f"{self.path}/{name}")
+
+
+class MemoryQuery:
+    _OPS = {
+        '==': lambda a, b: a == b, '!=': lambda a, b: a != b, '<': lambda a, b: a < b,
+        '<=': lambda a, b: a <= b, '>': lambda a, b: a > b, '>=': lambda a, b: a >= b,
+        'in': lambda a, b: a in b, 'array_contains': lambda a, b: b in (a or [])
+    }
+
+    def __init__(self, db: 'MemoryFirestore', collection: str, filters=(), limit_count: Optional[int] = None):
+        self.db = db
+        self.collection_name = collection
+        self.filters = list(filters)
+        self.limit_count = limit_count
+
+    def where(self, field: str, op: str, value: Any) -> 'MemoryQuery':
+        return MemoryQuery(self.db, self.collection_name, self.filters + [(field, op, value)], self.limit_count)
+
+    def limit(self, count: int) -> 'MemoryQuery':
+        return MemoryQuery(self.db, self.collection_name, self.filters, count)
+
+    def stream(self) -> Iterator[MemorySnapshot]:
+        with self.db.lock:
+            items = sorted(self.db.collections.get(self.collection_name, {}).items())
+        matched = 0
+        for doc_id, data in items:
+            if all(field in data and self._OPS[op](data[field], value) for field, op, value in self.filters):
+                yield MemorySnapshot(MemoryDocumentReference(self.db, self.collection_name, doc_id), dict(data))
+                matched += 1
+                if self.limit_count is not None and matched >= self.limit_count:
+                    return
+
+
+class MemoryCollection(MemoryQuery):
+    def __init__(self, db: 'MemoryFirestore', name: str):
+        super().__init__(db, name)
+        self.id = name
+
+    def document(self, doc_id: Optional[str] = None) -> MemoryDocumentReference:
+        return MemoryDocumentReference(self.db, self.collection_name, doc_id)
+
+    def list_documents(self, page_size: Optional[int] = None) -> Iterator[MemoryDocumentReference]:
+        with self.db.lock:
+            doc_ids = sorted(self.db.collections.get(self.collection_name, {}))
+        for doc_id in doc_ids:
+            yield MemoryDocumentReference(self.db, self.collection_name, doc_id)
+
+
+class MemoryWriteBatch:
+    MAX_OPERATIONS = 500
+
+    def __init__(self, db: 'MemoryFirestore'):
+        self.db = db
+        self.ops = []
+
+    def set(self, reference: MemoryDocumentReference, data: Dict[str, Any], merge: bool = False):
+        self.ops.append(('set', reference, data, merge))
+
+    def update(self, reference: MemoryDocumentReference, data: Dict[str, Any]):
+        self.ops.append(('update', reference, data, False))
+
+    def delete(self, reference: MemoryDocumentReference):
+        self.ops.append(('delete', reference, None, False))
+
+    def commit(self):
+        if len(self.ops) > self.MAX_OPERATIONS:
+            raise ValueError(f"400 A write batch can contain at most {self.MAX_OPERATIONS} operations")
+        if self.db.commit_latency_ms:
+            time.sleep(self.db.commit_latency_ms / 1000)
+        self.db._apply(self.ops)
+        self.ops = []
+
+
+def _document_size(value: Any) -> int:
+    """Approximate stored size of a Firestore value, following the documented size rules"""
+    if isinstance(value, str):
+        return len(value.encode('utf-8')) + 1
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(len(str(key).encode('utf-8')) + 1 + _document_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(_document_size(item) for item in value)
+    return 8
+
+
+class MemoryVector(list):
+    """Stand-in for google.cloud.firestore_v1.vector.Vector"""
+
+
+class _ServerTimestamp:
+    def __repr__(self) -> str:
+        return 'SERVER_TIMESTAMP'
+
+
+class MemoryFirestore:
+    """
+    In-memory Firestore: collections of plain dicts behind one lock, with atomic batch commits.
+    commit_latency_ms adds a fixed delay per batch commit to approximate a network round trip.
+    Writes of documents over Firestore's 1 MiB limit are rejected as they would be by the service.
+    Vector and SERVER_TIMESTAMP replace the Google SDK's, so offline runs work without it.
+    """
+
+    MAX_DOCUMENT_BYTES = 1024 * 1024
+    Vector = MemoryVector
+    SERVER_TIMESTAMP = _ServerTimestamp()
+    # No hot-spotting to protect against, so write engines skip Firestore's 500 ops/s ramp
+    RAMP_UP = False
+
+    def __init__(self, commit_latency_ms: float = 0.0):
+        self.commit_latency_ms = commit_latency_ms
+        self.lock = threading.Lock()
+        self.collections: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self.commits = 0
+
+    def collection(self, name: str) -> MemoryCollection:
+        return MemoryCollection(self, name)
+
+    def batch(self) -> MemoryWriteBatch:
+        return MemoryWriteBatch(self)
+
+    def _apply(self, ops):
+        for kind, reference, data, _ in ops:
+            if kind != 'delete' and _document_size(data) > self.MAX_DOCUMENT_BYTES:
+                raise ValueError(f"400 Document {reference.path} exceeds the maximum size of {self.MAX_DOCUMENT_BYTES} bytes")
+        now = datetime.now(timezone.utc)
+        with self.lock:
+            self.commits += 1
+            for kind, reference, data, merge in ops:
+                if data is not None:
+                    data = {key: now if value is self.SERVER_TIMESTAMP else value for key, value in data.items()}
+                documents = self.collections.setdefault(reference.collection_name, {})
+                if kind == 'delete':
+                    documents.pop(reference.id, None)
+                elif kind == 'update':
+                    if reference.id not in documents:
+                        raise KeyError(f"404 No document to update: {reference.path}")
+                    documents[reference.id].update(data)
+                elif merge and reference.id in documents:
+                    documents[reference.id].update(data)
+                else:
+                    documents[reference.id] = dict(data)
+
+    def count(self, collection: str) -> int:
+        with self.lock:
+            return len(self.collections.get(collection, {}))
+
+
+_WORDS = ("the of and to in is that for it as with was on be by this are from or an at which have not has "
+          "data model system report analysis revenue customer market growth risk policy process quarter "
+          "results product service team project budget forecast strategy security compliance review "
+          "performance increase decrease approval contract vendor invoice schedule deadline summary").split()
+
+
+def _paragraph(rng: random.Random, sentences: int) -> str:
+    parts = []
+    for _ in range(sentences):
+        words = [rng.choice(_WORDS) for _ in range(rng.randint(6, 24))]
+        parts.append(' '.join(words).capitalize() + '.')
+    return ' '.join(parts)
+
+
+def generate_synthetic_corpus(root: str, bucket: str, prefix: str, files: int, file_kb: int,
+                              seed: int = 0, boilerplate_ratio: float = 0.1) -> Dict[str, Any]:
+    """
+    Write a reproducible corpus of .txt/.md/.csv/.json files of about file_kb each under
+    root/bucket/prefix. Text has sentence and paragraph structure so the splitter's separators
+    are exercised, and boilerplate_ratio of the paragraphs are shared across files (like
+    disclaimers and headers in real corpora). PDFs are not generated.
+    """
+    rng = random.Random(seed)
+    boilerplate = [_paragraph(rng, 4) for _ in range(8)]
+    directory = os.path.join(root, bucket, prefix)
+    os.makedirs(directory, exist_ok=True)
+    extensions = itertools.cycle(['.txt', '.md', '.csv', '.txt', '.json'])
+    total_bytes = 0
+    for index in range(files):
+        extension = next(extensions)
+        target = file_kb * 1024
+        if extension == '.csv':
+            lines = ['id,category,amount,description']
+            size = len(lines[0])
+            while size < target:
+                line = f"{len(lines)},{rng.choice(_WORDS)},{rng.randint(1, 100000)},\"{_paragraph(rng, 1)}\""
+                lines.append(line)
+                size += len(line) + 1
+            content = '\n'.join(lines)
+        elif extension == '.json':
+            records = []
+            size = 0
+            while size < target:
+                record = {'id': len(records), 'title': _paragraph(rng, 1), 'body': _paragraph(rng, 3)}
+                records.append(record)
+                size += len(json.dumps(record))
+            content = json.dumps({'records': records})
+        else:
+            paragraphs = []
+            size = 0
+            while size < target:
+                paragraph = rng.choice(boilerplate) if rng.random() < boilerplate_ratio else _paragraph(rng, rng.randint(3, 8))
+                if extension == '.md' and rng.random() < 0.2:
+                    paragraph = f"## {_paragraph(rng, 1)}\n\n{paragraph}"
+                paragraphs.append(paragraph)
+                size += len(paragraph) + 2
+            content = '\n\n'.join(paragraphs)
+        path = os.path.join(directory, f"doc_{index:06d}{extension}")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        total_bytes += len(content.encode('utf-8'))
+    return {'files': files, 'bytes': total_bytes, 'path': directory}
@@ -0,0 +1,89 @@
+"""
+Shared fixtures for the offline tests: a corpus in a temporary directory bucket served through
+rag_local_backends, the hash embedder and one in-memory Firestore per test.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import gemini_rag_1536 as rag
+import rag_local_backends
+
+DIMENSIONS = 64
+
+PARAGRAPH = "Quarterly revenue grew in every region while operating costs stayed flat. " * 6
+
+
+def document(seed: int, paragraphs: int = 30) -> str:
+    """Reproducible paragraphs of random words, some with multibyte characters"""
+    words = ['alpha', 'beta', 'gamma', 'delta', 'émile', 'naïve', 'zeta', 'données', '✓']
+    rng = np.random.default_rng(seed)
+    return '\n\n'.join(' '.join(rng.choice(words, 60)) for _ in range(paragraphs)) + '\n'
+
+
+class FailingEmbeddings(rag_local_backends.HashEmbeddings):
+    """Hash embedder that rejects any request containing a chunk with the marker while fail is set"""
+
+    def __init__(self, marker: str):
+        super().__init__()
+        self.marker = marker
+        self.fail = True
+
+    def embed(self, texts, dimensions: int = 768, **kwargs):
+        if self.fail and any(self.marker in text for text in texts):
+            raise ValueError(f"400 chunk containing {self.marker} rejected")
+        return super().embed(texts, dimensions=dimensions, **kwargs)
+
+
+class OfflineRunTest(unittest.TestCase):
+    """A corpus under <root>/bucket/docs served as gs://bucket/docs, and one in-memory Firestore per test"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='rag-offline-test-')
+        self.docs = os.path.join(self.root, 'bucket', 'docs')
+        os.makedirs(self.docs)
+        self.db = rag_local_backends.MemoryFirestore()
+        self.storage = rag_local_backends.LocalStorageClient(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def write_file(self, name: str, text: str):
+        with open(os.path.join(self.docs, name), 'w', encoding='utf-8') as f:
+            f.write(text)
+
+    def populator(self, bucket_path: str = 'gs://bucket/docs', **kwargs) -> rag.GeminiRAGPopulator:
+        kwargs.setdefault('embeddings', rag_local_backends.HashEmbeddings())
+        kwargs.setdefault('db', self.db)
+        populator = rag.GeminiRAGPopulator(bucket_path, DIMENSIONS, firestore_mode='memory',
+                                           storage_client=self.storage, **kwargs)
+        self.addCleanup(populator.close)
+        return populator
+
+    def run_populator(self, **kwargs) -> dict:
+        populator = self.populator(**kwargs)
+        stats = populator.process_all_files()
+        populator.close()
+        return stats
+
+    def documents(self, collection: str, db=None) -> dict:
+        return {snapshot.id: snapshot.to_dict() for snapshot in (db or self.db).collection(collection).stream()}
+
+    def source(self, name: str) -> dict:
+        return next(source for source in self.documents('sources').values() if source['fileName'] == f'docs/{name}')
+
+    def assertChunksMatchSources(self):
+        """Every source's chunks, and no others, are in the embeddings collection"""
+        sources = self.documents('sources')
+        chunk_id = rag.GeminiRAGPopulator._chunk_doc_id
+        expected = {chunk_id(source_id, index) for source_id, source in sources.items() for index in range(source['chunkCount'])}
+        for source_id, source in sources.items():
+            expected -= {chunk_id(source_id, int(index)) for index in source.get('duplicateChunks', {})}
+        self.assertEqual(set(self.documents('embeddings')), expected)
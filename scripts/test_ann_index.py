@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Local IVF-flat index: recall against exact search, the chunk ID side table and spool recovery"""
+
+import os
+import unittest
+
+import numpy as np
+
+import gemini_rag_1536 as rag
+from rag_test_utils import DIMENSIONS, OfflineRunTest, document
+
+
+def _clustered_vectors(count: int, dimensions: int, clusters: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dimensions))
+    vectors = centers[rng.integers(clusters, size=count)] + 0.3 * rng.standard_normal((count, dimensions))
+    return rag._normalize_rows(vectors).astype(np.float32)
+
+
+class AnnIndexTest(OfflineRunTest):
+    def writer(self, merge_existing: bool = False, dimensions: int = 32, **kwargs) -> rag.AnnIndexWriter:
+        writer = rag.AnnIndexWriter(os.path.join(self.root, 'index'), dimensions, merge_existing=merge_existing, **kwargs)
+        self.addCleanup(writer.close)
+        return writer
+
+    def test_recall_against_exact_search(self):
+        vectors = _clustered_vectors(3000, 32, clusters=30)
+        chunk_ids = [f"chunk{index}" for index in range(len(vectors))]
+        writer = self.writer(lists=30)
+        for start in range(0, len(vectors), 500):
+            writer.add(chunk_ids[start:start + 500], vectors[start:start + 500])
+        self.assertEqual(writer.build()['vectors'], 3000)
+        index = rag.IvfFlatIndex(writer.path)
+        self.assertEqual(sorted(index.chunk_ids), sorted(chunk_ids))
+
+        rng = np.random.default_rng(1)
+        queries = vectors[rng.choice(len(vectors), 50, replace=False)] + 0.1 * rng.standard_normal((50, 32))
+        found = 0
+        for query in queries:
+            exact = {chunk_ids[i] for i in np.argsort(-(vectors @ rag._normalize_rows(query[None])[0]))[:10]}
+            found += len(exact & {chunk_id for chunk_id, _ in index.search(query, k=10, n_probe=8)})
+        self.assertGreaterEqual(found / (10 * len(queries)), 0.9)
+
+    def test_chunk_ids_map_to_their_vectors(self):
+        self.write_file('a.txt', document(1))
+        self.write_file('b.txt', document(2))
+        self.run_populator(ann_index_path=os.path.join(self.root, 'index'))
+        embeddings = self.documents('embeddings')
+        index = rag.IvfFlatIndex(os.path.join(self.root, 'index'))
+        self.assertEqual(set(index.chunk_ids), set(embeddings))
+        self.assertEqual(index.dimensions, DIMENSIONS)
+        for row, chunk_id in enumerate(index.chunk_ids):
+            np.testing.assert_allclose(index.vectors[row], list(embeddings[chunk_id]['embedding']), atol=1e-6)
+        chunk_id, doc = next(iter(embeddings.items()))
+        best_id, score = index.search(np.array(list(doc['embedding'])), k=1, n_probe=len(index.centroids))[0]
+        self.assertEqual(best_id, chunk_id)
+        self.assertAlmostEqual(score, 1.0, places=5)
+
+    def test_spools_realigned_after_crash(self):
+        vectors = _clustered_vectors(9, 32, clusters=3)
+        writer = self.writer()
+        writer.add([f"chunk{index}" for index in range(5)], vectors[:5])
+        # A crash after the vector bytes of two rows, midway through their IDs
+        writer.vectors_file.write(vectors[5:7].tobytes())
+        writer.ids_file.write(b"chunk5\nchu")
+        writer.close()
+
+        resumed = self.writer(merge_existing=True)
+        resumed.add(['chunk7', 'chunk8'], vectors[7:9])
+        self.assertEqual(resumed.build()['vectors'], 8)
+        index = rag.IvfFlatIndex(resumed.path)
+        self.assertEqual(sorted(index.chunk_ids), sorted(f"chunk{index}" for index in (0, 1, 2, 3, 4, 5, 7, 8)))
+        for row, chunk_id in enumerate(index.chunk_ids):
+            np.testing.assert_allclose(index.vectors[row], vectors[int(chunk_id[5:])], atol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Checkpointed resume of interrupted runs, and removal of a previous version's chunks after a failed run"""
+
+import os
+import unittest
+
+import rag_local_backends
+from rag_test_utils import FailingEmbeddings, OfflineRunTest, document
+
+
+class CheckpointResumeTest(OfflineRunTest):
+    def test_resume_after_interrupted_stream(self):
+        # Over stream_threshold_mb, so it is streamed and checkpointed every stream_chunk_group chunks
+        streamed = ''.join(document(seed) for seed in range(120)) + 'POISON ' * 50 + '\n'
+        self.write_file('big.txt', streamed)
+        self.write_file('small.txt', document(99))
+        checkpoint = os.path.join(self.root, 'checkpoint.jsonl')
+
+        embeddings = FailingEmbeddings('POISON')
+        populator = self.populator(embeddings=embeddings, checkpoint_path=checkpoint, stream_threshold_mb=1,
+                                   stream_window_mb=1)
+        populator.batcher.max_retries = 0
+        first = populator.process_all_files()
+        populator.close()
+        self.assertEqual((first['successful'], first['failed']), (1, 1))
+        written_before = len(self.documents('embeddings'))
+        self.assertGreater(written_before, populator.stream_chunk_group)
+
+        embeddings.fail = False
+        embeddings.texts = 0
+        resumed = self.run_populator(embeddings=embeddings, checkpoint_path=checkpoint, resume=True,
+                                     stream_threshold_mb=1, stream_window_mb=1)
+        self.assertEqual((resumed['resumed_skipped'], resumed['successful']), (1, 1))
+        source = self.source('big.txt')
+        self.assertEqual(source['status'], 'processed')
+        # Only the chunks after the last checkpointed batch were embedded again
+        self.assertLess(embeddings.texts, source['chunkCount'])
+        self.assertChunksMatchSources()
+
+        # The same chunks as an uninterrupted run
+        clean_db = rag_local_backends.MemoryFirestore()
+        self.run_populator(db=clean_db, stream_threshold_mb=1, stream_window_mb=1)
+        self.assertEqual({doc_id: doc['text'] for doc_id, doc in self.documents('embeddings').items()},
+                         {doc_id: doc['text'] for doc_id, doc in self.documents('embeddings', clean_db).items()})
+
+
+class FailedRunStaleChunksTest(OfflineRunTest):
+    def failing_run(self, **kwargs):
+        embeddings = FailingEmbeddings('POISON')
+        populator = self.populator(embeddings=embeddings, **kwargs)
+        populator.batcher.max_retries = 0
+        self.assertEqual(populator.process_all_files()['failed'], 1)
+        populator.close()
+        embeddings.fail = False
+        return embeddings
+
+    def test_shrunk_file_after_failed_run(self):
+        self.write_file('a.txt', document(1, paragraphs=60))
+        self.run_populator()
+        self.assertGreater(self.source('a.txt')['chunkCount'], 20)
+        # The shorter version fails, then succeeds: the longer version's tail is still removed
+        self.write_file('a.txt', document(2, paragraphs=5) + 'POISON\n')
+        embeddings = self.failing_run()
+        self.run_populator(embeddings=embeddings)
+        self.assertLess(self.source('a.txt')['chunkCount'], 10)
+        self.assertChunksMatchSources()
+
+    def test_failed_stream_longer_than_previous_version(self):
+        self.write_file('big.txt', document(1, paragraphs=10))
+        self.run_populator()
+        # Streamed chunk groups commit past the previous chunk count before the stream fails
+        self.write_file('big.txt', ''.join(document(seed) for seed in range(120)) + 'POISON ' * 50 + '\n')
+        embeddings = self.failing_run(stream_threshold_mb=1, stream_window_mb=1)
+        self.assertGreater(len(self.documents('embeddings')), 1000)
+        self.write_file('big.txt', document(3, paragraphs=5))
+        self.run_populator(embeddings=embeddings)
+        self.assertEqual(self.source('big.txt')['status'], 'processed')
+        self.assertChunksMatchSources()
+
+
+if __name__ == '__main__':
+    unittest.main()
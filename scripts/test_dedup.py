@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""Exact deduplication of chunks and whole documents across the files of a run"""
+
+import unittest
+
+import rag_local_backends
+from rag_test_utils import PARAGRAPH, OfflineRunTest, document
+
+
+class DedupTest(OfflineRunTest):
+    def test_exact_duplicates(self):
+        shared = '\n\n'.join([PARAGRAPH] * 8)
+        self.write_file('a.txt', shared + '\n\n' + document(1))
+        self.write_file('b.txt', document(2) + '\n\n' + shared)
+        self.write_file('c.txt', shared + '\n\n' + document(1))
+        embeddings = rag_local_backends.HashEmbeddings()
+        stats = self.run_populator(dedup='exact', embeddings=embeddings)
+        self.assertEqual((stats['successful'], stats['duplicate_files']), (2, 1))
+
+        sources = self.documents('sources')
+        duplicate = next(source for source in sources.values() if source['status'] == 'duplicate')
+        self.assertIn(duplicate['duplicateOf'], sources)
+        embedding_docs = self.documents('embeddings')
+        pointers = {}
+        for source in sources.values():
+            pointers.update(source.get('duplicateChunks', {}))
+        self.assertTrue(pointers)
+        # Each pointer names a chunk that was written, with the same text
+        for canonical in pointers.values():
+            self.assertIn(canonical, embedding_docs)
+        self.assertEqual(embeddings.texts, len(embedding_docs))
+        self.assertEqual(len({doc['text'] for doc in embedding_docs.values()}), len(embedding_docs))
+
+
+if __name__ == '__main__':
+    unittest.main()
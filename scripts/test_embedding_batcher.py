@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""Shared embedding requests: packing, error classification, AIMD concurrency, budgets and requeues"""
+
+import threading
+import unittest
+from unittest import mock
+
+import gemini_rag_1536 as rag
+import rag_local_backends
+
+DIMENSIONS = 16
+
+
+class ResourceExhausted(Exception):
+    """Named like google.api_core.exceptions.ResourceExhausted"""
+    code = 429
+
+
+class InvalidArgument(Exception):
+    code = 400
+
+
+class StatusCode:
+    """Stands in for a grpc.StatusCode member"""
+
+    def __init__(self, name: str):
+        self.name = name
+
+
+class RpcError(Exception):
+    def __init__(self, status: str, message: str):
+        super().__init__(message)
+        self._status = StatusCode(status)
+
+    def code(self):
+        return self._status
+
+
+class RecordingEmbeddings(rag_local_backends.HashEmbeddings):
+    """Hash embedder that records request sizes and raises queued errors on the next calls"""
+
+    def __init__(self, errors=(), **kwargs):
+        super().__init__(**kwargs)
+        self.errors = list(errors)
+        self.requests = []
+
+    def embed(self, texts, dimensions=768, **kwargs):
+        with self.lock:
+            self.requests.append(list(texts))
+            error = self.errors.pop(0) if self.errors else None
+        if error is not None:
+            raise error
+        return super().embed(texts, dimensions=dimensions, **kwargs)
+
+
+class ClassifyEmbeddingErrorTest(unittest.TestCase):
+    def test_by_type_and_code(self):
+        cases = [
+            (ResourceExhausted('Quota exceeded'), 'rate_limit'),
+            (rag_local_backends.InjectedRateLimit('requests per minute'), 'rate_limit'),
+            (RpcError('RESOURCE_EXHAUSTED', 'try again later'), 'rate_limit'),
+            (InvalidArgument('Request payload size exceeds the limit'), 'too_large'),
+            (RpcError('INVALID_ARGUMENT', 'input token count too large'), 'too_large'),
+            (InvalidArgument('unsupported task type'), 'other'),
+            (rag_local_backends.InjectedFailure('503 quota service unavailable'), 'other'),
+        ]
+        for error, kind in cases:
+            self.assertEqual(rag._classify_embedding_error(error), kind, repr(error))
+
+    def test_message_fallback(self):
+        cases = [
+            (ValueError('429 Too Many Requests'), 'rate_limit'),
+            (RuntimeError('Quota exceeded for aiplatform.googleapis.com'), 'rate_limit'),
+            (ValueError('400 Request too large: 300 texts exceed the limit of 250'), 'too_large'),
+            # Status-like numbers inside a message are not a status
+            (ValueError('chunk 429 of file 400.txt exceeds the sizes we expected'), 'other'),
+            (ValueError('timeout after 4000 ms'), 'other'),
+            (ValueError('400 chunk containing POISON rejected'), 'other'),
+        ]
+        for error, kind in cases:
+            self.assertEqual(rag._classify_embedding_error(error), kind, repr(error))
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_refill_and_debt(self):
+        bucket = rag.TokenBucket(per_minute=60, burst_seconds=10)
+        start = bucket.updated
+        self.assertEqual(bucket.wait_time(10, start), 0.0)
+        bucket.take(10, start)
+        self.assertAlmostEqual(bucket.wait_time(2, start), 2.0)
+        self.assertEqual(bucket.wait_time(2, start + 2), 0.0)
+        # Larger than the bucket: it waits for a full bucket, then leaves it in debt
+        self.assertAlmostEqual(bucket.wait_time(25, start + 2), 8.0)
+        bucket.take(25, start + 10)
+        self.assertAlmostEqual(bucket.wait_time(1, start + 10), 16.0)
+
+
+class EmbeddingBatcherTest(unittest.TestCase):
+    def batcher(self, embeddings, **kwargs) -> rag.EmbeddingBatcher:
+        batcher = rag.EmbeddingBatcher(embeddings, DIMENSIONS, **kwargs)
+        self.addCleanup(batcher.close)
+        return batcher
+
+    def assertEmbedded(self, texts, vectors):
+        self.assertEqual(len(vectors), len(texts))
+        for text, vector in zip(texts, vectors):
+            self.assertEqual(vector, rag_local_backends.HashEmbeddings.vector(text, DIMENSIONS))
+
+    def embed_concurrently(self, batcher, groups):
+        results = {}
+
+        def embed(group):
+            results[group[0]] = batcher.embed(group)
+
+        threads = [threading.Thread(target=embed, args=(group,)) for group in groups]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return [results[group[0]] for group in groups]
+
+    def test_texts_from_several_callers_share_requests(self):
+        embeddings = RecordingEmbeddings()
+        batcher = self.batcher(embeddings, max_items=50, linger_seconds=0.2)
+        groups = [[f"caller {caller} text {index}" for index in range(10)] for caller in range(4)]
+        for group, vectors in zip(groups, self.embed_concurrently(batcher, groups)):
+            self.assertEmbedded(group, vectors)
+        self.assertLess(len(embeddings.requests), len(groups))
+        self.assertTrue(any(len({text.split()[1] for text in request}) > 1 for request in embeddings.requests))
+
+    def test_character_budget(self):
+        embeddings = RecordingEmbeddings()
+        batcher = self.batcher(embeddings, max_items=50, max_chars=200, linger_seconds=0.1)
+        texts = [f"text number {index:03d}" for index in range(40)]
+        self.assertEmbedded(texts, batcher.embed(texts))
+        self.assertTrue(all(sum(len(text) for text in request) <= 200 for request in embeddings.requests))
+        self.assertEqual(len(embeddings.requests), 4)
+
+    def test_too_large_request_split(self):
+        embeddings = RecordingEmbeddings(max_texts_per_request=3)
+        batcher = self.batcher(embeddings, max_items=16, linger_seconds=0.1)
+        texts = [f"text {index}" for index in range(16)]
+        self.assertEmbedded(texts, batcher.embed(texts))
+        stats = batcher.stats()
+        self.assertGreater(stats['batch_shrinks'], 0)
+        self.assertEqual(stats['failed_chunks'], 0)
+        self.assertLessEqual(stats['batch_items'], 8)
+
+    def test_concurrency_halved_once_per_congestion_event(self):
+        batcher = self.batcher(RecordingEmbeddings(), max_in_flight=8)
+        batcher._start()
+        epoch = batcher._limit_epoch
+        batcher._on_rate_limit(epoch)
+        # Another request launched before the decrease reports the same congestion
+        batcher._on_rate_limit(epoch)
+        self.assertEqual(batcher.concurrency, 4.0)
+        self.assertEqual(batcher.stats()['rate_limited'], 2)
+        self.assertGreater(batcher._paused_until, batcher._loop.time())
+        batcher._on_rate_limit(batcher._limit_epoch)
+        self.assertEqual(batcher.concurrency, 2.0)
+        # Additive increase: about one per round of successful requests
+        batcher._grow()
+        batcher._grow()
+        self.assertAlmostEqual(batcher.concurrency, 2.9)
+        for _ in range(40):
+            batcher._grow()
+        self.assertEqual(batcher.concurrency, 8.0)
+
+    @mock.patch.object(rag.random, 'uniform', return_value=0.0)
+    def test_rate_limited_chunks_requeued(self, uniform):
+        embeddings = RecordingEmbeddings(errors=[rag_local_backends.InjectedRateLimit('429 Quota exceeded (injected)')])
+        batcher = self.batcher(embeddings, max_in_flight=4)
+        texts = [f"text {index}" for index in range(10)]
+        self.assertEmbedded(texts, batcher.embed(texts))
+        stats = batcher.stats()
+        self.assertEqual((stats['rate_limited'], stats['requeued'], stats['failed_chunks']), (1, 10, 0))
+        self.assertLess(batcher.concurrency, 4)
+
+    @mock.patch.object(rag.random, 'uniform', return_value=0.0)
+    def test_other_errors_retried_then_failed(self, uniform):
+        failure = rag_local_backends.InjectedFailure('503 Service unavailable (injected)')
+        embeddings = RecordingEmbeddings(errors=[failure, failure])
+        batcher = self.batcher(embeddings, max_retries=2)
+        texts = ['first', 'second']
+        self.assertEmbedded(texts, batcher.embed(texts))
+        self.assertEqual(batcher.stats()['retries'], 2)
+
+        embeddings.errors = [failure] * 3
+        with self.assertRaises(rag_local_backends.InjectedFailure):
+            batcher.embed(['third'])
+        self.assertEqual(batcher.stats()['failed_chunks'], 1)
+
+    def test_tokens_per_minute_paces_requests(self):
+        # 100 tokens a second, at most 1,000 banked; 11 requests of 100 tokens wait about a second
+        batcher = self.batcher(RecordingEmbeddings(), max_items=1, tokens_per_minute=6000)
+        texts = [f"{index:02d}" + 'x' * 398 for index in range(11)]
+        self.assertEmbedded(texts, batcher.embed(texts))
+        stats = batcher.stats()
+        self.assertGreater(stats['throttled_requests'], 0)
+        self.assertGreater(stats['throttled_seconds'], 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
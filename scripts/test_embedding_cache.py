@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""Content-addressed embedding cache: LRU eviction by size, persistence and hit counting in a run"""
+
+import os
+import time
+import unittest
+
+import numpy as np
+
+import gemini_rag_1536 as rag
+import rag_local_backends
+from rag_test_utils import DIMENSIONS, PARAGRAPH, OfflineRunTest, document
+
+CACHE_DIMENSIONS = 8
+# A 64-character hex key and 8 float32 values
+ENTRY_BYTES = 64 + 4 * CACHE_DIMENSIONS
+
+
+class EmbeddingCacheTest(OfflineRunTest):
+    def open_cache(self, max_entries: int = 10, dimensions: int = CACHE_DIMENSIONS) -> rag.EmbeddingCache:
+        cache = rag.EmbeddingCache(os.path.join(self.root, 'cache.sqlite'), 'model', dimensions, max_entries * ENTRY_BYTES)
+        self.addCleanup(cache.close)
+        return cache
+
+    @staticmethod
+    def vector(text: str):
+        return rag_local_backends.HashEmbeddings.vector(text, CACHE_DIMENSIONS)
+
+    def put(self, cache: rag.EmbeddingCache, text: str):
+        cache.put_many([text], [self.vector(text)])
+        # Distinct last_used times, so the eviction order is well defined
+        time.sleep(0.002)
+
+    def test_least_recently_used_evicted_first(self):
+        cache = self.open_cache(max_entries=10)
+        texts = [f"text {index}" for index in range(10)]
+        for text in texts:
+            self.put(cache, text)
+        self.assertEqual(cache.total_bytes, 10 * ENTRY_BYTES)
+        # A lookup makes the oldest entry the most recently used
+        cache.get_many([texts[0]])
+        time.sleep(0.002)
+        self.put(cache, 'text 10')
+        # Over max_bytes, entries are dropped down to 90%: the two least recently used
+        self.assertEqual(cache.evictions, 2)
+        self.assertEqual(cache.total_bytes, 9 * ENTRY_BYTES)
+        cached = cache.get_many(texts + ['text 10'])
+        self.assertEqual([text for text, vector in zip(texts + ['text 10'], cached) if vector is None], ['text 1', 'text 2'])
+        # Stored as float32
+        np.testing.assert_allclose(cached[0], self.vector(texts[0]), rtol=1e-6)
+
+    def test_persistent_and_keyed_on_dimensions(self):
+        cache = self.open_cache()
+        self.put(cache, 'kept')
+        cache.close()
+        reopened = self.open_cache()
+        self.assertEqual(reopened.total_bytes, ENTRY_BYTES)
+        np.testing.assert_allclose(reopened.get_many(['kept'])[0], self.vector('kept'), rtol=1e-6)
+        self.assertEqual(self.open_cache(dimensions=16).get_many(['kept']), [None])
+
+    def test_rewrite_does_not_grow_the_size(self):
+        cache = self.open_cache()
+        for _ in range(3):
+            self.put(cache, 'same')
+        self.assertEqual(cache.total_bytes, ENTRY_BYTES)
+
+
+class EmbeddingCacheRunTest(OfflineRunTest):
+    def test_second_run_served_from_cache(self):
+        # The shared paragraph repeats within and across files, so only its first occurrence is embedded
+        shared = '\n\n'.join([PARAGRAPH] * 4)
+        for index in range(3):
+            self.write_file(f'file{index}.txt', document(index, paragraphs=4) + '\n\n' + shared)
+        cache_path = os.path.join(self.root, 'cache.sqlite')
+        embeddings = rag_local_backends.HashEmbeddings()
+        first = self.run_populator(embedding_cache_path=cache_path, embeddings=embeddings)
+        cache_stats = first['embedding_cache']
+        self.assertEqual(cache_stats['hits'] + cache_stats['misses'], first['total_chunks'])
+        self.assertEqual(embeddings.texts, len({doc['text'] for doc in self.documents('embeddings').values()}))
+        self.assertGreater(cache_stats['hits'], 0)
+
+        embeddings.texts = 0
+        second_db = rag_local_backends.MemoryFirestore()
+        second = self.run_populator(embedding_cache_path=cache_path, embeddings=embeddings, db=second_db)
+        self.assertEqual(embeddings.texts, 0)
+        self.assertEqual((second['embedding_cache']['hits'], second['embedding_cache']['misses']), (second['total_chunks'], 0))
+        for doc_id, doc in self.documents('embeddings', second_db).items():
+            self.assertEqual(len(doc['embedding']), DIMENSIONS)
+            np.testing.assert_allclose(list(doc['embedding']), list(self.documents('embeddings')[doc_id]['embedding']), rtol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
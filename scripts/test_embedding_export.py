@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Embedding export shards (npy or Parquet), re-import without embedding requests, and spool recovery"""
+
+import importlib.util
+import json
+import os
+import unittest
+
+import numpy as np
+
+import gemini_rag_1536 as rag
+import rag_local_backends
+from rag_test_utils import DIMENSIONS, OfflineRunTest, document
+
+
+class ExportImportTest(OfflineRunTest):
+    def round_trip(self, export_format: str):
+        for index in range(3):
+            self.write_file(f'file{index}.txt', document(index))
+        export = os.path.join(self.root, 'export')
+        self.run_populator(export_path=export, export_format=export_format, export_shard_rows=20,
+                           incremental=True, manifest_backend='firestore')
+        # A changed file supersedes its rows and a deleted one removes them
+        self.write_file('file0.txt', document(50, paragraphs=4))
+        os.remove(os.path.join(self.docs, 'file1.txt'))
+        self.run_populator(export_path=export, export_format=export_format, export_shard_rows=20,
+                           incremental=True, manifest_backend='firestore')
+        with open(os.path.join(export, 'manifest.json')) as f:
+            self.assertEqual({shard['format'] for shard in json.load(f)['shards']}, {export_format})
+
+        imported_db = rag_local_backends.MemoryFirestore()
+        importer = rag.GeminiRAGPopulator('', DIMENSIONS, firestore_mode='memory', db=imported_db)
+        self.addCleanup(importer.close)
+        stats = importer.import_embedding_shards(export)
+        importer.close()
+        original, imported = self.documents('embeddings'), self.documents('embeddings', imported_db)
+        self.assertEqual(set(imported), set(original))
+        self.assertEqual(stats['imported'], len(original))
+        for doc_id, doc in original.items():
+            for field in ('text', 'fileName', 'sourceId', 'chunkIndex', 'chunkId'):
+                self.assertEqual(imported[doc_id][field], doc[field])
+            np.testing.assert_allclose(list(imported[doc_id]['embedding']), list(doc['embedding']), atol=1e-6)
+
+    def test_npy_round_trip(self):
+        self.round_trip('npy')
+
+    @unittest.skipIf(importlib.util.find_spec('pyarrow') is None, 'pyarrow not installed')
+    def test_parquet_round_trip(self):
+        self.round_trip('parquet')
+
+
+class ExportSpoolTest(OfflineRunTest):
+    DIMENSIONS = 8
+
+    def writer(self, merge_existing: bool = False) -> rag.EmbeddingExportWriter:
+        writer = rag.EmbeddingExportWriter(os.path.join(self.root, 'export'), self.DIMENSIONS, shard_rows=100,
+                                           merge_existing=merge_existing)
+        self.addCleanup(writer.close)
+        return writer
+
+    @staticmethod
+    def row(index: int) -> dict:
+        return {'chunkId': f"chunk{index}", 'sourceId': 'source', 'fileName': 'docs/a.txt', 'chunkIndex': index,
+                'totalChunks': 9, 'text': f"text {index}"}
+
+    def test_spools_realigned_after_crash(self):
+        vectors = np.arange(9 * self.DIMENSIONS, dtype=np.float32).reshape(9, self.DIMENSIONS)
+        writer = self.writer()
+        writer.add([self.row(index) for index in range(5)], vectors[:5])
+        # A crash after the vector bytes of two rows, midway through their metadata lines
+        writer.vectors_file.write(vectors[5:7].tobytes())
+        writer.rows_file.write((json.dumps(self.row(5)) + '\n' + json.dumps(self.row(6))[:20]).encode('utf-8'))
+        writer.removed_file.write(b"chunk")
+        writer.close()
+
+        resumed = self.writer(merge_existing=True)
+        self.assertEqual(resumed.pending_rows, 6)
+        resumed.add([self.row(7), self.row(8)], vectors[7:9])
+        resumed.flush()
+        shards = list(rag.EmbeddingShardReader(resumed.path).iter_live())
+        self.assertEqual(len(shards), 1)
+        _, rows, shard_vectors = shards[0]
+        self.assertEqual([row['chunkIndex'] for row in rows], [0, 1, 2, 3, 4, 5, 7, 8])
+        for row, vector in zip(rows, shard_vectors):
+            np.testing.assert_array_equal(vector, vectors[row['chunkIndex']])
+        self.assertEqual(shards[0][0]['removed'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""Incremental ingest: the SQLite and Firestore manifests and re-runs over changed, deleted and new files"""
+
+import os
+import unittest
+
+import gemini_rag_1536 as rag
+from rag_test_utils import OfflineRunTest, document
+
+# Characters after the prefix at or above U+F900, which an upper bound of U+F8FF used to cut off
+UNUSUAL_NAMES = ['bucket/docs/😀.txt', 'bucket/docs/ｆｕｌｌ.txt', 'bucket/docs/100%_done.txt', 'bucket/docs/a.txt']
+
+
+class ManifestNamesTest(OfflineRunTest):
+    def check_names(self, manifest):
+        for name in UNUSUAL_NAMES + ['bucket/docs-old/b.txt', 'bucket/doc', 'other/docs/c.txt']:
+            manifest.put({'name': name, 'generation': '1', 'md5_hash': None, 'crc32c': None, 'dimensions': 64,
+                          'source_id': None, 'chunk_ids': [], 'text_layout': {}})
+        self.assertEqual(sorted(manifest.names('bucket/docs/')), sorted(UNUSUAL_NAMES))
+        self.assertEqual(len(manifest.names()), len(UNUSUAL_NAMES) + 3)
+
+    def test_sqlite(self):
+        manifest = rag.SQLiteManifest(os.path.join(self.root, 'manifest.sqlite'))
+        self.addCleanup(manifest.close)
+        self.check_names(manifest)
+
+    def test_firestore(self):
+        self.check_names(rag.FirestoreManifest(self.db))
+
+
+class IncrementalTest(OfflineRunTest):
+    def test_changed_deleted_and_new_files(self):
+        for index in range(4):
+            self.write_file(f'file{index}.txt', document(index))
+        first = self.run_populator(incremental=True, manifest_path=os.path.join(self.root, 'manifest.sqlite'))
+        self.assertEqual(first['successful'], 4)
+        self.assertChunksMatchSources()
+
+        self.write_file('file0.txt', document(100, paragraphs=3))
+        os.remove(os.path.join(self.docs, 'file1.txt'))
+        self.write_file('file4.txt', document(4))
+        second = self.run_populator(incremental=True, manifest_path=os.path.join(self.root, 'manifest.sqlite'))
+        self.assertEqual(second['unchanged_skipped'], 2)
+        self.assertEqual(second['total_files'], 2)
+        self.assertEqual(second['deleted_files'], 1)
+        self.assertEqual({source['fileName'] for source in self.documents('sources').values()},
+                         {'docs/file0.txt', 'docs/file2.txt', 'docs/file3.txt', 'docs/file4.txt'})
+        # The shrunken file's old tail chunks were removed
+        self.assertChunksMatchSources()
+
+        third = self.run_populator(incremental=True, manifest_path=os.path.join(self.root, 'manifest.sqlite'))
+        self.assertEqual((third['unchanged_skipped'], third['total_files']), (4, 0))
+
+    def test_firestore_manifest(self):
+        for index in range(3):
+            self.write_file(f'file{index}.txt', document(index))
+        self.run_populator(incremental=True, manifest_backend='firestore')
+        self.write_file('file2.txt', document(200, paragraphs=2))
+        stats = self.run_populator(incremental=True, manifest_backend='firestore', pipeline=True)
+        self.assertEqual((stats['unchanged_skipped'], stats['total_files']), (2, 1))
+        self.assertEqual(self.db.count('ingest_manifest'), 3)
+        self.assertChunksMatchSources()
+
+    def test_deleted_files_with_unusual_names_are_removed(self):
+        # A whole-bucket run: the manifest prefix is 'bucket/', so the next character is the name's first
+        def write_top_level(name: str):
+            with open(os.path.join(self.root, 'bucket', name), 'w', encoding='utf-8') as f:
+                f.write(document(len(name)))
+
+        for name in ('😀.txt', 'ｆｕｌｌ.txt', 'plain.txt'):
+            write_top_level(name)
+        for backend in ('sqlite', 'firestore'):
+            kwargs = dict(bucket_path='gs://bucket', incremental=True, manifest_backend=backend,
+                          manifest_path=os.path.join(self.root, 'manifest.sqlite'))
+            self.run_populator(**kwargs)
+            os.remove(os.path.join(self.root, 'bucket', '😀.txt'))
+            os.remove(os.path.join(self.root, 'bucket', 'ｆｕｌｌ.txt'))
+            stats = self.run_populator(**kwargs)
+            self.assertEqual(stats['deleted_files'], 2, backend)
+            self.assertEqual([source['fileName'] for source in self.documents('sources').values()], ['plain.txt'])
+            self.assertChunksMatchSources()
+            for name in ('😀.txt', 'ｆｕｌｌ.txt'):
+                write_top_level(name)
+
+if __name__ == '__main__':
+    unittest.main()
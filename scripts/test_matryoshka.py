@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Matryoshka fields: re-normalized prefixes of each embedding, stored with or instead of the full vector"""
+
+import sys
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import gemini_rag_1536 as rag
+import rag_local_backends
+from rag_test_utils import DIMENSIONS, OfflineRunTest, document
+
+
+class MatryoshkaTruncationTest(unittest.TestCase):
+    def test_unit_length_prefixes(self):
+        embeddings = np.random.default_rng(0).standard_normal((20, 64)).astype(np.float32)
+        embeddings[3] = 0.0
+        truncations = rag.matryoshka_truncations(embeddings, [8, 32])
+        self.assertEqual(sorted(truncations), [8, 32])
+        nonzero = np.delete(embeddings, 3, axis=0)
+        for size, truncated in truncations.items():
+            self.assertEqual(truncated.shape, (20, size))
+            expected = nonzero[:, :size] / np.linalg.norm(nonzero[:, :size], axis=1, keepdims=True)
+            np.testing.assert_allclose(np.delete(truncated, 3, axis=0), expected, rtol=1e-5)
+            np.testing.assert_allclose(np.linalg.norm(np.delete(truncated, 3, axis=0), axis=1), 1.0, rtol=1e-5)
+            # A zero prefix stays zero instead of dividing by zero
+            np.testing.assert_array_equal(truncated[3], 0.0)
+
+
+class MatryoshkaRunTest(OfflineRunTest):
+    def assertPrefixFields(self, sizes, full_vectors):
+        docs = self.documents('embeddings')
+        self.assertTrue(docs)
+        for doc_id, doc in docs.items():
+            full = np.asarray(full_vectors[doc_id], dtype=np.float32)
+            for size in sizes:
+                field = np.asarray(list(doc[rag.matryoshka_field(size)]), dtype=np.float32)
+                self.assertEqual(len(field), size)
+                self.assertAlmostEqual(float(np.linalg.norm(field)), 1.0, places=5)
+                np.testing.assert_allclose(field, full[:size] / np.linalg.norm(full[:size]), rtol=1e-5, atol=1e-6)
+
+    def test_fields_alongside_embedding(self):
+        self.write_file('a.txt', document(1))
+        self.run_populator(matryoshka_dimensions=[16, 32])
+        full_vectors = {doc_id: list(doc['embedding']) for doc_id, doc in self.documents('embeddings').items()}
+        self.assertTrue(all(len(vector) == DIMENSIONS for vector in full_vectors.values()))
+        self.assertPrefixFields([16, 32], full_vectors)
+
+    def test_fields_replace_embedding(self):
+        self.write_file('a.txt', document(1))
+        self.run_populator(matryoshka_dimensions=[16, 32], vector_storage='replace')
+        docs = self.documents('embeddings')
+        self.assertFalse(any('embedding' in doc for doc in docs.values()))
+        full_vectors = {doc_id: rag_local_backends.HashEmbeddings.vector(doc['text'], DIMENSIONS) for doc_id, doc in docs.items()}
+        self.assertPrefixFields([16, 32], full_vectors)
+
+
+class MatryoshkaArgumentsTest(OfflineRunTest):
+    def main(self, *options: str):
+        """Run main() over the test bucket on the local backends; returns the in-memory Firestore it wrote to"""
+        backends = {}
+        build_backends = rag.build_backends
+
+        def capture_backends(args):
+            backends.update(build_backends(args))
+            return backends
+
+        argv = ['gemini_rag_1536.py', 'gs://bucket/docs', '--storage-backend', 'local', '--local-storage-root', self.root,
+                '--embedding-backend', 'hash', '--firestore-mode', 'memory', *options]
+        # configure_logging would open a log file in the working directory
+        with mock.patch.object(sys, 'argv', argv), mock.patch.object(rag, 'build_backends', capture_backends), \
+                mock.patch.object(rag, 'configure_logging'):
+            rag.main()
+        return backends['db']
+
+    def test_full_size_vector_replaced_by_indexable_prefixes(self):
+        self.write_file('a.txt', document(1, paragraphs=5))
+        db = self.main('--dimensions', '3072', '--matryoshka-dimensions', '256,768,1536', '--vector-storage', 'replace')
+        docs = self.documents('embeddings', db)
+        self.assertTrue(docs)
+        for doc in docs.values():
+            self.assertNotIn('embedding', doc)
+            full = np.asarray(rag_local_backends.HashEmbeddings.vector(doc['text'], 3072), dtype=np.float32)
+            for size in (256, 768, 1536):
+                field = np.asarray(list(doc[rag.matryoshka_field(size)]), dtype=np.float32)
+                np.testing.assert_allclose(field, full[:size] / np.linalg.norm(full[:size]), rtol=1e-5, atol=1e-6)
+
+    def test_rejected_combinations(self):
+        self.write_file('a.txt', document(1, paragraphs=5))
+        for options in (['--vector-storage', 'replace'],
+                        ['--dimensions', '3072', '--matryoshka-dimensions', '256'],
+                        ['--dimensions', '3072', '--matryoshka-dimensions', '256,2560', '--vector-storage', 'replace'],
+                        ['--dimensions', '768', '--matryoshka-dimensions', '768']):
+            with self.assertRaises(SystemExit, msg=options) as raised:
+                self.main(*options)
+            self.assertEqual(raised.exception.code, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""Per-stage run metrics: histograms, merged worker snapshots and the JSON and Prometheus files"""
+
+import json
+import os
+import re
+import unittest
+
+import gemini_rag_1536 as rag
+from rag_test_utils import OfflineRunTest, document
+
+
+class RunMetricsTest(unittest.TestCase):
+    def test_histogram_and_percentiles(self):
+        metrics = rag.RunMetrics()
+        for milliseconds in range(1, 101):
+            metrics.observe('embed', milliseconds / 1000, items=2)
+        stage = metrics.snapshot()['stages']['embed']
+        self.assertEqual((stage['calls'], stage['items']), (100, 200))
+        self.assertAlmostEqual(stage['p50'], 0.051)
+        self.assertAlmostEqual(stage['max'], 0.1)
+        # Cumulative counts, as Prometheus `le` buckets
+        self.assertEqual((stage['buckets']['0.01'], stage['buckets']['0.1'], stage['buckets']['+Inf']), (10, 100, 100))
+
+    def test_timer_counts_items_set_inside(self):
+        metrics = rag.RunMetrics()
+        with metrics.timer('list') as timed:
+            timed['items'] = 7
+        self.assertEqual(metrics.snapshot()['stages']['list']['items'], 7)
+
+    def test_merge_sums_workers(self):
+        snapshots = []
+        for seconds in (0.002, 0.2):
+            metrics = rag.RunMetrics()
+            metrics.register_gauge('embed_queue', lambda: 4)
+            metrics.observe('write', seconds, items=10)
+            metrics.sample_gauges()
+            snapshots.append(metrics.snapshot())
+        merged = rag.RunMetrics.merge(snapshots, wall_seconds=2.0)
+        stage = merged['stages']['write']
+        self.assertEqual((stage['calls'], stage['items'], stage['buckets']['+Inf']), (2, 20, 2))
+        self.assertAlmostEqual(stage['items_per_sec'], 10.0)
+        # Read from the merged histogram: a bucket bound, capped at the slowest call
+        self.assertEqual((stage['p50'], stage['p99']), (0.0025, 0.2))
+        self.assertEqual(merged['queues']['embed_queue']['current'], 8)
+
+
+class MetricsFileTest(OfflineRunTest):
+    def setUp(self):
+        super().setUp()
+        for index in range(3):
+            self.write_file(f'file{index}.txt', document(index))
+
+    def test_json_file(self):
+        path = os.path.join(self.root, 'metrics.json')
+        stats = self.run_populator(metrics_path=path)
+        with open(path) as f:
+            snapshot = json.load(f)
+        stages = snapshot['stages']
+        self.assertTrue({'list', 'download', 'split', 'embed', 'write', 'embed_request', 'write_batch'} <= set(stages))
+        self.assertEqual(stages['embed']['items'], stats['total_chunks'])
+        self.assertEqual(stages['write']['items'], stats['total_chunks'])
+        self.assertEqual(stages['download']['calls'], 3)
+        self.assertIn('embed_queue', snapshot['queues'])
+
+    def test_prometheus_textfile(self):
+        path = os.path.join(self.root, 'metrics.prom')
+        stats = self.run_populator(metrics_path=path, metrics_format='prometheus')
+        with open(path) as f:
+            lines = f.read().splitlines()
+        samples = {}
+        for line in lines:
+            if line.startswith('#'):
+                self.assertRegex(line, r'^# (HELP|TYPE) rag_\w+ ')
+                continue
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+        self.assertEqual(samples['rag_stage_items_total{stage="embed"}'], stats['total_chunks'])
+        for stage in ('embed', 'write'):
+            buckets = [value for name, value in samples.items() if name.startswith(f'rag_stage_seconds_bucket{{stage="{stage}"')]
+            self.assertEqual(buckets, sorted(buckets))
+            self.assertEqual(samples[f'rag_stage_seconds_bucket{{stage="{stage}",le="+Inf"}}'],
+                             samples[f'rag_stage_seconds_count{{stage="{stage}"}}'])
+        self.assertTrue(any(re.match(r'rag_queue_depth\{queue="\w+"\}', name) for name in samples))
+        self.assertFalse(os.path.exists(f"{path}.tmp"))
+
+
+if __name__ == '__main__':
+    unittest.main()
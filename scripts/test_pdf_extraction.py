@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""PDF text extraction on the process pool: page order, per-page timeouts and worker crashes"""
+
+import importlib.util
+import os
+import time
+import unittest
+from unittest import mock
+
+import gemini_rag_1536 as rag
+from rag_test_utils import OfflineRunTest
+
+HAVE_PDF_LIBRARIES = importlib.util.find_spec('PyPDF2') is not None and importlib.util.find_spec('fpdf') is not None
+
+
+def _write_pdf(path: str, pages: int):
+    from fpdf import FPDF
+
+    pdf = FPDF()
+    pdf.set_font('Helvetica', size=12)
+    for page in range(pages):
+        pdf.add_page()
+        pdf.cell(0, 10, f"Page {page + 1} of the quarterly report")
+    pdf.output(path)
+
+
+@unittest.skipUnless(HAVE_PDF_LIBRARIES, 'PyPDF2 and fpdf are needed to write and read test PDFs')
+class PdfExtractionTest(OfflineRunTest):
+    PAGES = 20
+
+    def setUp(self):
+        super().setUp()
+        _write_pdf(os.path.join(self.docs, 'report.pdf'), self.PAGES)
+        self.blob = self.storage.bucket('bucket').blob('docs/report.pdf')
+
+    def assertAllPages(self, text: str):
+        self.assertEqual([line for line in text.split('\n') if line.startswith('Page')],
+                         [f"Page {page + 1} of the quarterly report" for page in range(self.PAGES)])
+
+    def test_pages_in_order(self):
+        populator = self.populator(process_workers=2)
+        self.assertAllPages(populator.extract_text_from_pdf(self.blob))
+
+    def test_pool_restarted_after_worker_crash(self):
+        populator = self.populator(process_workers=2)
+        broken = populator.process_pool
+        # A worker that exits without reporting back breaks the whole pool
+        with self.assertRaises(rag.BrokenProcessPool):
+            broken.submit(os._exit, 1).result()
+        self.assertAllPages(populator.extract_text_from_pdf(self.blob))
+        self.assertIsNot(populator.process_pool, broken)
+        # Later PDFs keep extracting instead of coming back empty
+        self.assertAllPages(populator.extract_text_from_pdf(self.blob))
+
+    def test_broken_pool_fails_the_file(self):
+        populator = self.populator(process_workers=2)
+        with mock.patch.object(rag, 'iter_pdf_pages', side_effect=rag.BrokenProcessPool('worker died')):
+            result = populator.process_file(self.blob, 1, 1)
+        self.assertEqual(result['status'], 'error')
+
+    def test_slow_page_skipped(self):
+        import PyPDF2
+
+        original = PyPDF2.PageObject.extract_text
+        calls = []
+
+        def slow_second_page(page, *args, **kwargs):
+            calls.append(None)
+            if len(calls) == 2:
+                time.sleep(5)
+            return original(page, *args, **kwargs)
+
+        # The worker function runs here, on the main thread, so SIGALRM can interrupt the page
+        with mock.patch.object(PyPDF2.PageObject, 'extract_text', slow_second_page):
+            start = time.monotonic()
+            texts, timed_out = rag._extract_pdf_page_range(self.blob.path, 0, 4, page_timeout=0.2)
+        self.assertLess(time.monotonic() - start, 4)
+        self.assertEqual(timed_out, [1])
+        self.assertEqual(texts[1], '')
+        self.assertIn('Page 3', texts[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
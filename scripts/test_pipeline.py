@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""Pipeline mode of process_all_files against the local backends"""
+
+import unittest
+
+import rag_local_backends
+from rag_test_utils import FailingEmbeddings, OfflineRunTest, document
+
+
+def _without_timestamps(documents: dict) -> dict:
+    return {doc_id: {key: value for key, value in doc.items() if key != 'createdAt'} for doc_id, doc in documents.items()}
+
+
+class PipelineTest(OfflineRunTest):
+    def setUp(self):
+        super().setUp()
+        for index in range(12):
+            self.write_file(f'file{index:02d}.txt', document(index, paragraphs=5 + index))
+        self.write_file('empty.txt', '   \n')
+
+    def test_same_documents_as_serial_run(self):
+        serial_db = rag_local_backends.MemoryFirestore()
+        serial = self.run_populator(db=serial_db)
+        pipelined = self.run_populator(pipeline=True, workers=4)
+        self.assertEqual({key: pipelined[key] for key in ('successful', 'failed', 'no_text', 'total_chunks')},
+                         {key: serial[key] for key in ('successful', 'failed', 'no_text', 'total_chunks')})
+        self.assertEqual(_without_timestamps(self.documents('embeddings')),
+                         _without_timestamps(self.documents('embeddings', serial_db)))
+        self.assertEqual(_without_timestamps(self.documents('sources')),
+                         _without_timestamps(self.documents('sources', serial_db)))
+
+    def test_results_in_listing_order(self):
+        stats = self.run_populator(pipeline=True, workers=4)
+        names = [result['file'] for result in stats['file_results']]
+        self.assertEqual(names, sorted(names))
+        self.assertEqual(len(names), 13)
+        self.assertEqual(stats['no_text'], 1)
+
+    def test_failed_file_does_not_stop_the_others(self):
+        self.write_file('file03.txt', document(3) + 'POISON\n')
+        embeddings = FailingEmbeddings('POISON')
+        populator = self.populator(pipeline=True, workers=4, embeddings=embeddings)
+        populator.batcher.max_retries = 0
+        stats = populator.process_all_files()
+        failed = {failure['file'] for failure in stats['failed_files']}
+        # Files whose chunks shared the rejected request fail with it; the rest of the run goes on
+        self.assertIn('docs/file03.txt', failed)
+        self.assertEqual(stats['successful'] + stats['failed'], 12)
+        self.assertGreater(stats['successful'], 0)
+        # Failed files leave no half-written documents behind
+        self.assertFalse(failed & {source['fileName'] for source in self.documents('sources').values()})
+        self.assertChunksMatchSources()
+
+
+if __name__ == '__main__':
+    unittest.main()
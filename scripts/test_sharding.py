@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""--shard i/N workers: stable assignment, per-worker paths and merging the workers' statistics"""
+
+import argparse
+import os
+import unittest
+
+import gemini_rag_1536 as rag
+import rag_local_backends
+from rag_test_utils import OfflineRunTest, document
+
+
+class ShardAssignmentTest(unittest.TestCase):
+    def test_stable_across_processes(self):
+        # crc32 of the UTF-8 name; fixed values, so a change that would reshuffle running shards fails here
+        names = ['docs/a.txt', 'docs/b.pdf', 'docs/report-2024.csv', 'docs/😀.txt']
+        self.assertEqual([rag.shard_of(name, 4) for name in names], [3, 2, 3, 2])
+
+    def test_roughly_even(self):
+        counts = [0] * 8
+        for index in range(8000):
+            counts[rag.shard_of(f"docs/file-{index:05d}.txt", 8)] += 1
+        self.assertTrue(all(900 <= count <= 1100 for count in counts), counts)
+
+    def test_parse_shard(self):
+        self.assertEqual(rag.parse_shard('2/4'), (2, 4))
+        for value in ('4/4', '-1/4', '0/0', '1', 'a/b'):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                rag.parse_shard(value)
+
+    def test_shard_path(self):
+        self.assertEqual(rag.shard_path('rag_checkpoint.jsonl', (0, 4)), 'rag_checkpoint.shard-0-of-4.jsonl')
+        self.assertEqual(rag.shard_path('out/ann-index/', (3, 4)), 'out/ann-index.shard-3-of-4')
+
+
+class ShardedRunTest(OfflineRunTest):
+    SHARDS = 3
+
+    def setUp(self):
+        super().setUp()
+        for index in range(12):
+            self.write_file(f'file{index:02d}.txt', document(index, paragraphs=5))
+
+    def run_shards(self):
+        stats_paths = []
+        for index in range(self.SHARDS):
+            stats = self.run_populator(shard=(index, self.SHARDS))
+            stats_paths.append(os.path.join(self.root, rag.shard_path('stats.json', (index, self.SHARDS))))
+            rag.write_stats_file(stats_paths[-1], stats)
+        return stats_paths
+
+    def test_workers_partition_the_files(self):
+        stats_paths = self.run_shards()
+        merged = rag.merge_stats_files(stats_paths, os.path.join(self.root, 'merged.json'))
+        self.assertEqual((merged['workers'], merged['successful'], merged['failed']), (3, 12, 0))
+        self.assertEqual(merged['shards'], ['0/3', '1/3', '2/3'])
+        files = [result['file'] for result in merged['file_results']]
+        self.assertEqual(sorted(files), [f'docs/file{index:02d}.txt' for index in range(12)])
+        self.assertTrue(os.path.exists(os.path.join(self.root, 'merged.json')))
+
+        # The same documents as one unsharded run
+        single_db = rag_local_backends.MemoryFirestore()
+        single = self.run_populator(db=single_db)
+        self.assertEqual(merged['total_chunks'], single['total_chunks'])
+        self.assertEqual(set(self.documents('embeddings')), set(self.documents('embeddings', single_db)))
+        self.assertChunksMatchSources()
+
+    def test_missing_shard_reported(self):
+        stats_paths = self.run_shards()
+        with self.assertLogs(rag.logger, 'WARNING') as logs:
+            merged = rag.merge_stats_files(stats_paths[:1] + stats_paths[2:])
+        self.assertTrue(any('No statistics for shards 1/3' in line for line in logs.output))
+        self.assertEqual(merged['workers'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
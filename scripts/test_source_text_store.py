@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""Source text over the inline limit, stored in Firestore parts or GCS shards and read back by byte range"""
+
+import os
+import unittest
+
+import gemini_rag_1536 as rag
+from rag_test_utils import OfflineRunTest, document
+
+
+class SourcePartsTest(OfflineRunTest):
+    # Over SourceTextStore.INLINE_BYTES, so the text is stored in parts
+    TEXT = ''.join(document(seed) for seed in range(120))
+
+    def assertReadBack(self, populator, name: str, text: str):
+        reference = self.db.collection('sources').document(populator._source_doc_id(f'docs/{name}'))
+        fields = reference.get().to_dict()
+        self.assertIn(fields['textStorage'], ('parts', 'gcs'))
+        self.assertGreater(fields['partCount'], 1)
+        store = populator.source_text_store
+        self.assertEqual(store.read(reference), text)
+        data = text.encode('utf-8')
+        # A range across a part boundary, with ends inside multibyte characters moved back to codepoints
+        start, end = fields['partOffsets'][1] - 1001, fields['partOffsets'][1] + 2001
+        self.assertEqual(store.read(reference, start, end),
+                         data[rag.utf8_boundary(data, start):rag.utf8_boundary(data, end)].decode('utf-8'))
+
+    def check_storage(self, **kwargs):
+        self.write_file('whole.txt', self.TEXT)
+        self.write_file('streamed.txt', self.TEXT)
+        populator = self.populator(source_part_kb=300, **kwargs)
+        populator._should_stream = lambda blob: blob.name.endswith('streamed.txt')
+        populator.process_all_files()
+        for name in ('whole.txt', 'streamed.txt'):
+            self.assertReadBack(populator, name, self.TEXT)
+
+        # A shorter version leaves none of the longer one's parts behind
+        shorter = self.TEXT[:len(self.TEXT) // 3]
+        self.write_file('whole.txt', shorter)
+        self.write_file('streamed.txt', shorter)
+        populator.process_all_files()
+        for name in ('whole.txt', 'streamed.txt'):
+            self.assertReadBack(populator, name, shorter)
+        return populator
+
+    def test_parts(self):
+        populator = self.check_storage()
+        for name in ('whole.txt', 'streamed.txt'):
+            source_id = populator._source_doc_id(f'docs/{name}')
+            self.assertEqual(self.db.count(f'sources/{source_id}/parts'), self.source(name)['partCount'])
+
+    def test_gcs(self):
+        populator = self.check_storage(source_storage='gcs', source_text_uri='gs://bucket/source-text')
+        for name in ('whole.txt', 'streamed.txt'):
+            source_id = populator._source_doc_id(f'docs/{name}')
+            shards = os.listdir(os.path.join(self.root, 'bucket', 'source-text', source_id))
+            self.assertEqual(len(shards), self.source(name)['partCount'])
+
+
+if __name__ == '__main__':
+    unittest.main()
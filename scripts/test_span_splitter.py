@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Chunk parity of SpanTextSplitter with LangChain's RecursiveCharacterTextSplitter
+
+Run from the repository root with `python3 -m unittest discover -s scripts` (or pytest).
+The fuzz cases use fixed seeds, so a failure names a case that can be reproduced.
+"""
+
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import gemini_rag_1536 as rag
+import rag_local_backends
+from rag_benchmarks import _fuzz_text, _langchain_splitter_class
+
+LANGCHAIN_SPLITTER = _langchain_splitter_class()
+
+FUZZ_SEEDS = (0, 1, 2)
+FUZZ_CASES_PER_SEED = 100
+
+
+@unittest.skipIf(LANGCHAIN_SPLITTER is None, 'LangChain text splitters not installed')
+class SpanSplitterParityTest(unittest.TestCase):
+    def assertSameChunks(self, text: str, chunk_size: int, chunk_overlap: int, case: str):
+        expected = LANGCHAIN_SPLITTER(chunk_size=chunk_size, chunk_overlap=chunk_overlap).split_text(text)
+        actual = rag.SpanTextSplitter(chunk_size, chunk_overlap).split_text(text)
+        self.assertEqual(actual, expected, f"{case} ({len(text)} chars, {chunk_size}/{chunk_overlap})")
+
+    def test_synthetic_corpus(self):
+        with tempfile.TemporaryDirectory(prefix='rag-split-test-') as workdir:
+            corpus = rag_local_backends.generate_synthetic_corpus(workdir, 'split', 'corpus', 20, 32, seed=0)
+            for name in sorted(os.listdir(corpus['path'])):
+                with open(os.path.join(corpus['path'], name), encoding='utf-8') as f:
+                    self.assertSameChunks(f.read(), 1024, 128, name)
+
+    def test_fuzz(self):
+        for seed in FUZZ_SEEDS:
+            rng = random.Random(seed)
+            for case in range(FUZZ_CASES_PER_SEED):
+                chunk_size = rng.choice([1, 2, 5, 10, 30, 100, 1024])
+                chunk_overlap = rng.randint(0, chunk_size)
+                self.assertSameChunks(_fuzz_text(rng), chunk_size, chunk_overlap, f"seed {seed} case {case}")
+
+    def test_separator_edge_cases(self):
+        for text in ['', ' ', '\n\n\n', 'a' * 3000, 'word ' * 600, '\n\n'.join(['é' * 700] * 5), '𝄞 ' * 1500, '  lead and trail  ' * 200]:
+            for chunk_size, chunk_overlap in ((1024, 128), (100, 0), (100, 100), (7, 3)):
+                self.assertSameChunks(text, chunk_size, chunk_overlap, repr(text[:20]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""Streamed processing of large text files: chunk parity with whole-file runs, resume and the processing state"""
+
+import os
+import unittest
+
+import rag_local_backends
+from rag_test_utils import FailingEmbeddings, OfflineRunTest, document
+
+# Each block fills a chunk on its own, so repeated blocks give identical chunks
+BLOCKS = [' '.join(document(seed, paragraphs=3).split())[:900] for seed in range(40)]
+STREAM_OPTIONS = {'stream_threshold_mb': 1, 'stream_window_mb': 1}
+
+
+def _blocks_text(count: int, repeat_every: int = 3) -> str:
+    """count blocks, every repeat_every-th one a repeat of the first block"""
+    return '\n\n'.join(BLOCKS[0] if index % repeat_every == 0 else BLOCKS[index % len(BLOCKS)] + f" {index}"
+                       for index in range(count)) + '\n'
+
+
+class StreamingTest(OfflineRunTest):
+    def test_same_chunks_as_whole_file(self):
+        text = ''.join(document(seed) for seed in range(120))
+        self.write_file('big.txt', text)
+        streamed = self.run_populator(**STREAM_OPTIONS)
+        whole_db = rag_local_backends.MemoryFirestore()
+        self.run_populator(db=whole_db)
+        self.assertEqual(streamed['total_chunks'], len(self.documents('embeddings', whole_db)))
+        self.assertEqual({doc_id: doc['text'] for doc_id, doc in self.documents('embeddings').items()},
+                         {doc_id: doc['text'] for doc_id, doc in self.documents('embeddings', whole_db).items()})
+        self.assertTrue(self.source('big.txt')['streamed'])
+
+    def test_failed_stream_left_processing(self):
+        self.write_file('big.txt', ''.join(document(seed) for seed in range(120)) + 'POISON ' * 50 + '\n')
+        populator = self.populator(embeddings=FailingEmbeddings('POISON'), **STREAM_OPTIONS)
+        populator.batcher.max_retries = 0
+        self.assertEqual(populator.process_all_files()['failed'], 1)
+        source = self.source('big.txt')
+        self.assertEqual(source['status'], 'processing')
+        self.assertNotIn('text', source)
+        self.assertTrue(self.documents('embeddings'))
+
+    def test_resume_skips_duplicate_indices(self):
+        # Over a megabyte of blocks, a third of them duplicates, with the failing chunk in the last group
+        text = _blocks_text(1400)
+        self.write_file('big.txt', text + '\n\n' + 'POISON ' * 50 + '\n')
+        checkpoint = os.path.join(self.root, 'checkpoint.jsonl')
+        embeddings = FailingEmbeddings('POISON')
+        populator = self.populator(embeddings=embeddings, dedup='exact', checkpoint_path=checkpoint, **STREAM_OPTIONS)
+        populator.batcher.max_retries = 0
+        self.assertEqual(populator.process_all_files()['failed'], 1)
+        populator.close()
+
+        embeddings.fail = False
+        resumed = self.run_populator(embeddings=embeddings, dedup='exact', checkpoint_path=checkpoint, resume=True,
+                                     **STREAM_OPTIONS)
+        self.assertEqual(resumed['successful'], 1)
+        source = self.source('big.txt')
+        # Pointers recorded before the interruption are kept
+        self.assertGreater(len(source['duplicateChunks']), 400)
+        self.assertChunksMatchSources()
+        # Only chunks that were written count as created
+        self.assertEqual(resumed['total_chunks'], len(self.documents('embeddings')))
+
+        clean_db = rag_local_backends.MemoryFirestore()
+        clean = self.run_populator(db=clean_db, dedup='exact', **STREAM_OPTIONS)
+        self.assertEqual(resumed['total_chunks'], clean['total_chunks'])
+        clean_source = next(iter(self.documents('sources', clean_db).values()))
+        self.assertEqual(source['duplicateChunks'], clean_source['duplicateChunks'])
+
+
+if __name__ == '__main__':
+    unittest.main()
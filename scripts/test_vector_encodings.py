@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""Compact vector encodings (float16, int8, binary) written with or instead of the float embedding"""
+
+import unittest
+
+import numpy as np
+
+import gemini_rag_1536 as rag
+from rag_test_utils import DIMENSIONS, OfflineRunTest, document
+
+
+class QuantizationTest(OfflineRunTest):
+    def test_encodings_round_trip(self):
+        self.write_file('a.txt', document(1))
+        self.run_populator(vector_encodings=['float16', 'int8', 'binary'])
+        docs = list(self.documents('embeddings').values())
+        self.assertTrue(docs)
+        full = np.array([list(doc['embedding']) for doc in docs], dtype=np.float32)
+        decoded = {}
+        for encoding, field in rag.VECTOR_ENCODING_FIELDS.items():
+            dtype = np.float16 if encoding == 'float16' else np.int8 if encoding == 'int8' else np.uint8
+            codes = np.stack([np.frombuffer(doc[field], dtype=dtype) for doc in docs])
+            scales = np.array([doc[f"{field}Scale"] for doc in docs], dtype=np.float32) if encoding == 'int8' else None
+            decoded[encoding] = rag.dequantize_embeddings(codes, scales, encoding, DIMENSIONS)
+        np.testing.assert_allclose(decoded['float16'], full, atol=1e-3)
+        np.testing.assert_allclose(decoded['int8'], full, atol=np.abs(full).max() / 127)
+        np.testing.assert_array_equal(decoded['binary'] > 0, full > 0)
+
+    def test_replace_drops_float_vector(self):
+        self.write_file('a.txt', document(1))
+        self.run_populator(vector_encodings=['int8'], vector_storage='replace')
+        doc = next(iter(self.documents('embeddings').values()))
+        self.assertNotIn('embedding', doc)
+        self.assertEqual(len(doc['embeddingInt8']), DIMENSIONS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""Firestore write engine: batching, retries of transient errors and the 500/50/5 ramp"""
+
+import threading
+import time
+import unittest
+from unittest import mock
+
+import gemini_rag_1536 as rag
+import rag_local_backends
+
+
+class ServiceUnavailable(Exception):
+    """Named like google.api_core.exceptions.ServiceUnavailable"""
+    code = 503
+
+
+class FlakyFirestore(rag_local_backends.MemoryFirestore):
+    """In-memory Firestore whose next commit attempts raise the queued errors"""
+
+    def __init__(self, errors=()):
+        super().__init__()
+        self.errors = list(errors)
+        self.attempts = 0
+        self.error_lock = threading.Lock()
+
+    def batch(self):
+        batch = super().batch()
+        commit = batch.commit
+
+        def flaky_commit():
+            with self.error_lock:
+                self.attempts += 1
+                error = self.errors.pop(0) if self.errors else None
+            if error is not None:
+                raise error
+            commit()
+
+        batch.commit = flaky_commit
+        return batch
+
+
+class WriteEngineTest(unittest.TestCase):
+    def engine(self, db, **kwargs) -> rag.FirestoreWriteEngine:
+        engine = rag.FirestoreWriteEngine(db, **kwargs)
+        self.addCleanup(engine.close)
+        return engine
+
+    def write(self, engine, db, count: int):
+        return [engine.set(db.collection('docs').document(f"doc{index}"), {'index': index}) for index in range(count)]
+
+    def test_operations_grouped_into_batches(self):
+        db = rag_local_backends.MemoryFirestore()
+        engine = self.engine(db, batch_size=50)
+        futures = self.write(engine, db, 120)
+        futures.append(engine.delete(db.collection('docs').document('doc0')))
+        engine.wait(futures)
+        stats = engine.stats()
+        self.assertEqual((stats['writes'], stats['deletes'], stats['batches']), (120, 1, 3))
+        self.assertEqual(db.count('docs'), 119)
+
+    @mock.patch.object(rag.random, 'uniform', return_value=0.0)
+    def test_transient_errors_retried(self, uniform):
+        db = FlakyFirestore([ServiceUnavailable('503 The service is currently unavailable')] * 2)
+        engine = self.engine(db, batch_size=50)
+        engine.wait(self.write(engine, db, 10))
+        self.assertEqual(db.count('docs'), 10)
+        self.assertEqual((engine.stats()['retries'], engine.stats()['failures'], db.attempts, db.commits), (2, 0, 3, 1))
+
+    @mock.patch.object(rag.random, 'uniform', return_value=0.0)
+    def test_failure_after_attempts_or_on_validation_error(self, uniform):
+        db = FlakyFirestore([ServiceUnavailable('503 unavailable')] * 3)
+        engine = self.engine(db, max_attempts=3)
+        with self.assertRaises(rag.WriteEngineError):
+            engine.wait(self.write(engine, db, 5))
+        self.assertEqual((engine.stats()['retries'], engine.stats()['failures']), (2, 5))
+
+        # Not worth retrying: the batch fails on the first attempt
+        db.errors = [ValueError('400 Document too large')]
+        with self.assertRaises(rag.WriteEngineError):
+            engine.wait(self.write(engine, db, 5))
+        self.assertEqual(engine.stats()['retries'], 2)
+        self.assertEqual(db.count('docs'), 0)
+
+    def test_ramp_up(self):
+        engine = self.engine(object(), max_ops_per_second=2000)
+        self.assertEqual(engine.initial_ops_per_second, 500)
+        self.assertEqual(engine._current_rate(1000.0), 500)
+        self.assertEqual(engine._current_rate(1000.0 + 299), 500)
+        self.assertEqual(engine._current_rate(1000.0 + 300), 750)
+        self.assertEqual(engine._current_rate(1000.0 + 600), 1125)
+        self.assertEqual(engine._current_rate(1000.0 + 3000), 2000)
+
+    def test_no_ramp_up_without_hot_spotting(self):
+        engine = self.engine(rag_local_backends.MemoryFirestore(), max_ops_per_second=2000)
+        self.assertEqual(engine._current_rate(time.monotonic()), 2000)
+
+    def test_writes_paced_to_the_rate(self):
+        db = rag_local_backends.MemoryFirestore()
+        engine = self.engine(db, batch_size=25, initial_ops_per_second=200, max_ops_per_second=200)
+        start = time.monotonic()
+        engine.wait(self.write(engine, db, 100))
+        # The first batch goes at once; the other 75 writes take 75 / 200 seconds
+        self.assertGreaterEqual(time.monotonic() - start, 0.35)
+        self.assertEqual(db.count('docs'), 100)
+
+
+if __name__ == '__main__':
+    unittest.main()